@@ -0,0 +1,91 @@
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.choker import OPTIMISTIC_INTERVAL, RECHOKE_INTERVAL, UPLOAD_SLOTS, Choker
+
+# A model swarm in which every remote peer plays tit-for-tat with us: it uploads to us at its full
+# share only while what we upload to it beats what its other peers give it, and otherwise only
+# when its own optimistic unchoke lands on us. The real Choker decides whom we upload to, driven
+# by a simulated clock, and is compared against unchoking peers at random and against not
+# uploading at all. Reports the download rate each policy gets out of the swarm.
+# Usage: python3 benchmarks/choker_simulation.py --peers 40 --upload-kib 256 --minutes 30 --runs 5
+
+TICK = 1 # Simulated seconds per step
+REMOTE_SLOTS = 4 # Upload slots of every remote peer
+
+class RemotePeer:
+    def __init__(self, index: int, rng: random.Random):
+        self.key = f"10.0.{index // 256}.{index % 256}:6881"
+        self.ip = self.key.split(":")[0]
+        # Upload capacities spread over two orders of magnitude, like a real swarm
+        self.capacity = 2**10 * rng.choice([16, 32, 64, 128, 256, 512, 1024])
+        # What its best other partners give it: the rate we have to beat to earn a regular slot
+        self.bar = self.capacity * rng.uniform(0.2, 1.2) / REMOTE_SLOTS
+        self.received = 0.0
+        self.received_rate = 0.0
+        self.unchokes_us = False
+
+    def rechoke(self, rng: random.Random) -> None:
+        self.received_rate = self.received / RECHOKE_INTERVAL
+        self.received = 0.0
+        optimistic = rng.random() < 1 / (REMOTE_SLOTS * 10)
+        self.unchokes_us = self.received_rate >= self.bar or optimistic
+
+def simulate(policy: str, num_peers: int, upload: int, seconds: int, slots: int, seed: int) -> float:
+    rng = random.Random(seed)
+    random.seed(seed)
+    now = [0.0]
+    choker = Choker(slots, clock=lambda: now[0])
+    remotes = [RemotePeer(i, rng) for i in range(num_peers)]
+    for remote in remotes:
+        choker.add(remote.key, remote.ip, lambda message: None)
+        choker.set_interested(remote.key, True)
+
+    downloaded = 0.0
+    for tick in range(0, seconds, TICK):
+        now[0] = tick
+        if tick % RECHOKE_INTERVAL == 0:
+            for remote in remotes:
+                remote.rechoke(rng)
+            if policy == "tit-for-tat":
+                choker.rechoke()
+                unchoked = [remote for remote in remotes if not choker.peers[remote.key].choked]
+            elif policy == "random":
+                unchoked = rng.sample(remotes, slots + 1)
+            else:
+                unchoked = []
+
+        if unchoked:
+            share = upload * TICK / len(unchoked)
+            for remote in unchoked:
+                remote.received += share
+                choker.record_upload(remote.key, int(share))
+
+        for remote in remotes:
+            if remote.unchokes_us:
+                got = remote.capacity * TICK / REMOTE_SLOTS
+                downloaded += got
+                choker.record_download(remote.ip, int(got))
+
+    return downloaded / seconds
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--peers", type=int, default=40)
+    parser.add_argument("--upload-kib", type=int, default=256, help="our upload capacity in KiB/s")
+    parser.add_argument("--minutes", type=int, default=30)
+    parser.add_argument("--slots", type=int, default=UPLOAD_SLOTS)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{args.peers} peers, {args.upload_kib} KiB/s upload, {args.slots} slots + 1 optimistic "
+          f"(rotated every {OPTIMISTIC_INTERVAL} s), {args.minutes} min simulated")
+    for policy in ("tit-for-tat", "random", "no upload"):
+        rates = [simulate(policy, args.peers, args.upload_kib * 2**10, args.minutes * 60, args.slots, seed)
+                 for seed in range(args.runs)]
+        print(f"{policy:>12}: {sum(rates) / len(rates) / 2**10:8.1f} KiB/s download "
+              f"(min {min(rates) / 2**10:.1f}, max {max(rates) / 2**10:.1f})")
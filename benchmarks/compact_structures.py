@@ -0,0 +1,107 @@
+import argparse
+import asyncio
+import gc
+import os
+import struct
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils.build_messages as messages
+import utils.verify_messages as verify
+from utils.metainfo import FileTable
+
+# Compares the previous representations (a dict per file, a ParsedMessage plus two slices per
+# block) with the compact ones (FileTable arrays, message bodies read as views) and reports
+# time, peak traced memory and the number of garbage collections each one triggers.
+# Usage: python3 benchmarks/compact_structures.py --files 100000 --blocks 20000
+
+BLOCK_SIZE = 2**14
+BATCH = 64
+
+class DictParsedMessage:
+    # ParsedMessage as it was before it got __slots__
+    def __init__(self, size, id, payload):
+        self.size = size
+        self.id = id
+        self.payload = payload
+
+def file_dicts(count: int, root: str):
+    files = []
+    offset = 0
+    for file_index in range(count):
+        length = 1000 + file_index
+        files.append({'path': root + f"dir{file_index % 100}/file{file_index}.bin", 'length': length, 'offset': offset})
+        offset += length
+    return files
+
+def file_table(count: int, root: str):
+    return FileTable(root, [f"dir{file_index % 100}/file{file_index}.bin" for file_index in range(count)],
+                     [1000 + file_index for file_index in range(count)])
+
+async def blocks_old(reader: asyncio.StreamReader, count: int) -> int:
+    received = 0
+    for _ in range(count):
+        msg = await messages.recv_whole_message(reader, isHandshake=False)
+        length = struct.unpack(">I", msg[:4])[0]
+        parsed = DictParsedMessage(length, struct.unpack(">b", msg[4:5])[0], msg[5:])
+        if verify.is_piece(parsed):
+            struct.unpack(">II", parsed.payload[:8])
+            received += len(parsed.payload[8:])
+    return received
+
+async def blocks_new(reader: asyncio.StreamReader, count: int) -> int:
+    received = 0
+    for _ in range(count):
+        body = await messages.recv_message_body(reader)
+        if verify.is_piece_body(body):
+            struct.unpack_from(">II", body, 1)
+            received += len(memoryview(body)[9:])
+    return received
+
+def run_blocks(consume, count: int) -> int:
+    block = os.urandom(BLOCK_SIZE)
+    batch = b''.join(struct.pack(">IbII", 9 + BLOCK_SIZE, 7, i, 0) + block for i in range(BATCH))
+
+    async def run():
+        reader = asyncio.StreamReader(limit=2**24)
+        received = 0
+        for _ in range(count // BATCH):
+            reader.feed_data(batch)
+            received += await consume(reader, BATCH)
+        return received
+
+    return asyncio.run(run())
+
+def measure(label: str, fn, *args) -> None:
+    # Timed without tracing first, tracemalloc slows allocation heavy code down a lot
+    gc.collect()
+    collections = sum(stat['collections'] for stat in gc.get_stats())
+    started = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - started
+    collections = sum(stat['collections'] for stat in gc.get_stats()) - collections
+    del result
+
+    gc.collect()
+    tracemalloc.start()
+    result = fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<28} {elapsed * 1000:8.1f} ms   peak {peak / 2**20:7.2f} MiB   gc runs {collections:5d}")
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=100000)
+    parser.add_argument("--blocks", type=int, default=20000)
+    args = parser.parse_args()
+
+    root = "/downloads/some torrent/"
+    measure("file table: dict per file", file_dicts, args.files, root)
+    measure("file table: FileTable", file_table, args.files, root)
+
+    measure("blocks: ParsedMessage", run_blocks, blocks_old, args.blocks)
+    measure("blocks: body + memoryview", run_blocks, blocks_new, args.blocks)
@@ -0,0 +1,100 @@
+import argparse
+import asyncio
+import contextlib
+import os
+import queue
+import random
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.logger import Logger
+from utils.lsd import LSD_GROUP, LocalServiceDiscovery, PeerIntake, build_announce
+
+# Local Service Discovery between clients on one host, over multicast on the loopback interface:
+# a client announcing a torrent must be found by another client of the same torrent and ignored by
+# a client of a different one and by itself. Announces closer together than --min-interval are
+# not sent, and a peer re-announcing within it is not queued again until the interval has passed.
+# While a pipeline has the intake open, a found peer goes to that pipeline's loop, not to the next batch.
+# Usage: python3 benchmarks/lsd_loopback.py --min-interval 1
+
+def receive(lsd: LocalServiceDiscovery, seconds: float) -> list:
+    # Handles whatever arrives on the client's socket for a while, returns the peers it queued
+    queued = []
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        try:
+            data, addr = lsd.sock.recvfrom(1400)
+        except socket.timeout:
+            continue
+        peer = lsd.handle(data, addr)
+        if peer is not None:
+            queued.append(peer)
+    return queued
+
+def drain(intake: PeerIntake) -> list:
+    peers = []
+    while not intake.peers_list.empty():
+        peers.extend(intake.peers_list.get_nowait())
+    return peers
+
+async def receive_in_pipeline(lsd: LocalServiceDiscovery, seconds: float) -> list:
+    # Stands in for a running pipeline: the LSD thread hands what it finds to this loop
+    handed_over = []
+    lsd.intake.open(asyncio.get_running_loop(), handed_over.extend)
+    try:
+        await asyncio.to_thread(receive, lsd, seconds)
+        await asyncio.sleep(0)
+    finally:
+        lsd.intake.close()
+    return handed_over
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mcast-port", type=int, default=None, help="multicast port (default: a random one)")
+    parser.add_argument("--min-interval", type=float, default=1.0)
+    args = parser.parse_args()
+
+    mcast_port = args.mcast_port or random.randint(20000, 60000)
+    info_hash = os.urandom(20)
+    clients = {}
+    for name, client_hash, port in (("seeder", info_hash, 50001), ("leecher", info_hash, 50002), ("other", os.urandom(20), 50003)):
+        clients[name] = LocalServiceDiscovery(client_hash, port, PeerIntake(queue.Queue()), Logger(), LSD_GROUP, mcast_port,
+                                              interface="127.0.0.1", min_interval=args.min_interval)
+        clients[name].sock.settimeout(0.05)
+    seeder, leecher, other = clients["seeder"], clients["leecher"], clients["other"]
+    checks = []
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        seeder.announce()
+        found = receive(leecher, 0.5)
+        checks.append(("leecher finds the seeder", found == [("127.0.0.1", 50001)] and drain(leecher.intake) == found))
+        checks.append(("other torrent ignores it", receive(other, 0.2) == [] and drain(other.intake) == []))
+        checks.append(("seeder ignores its own announce", receive(seeder, 0.2) == []))
+
+        # Rate limit: the seeder does not announce again yet, a copy of its announce is not queued again
+        checks.append(("second announce held back", not seeder.announce()))
+        replayed = build_announce(info_hash, 50001, "replayed", LSD_GROUP, mcast_port)
+        seeder.sock.sendto(replayed, (LSD_GROUP, mcast_port))
+        checks.append(("repeat within interval dropped", receive(leecher, 0.2) == []))
+
+        time.sleep(args.min_interval)
+        checks.append(("announce after interval sent", seeder.announce()))
+        checks.append(("repeat after interval queued", receive(leecher, 0.5) == [("127.0.0.1", 50001)] and drain(leecher.intake)))
+
+        time.sleep(args.min_interval)
+        seeder.announce()
+        handed_over = asyncio.run(receive_in_pipeline(leecher, 0.5))
+        checks.append(("running pipeline gets the peer", handed_over == [("127.0.0.1", 50001)] and drain(leecher.intake) == []))
+
+    for lsd in clients.values():
+        lsd.close()
+
+    failed = False
+    print(f"multicast {LSD_GROUP}:{mcast_port} on 127.0.0.1")
+    for check, passed in checks:
+        print(f"{check:>32}: {'ok' if passed else 'FAILED'}")
+        failed = failed or not passed
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,161 @@
+import argparse
+import asyncio
+import os
+import random
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils.build_messages as messages
+from utils.details import TorrentDetails
+
+# Messages per second for every build_* function, next to the format-string struct.pack versions
+# they replaced, and the CPU time it takes to send the requests for a stream of pieces over a
+# loopback connection: one request, write and drain per block as before, against one buffer and
+# one drain per pipeline refill.
+# Usage: python3 benchmarks/message_encoding.py --seconds 0.5 --mb 256
+
+BLOCK_SIZE = 2**14
+PIPELINE_DEPTH = 10
+
+def legacy_handshake(details):
+    peer_id = b'-TR4003-' + bytes(random.getrandbits(8) for _ in range(12))
+    return struct.pack(">B19s8s20s20s", 19, b"BitTorrent protocol", bytes(8), details.info_hash, peer_id)
+
+def legacy_bitfield(bitfield, details):
+    bitfield_bytes = bytearray((details.num_of_pieces + 7) // 8)
+    for i, has_piece in enumerate(bitfield):
+        if has_piece:
+            bitfield_bytes[i // 8] |= (1 << (7 - (i % 8)))
+    return struct.pack(">Ib", 1 + len(bitfield_bytes), 5) + bytes(bitfield_bytes)
+
+def legacy_requests(piece_index, blocks):
+    return [legacy_request(piece_index, begin, length) for begin, length in blocks]
+
+# The previous build_* functions, each packing with a format string
+def legacy_keep_alive():
+    return struct.pack(">I", 0)
+
+def legacy_choke():
+    return struct.pack(">Ib", 1, 0)
+
+def legacy_unchoke():
+    return struct.pack(">Ib", 1, 1)
+
+def legacy_interested():
+    return struct.pack(">Ib", 1, 2)
+
+def legacy_uninterested():
+    return struct.pack(">Ib", 1, 3)
+
+def legacy_have(piece_index):
+    return struct.pack(">IbI", 5, 4, piece_index)
+
+def legacy_request(piece_index, begin, length):
+    return struct.pack(">IbIII", 13, 6, piece_index, begin, length)
+
+def legacy_piece_header(piece_index, begin, block_length):
+    return struct.pack(">IbII", 9 + block_length, 7, piece_index, begin)
+
+def legacy_piece(piece_index, begin, block):
+    return struct.pack(">IbII", 9 + len(block), 7, piece_index, begin) + block
+
+def legacy_cancel(piece_index, begin, length):
+    return struct.pack(">IbIII", 13, 8, piece_index, begin, length)
+
+def legacy_port(port):
+    return struct.pack(">IbH", 3, 9, port)
+
+def legacy_hash_request(pieces_root, base_layer, index, length, proof_layers):
+    return struct.pack(">Ib32sIIII", 49, 21, pieces_root, base_layer, index, length, proof_layers)
+
+def rate(function, seconds: float) -> float:
+    # Calls per second, timed in rounds of 1000 calls
+    calls = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        for _ in range(1000):
+            function()
+        calls += 1000
+    return calls / (time.perf_counter() - started)
+
+def encoding_cases(details: TorrentDetails):
+    bitfield = [random.random() < 0.5 for _ in range(details.num_of_pieces)]
+    block = os.urandom(BLOCK_SIZE)
+    blocks = [(begin, BLOCK_SIZE) for begin in range(0, PIPELINE_DEPTH * BLOCK_SIZE, BLOCK_SIZE)]
+    root = os.urandom(32)
+    # (name, messages per call, new, old)
+    return [
+        ("handshake", 1, lambda: messages.build_bitTorrent_handshake(details), lambda: legacy_handshake(details)),
+        ("keep_alive", 1, messages.build_keep_alive, legacy_keep_alive),
+        ("choke", 1, messages.build_choke, legacy_choke),
+        ("unchoke", 1, messages.build_unchoke, legacy_unchoke),
+        ("interested", 1, messages.build_interested, legacy_interested),
+        ("uninterested", 1, messages.build_uninterested, legacy_uninterested),
+        ("have", 1, lambda: messages.build_have(1234), lambda: legacy_have(1234)),
+        ("bitfield", 1, lambda: messages.build_bitfeild(bitfield, details), lambda: legacy_bitfield(bitfield, details)),
+        ("request", 1, lambda: messages.build_request(7, 16384, BLOCK_SIZE), lambda: legacy_request(7, 16384, BLOCK_SIZE)),
+        ("requests", PIPELINE_DEPTH, lambda: messages.build_requests(7, blocks), lambda: legacy_requests(7, blocks)),
+        ("piece_header", 1, lambda: messages.build_piece_header(7, 16384, BLOCK_SIZE), lambda: legacy_piece_header(7, 16384, BLOCK_SIZE)),
+        ("piece", 1, lambda: messages.build_piece(7, 16384, block), lambda: legacy_piece(7, 16384, block)),
+        ("cancel", 1, lambda: messages.build_cancel(7, 16384, BLOCK_SIZE), lambda: legacy_cancel(7, 16384, BLOCK_SIZE)),
+        ("port", 1, lambda: messages.build_port(6881), lambda: legacy_port(6881)),
+        ("hash_request", 1, lambda: messages.build_hash_request(root, 0, 0, 512, 0),
+         lambda: legacy_hash_request(root, 0, 0, 512, 0)),
+    ]
+
+async def send_requests(size: int, batched: bool) -> float:
+    # CPU seconds spent requesting `size` bytes worth of blocks, the other end only discards
+    done = asyncio.Event()
+    async def discard(reader, writer):
+        while await reader.read(2**16):
+            pass
+        done.set()
+    server = await asyncio.start_server(discard, "127.0.0.1", 0)
+    reader, writer = await asyncio.open_connection("127.0.0.1", server.sockets[0].getsockname()[1])
+
+    blocks_per_piece = 16
+    started = time.process_time()
+    for piece_index in range(size // (BLOCK_SIZE * blocks_per_piece)):
+        blocks = [(begin, BLOCK_SIZE) for begin in range(0, blocks_per_piece * BLOCK_SIZE, BLOCK_SIZE)]
+        for refill in range(0, len(blocks), PIPELINE_DEPTH):
+            batch = blocks[refill:refill + PIPELINE_DEPTH]
+            if batch:
+                if batched:
+                    writer.write(messages.build_requests(piece_index, batch))
+                    await writer.drain()
+                else:
+                    for begin, length in batch:
+                        writer.write(legacy_request(piece_index, begin, length))
+                        await writer.drain()
+    elapsed = time.process_time() - started
+
+    writer.close()
+    await done.wait()
+    server.close()
+    await server.wait_closed()
+    return elapsed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=0.5, help="time spent on each function")
+    parser.add_argument("--mb", type=int, default=256, help="data requested in the send test")
+    parser.add_argument("--pieces", type=int, default=10000, help="pieces of the torrent, sets the bitfield size")
+    args = parser.parse_args()
+
+    info = {b'name': b'bench.bin', b'piece length': 2**18, b'length': args.pieces * 2**18, b'pieces': bytes(20 * args.pieces)}
+    details = TorrentDetails(info, "/tmp/")
+
+    print(f"{'message':>14} {'new msg/s':>12} {'old msg/s':>12}  speedup")
+    for name, per_call, new, old in encoding_cases(details):
+        new_rate = rate(new, args.seconds) * per_call
+        old_rate = rate(old, args.seconds) * per_call
+        print(f"{name:>14} {new_rate:12,.0f} {old_rate:12,.0f}  x{new_rate / old_rate:.2f}")
+
+    size = args.mb * 2**20
+    for batched in (False, True):
+        cpu = asyncio.run(send_requests(size, batched))
+        label = "one buffer per refill" if batched else "write + drain per block"
+        print(f"{label:>24}: {cpu * 1000 / args.mb:.3f} ms CPU per MiB requested")
@@ -0,0 +1,134 @@
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import multiprocessing
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bencodepy
+
+from utils.json_data import ResumeData
+from utils.multiproc import DownloadProcesses, SharedPieceState
+
+# Downloads a random torrent from a local swarm of seeders with 1, 2, 4 ... worker processes and
+# reports the throughput of each run. The seeders run in their own processes so they do not
+# compete with the client for the same core.
+# Usage: python3 benchmarks/multiprocess_swarm.py --size-mb 256 --seeders 32 --max-processes 4
+
+async def serve_peer(reader, writer, info_hash: bytes, blob: bytes, piece_length: int) -> None:
+    await reader.readexactly(68)
+    writer.write(struct.pack(">B19s8x20s20s", 19, b"BitTorrent protocol", info_hash, os.urandom(20)))
+    num_of_pieces = (len(blob) + piece_length - 1) // piece_length
+    bitfield = bytearray(b'\xff' * ((num_of_pieces + 7) // 8))
+    if num_of_pieces % 8:
+        bitfield[-1] = (0xff << (8 - num_of_pieces % 8)) & 0xff
+    writer.write(struct.pack(">Ib", 1 + len(bitfield), 5) + bytes(bitfield))
+    writer.write(struct.pack(">Ib", 1, 1))
+    view = memoryview(blob)
+
+    try:
+        while True:
+            length = struct.unpack(">I", await reader.readexactly(4))[0]
+            if length == 0:
+                continue
+            payload = await reader.readexactly(length)
+            if payload[0] != 6:
+                continue
+            index, begin, block_length = struct.unpack(">III", payload[1:13])
+            start = index * piece_length + begin
+            writer.write(struct.pack(">IbII", 9 + block_length, 7, index, begin))
+            writer.write(view[start:start + block_length])
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+def run_seeders(first_slot: int, count: int, info_hash: bytes, blob: bytes, piece_length: int, ports) -> None:
+    async def start():
+        servers = []
+        for index in range(count):
+            server = await asyncio.start_server(lambda r, w: serve_peer(r, w, info_hash, blob, piece_length), "127.0.0.1", 0)
+            servers.append(server)
+            ports[first_slot + index] = server.sockets[0].getsockname()[1]
+        await asyncio.Event().wait()
+
+    asyncio.run(start())
+
+def make_torrent(size: int, piece_length: int):
+    blob = os.urandom(size)
+    hashes = b''.join(hashlib.sha1(blob[i:i + piece_length]).digest() for i in range(0, size, piece_length))
+    info_dict = {b'name': b'bench.bin', b'piece length': piece_length, b'length': size, b'pieces': hashes}
+    return info_dict, hashlib.sha1(bencodepy.encode(info_dict)).digest(), blob
+
+def download(num_processes: int, info_dict: dict, peers: list, context) -> float:
+    num_of_pieces = len(info_dict[b'pieces']) // 20
+    dir_path = tempfile.mkdtemp(prefix="swarm-bench-") + '/'
+    resume_data = ResumeData(info_hash="", piece_length=info_dict[b'piece length'], total_pieces=num_of_pieces,
+                             downloaded=0, file_sizes=[info_dict[b'length']], mtime=0,
+                             verified_pieces=[False] * num_of_pieces, last_active="")
+    shared = SharedPieceState(resume_data.verified_pieces, context, num_processes)
+    processes = DownloadProcesses(num_processes, info_dict, None, dir_path, resume_data, shared, {
+        'streaming': False,
+        'write_through': False,
+        'transport': 'tcp',
+        'max_half_open': 32,
+        'min_peers': 2,
+        'max_peers': 40,
+        'max_claim': 30,
+        'preallocate': False,
+        'fsync': 'checkpoint',
+    }, context)
+
+    # Forked workers inherit the silenced stdout, the client logs every connection and piece
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        processes.start()
+    started = time.perf_counter()
+    processes.dispatch(peers)
+
+    while shared.downloaded() < num_of_pieces:
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - started
+
+    processes.stop()
+    shutil.rmtree(dir_path, ignore_errors=True)
+    return elapsed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=float, default=256)
+    parser.add_argument("--piece-kb", type=int, default=256)
+    parser.add_argument("--seeders", type=int, default=32)
+    parser.add_argument("--seeder-processes", type=int, default=2)
+    parser.add_argument("--max-processes", type=int, default=4)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("fork")
+    size = int(args.size_mb * 2**20)
+    info_dict, info_hash, blob = make_torrent(size, args.piece_kb * 1024)
+
+    # Each seeder process fills its slice of the shared port table once its servers listen
+    ports = context.Array('i', args.seeders, lock=False)
+    per_process = args.seeders // args.seeder_processes
+    for first_slot in range(0, per_process * args.seeder_processes, per_process):
+        context.Process(target=run_seeders, daemon=True,
+                        args=(first_slot, per_process, info_hash, blob, info_dict[b'piece length'], ports)).start()
+    time.sleep(1)
+
+    peers = [("127.0.0.1", port) for port in ports if port]
+    baseline = None
+    num_processes = 1
+    while num_processes <= args.max_processes:
+        elapsed = download(num_processes, info_dict, peers, context)
+        rate = size / elapsed / 2**20
+        baseline = baseline or rate
+        print(f"{num_processes} process(es): {size / 2**20:.0f} MiB in {elapsed:.2f} s, "
+              f"{rate:.1f} MiB/s, x{rate / baseline:.2f}")
+        num_processes *= 2
@@ -0,0 +1,76 @@
+import argparse
+import asyncio
+import contextlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.details import TorrentDetails
+from utils.download import BLOCK_SIZE, MAX_CLAIM_PER_PEER, main
+from utils.json_data import ResumeData
+from utils.logger import Logger
+from utils.metainfo import Metainfo
+from utils.piece_picker import PiecePicker
+from utils.replay import SessionReplay, load_recording
+from utils.session import DownloadSession
+from utils.storage import Storage
+
+# Runs the real download pipeline against peer connections recorded with `master.py --record FILE`,
+# without a network. Each run downloads into a fresh temporary folder and reports the time taken
+# and how many pieces were verified, which must match the complete pieces in the recording.
+# Usage: python3 benchmarks/replay_session.py file.torrent session.rec --speed 0 --runs 3
+#   --speed 1 keeps the recorded timing, 0 replays as fast as possible
+
+def recorded_pieces(recorded, details: TorrentDetails) -> int:
+    # Pieces every block of which was received from some peer
+    blocks = set()
+    for connection in recorded:
+        blocks.update(connection.messages()[1])
+    return sum(all((piece_index, begin) in blocks for begin in range(0, details.piece_size(piece_index), BLOCK_SIZE))
+               for piece_index in range(details.num_of_pieces))
+
+def replay(metainfo: Metainfo, recorded, speed: float):
+    dir_path = tempfile.mkdtemp(prefix="replay-") + '/'
+    details = TorrentDetails(metainfo.info, dir_path, piece_layers=metainfo.piece_layers, info_hash=metainfo.info_hash)
+    resume_data = ResumeData(info_hash=details.info_hash.hex(), piece_length=details.piece_length,
+                             total_pieces=details.num_of_pieces, downloaded=0, file_sizes=details.file_sizes,
+                             mtime=0, verified_pieces=[False] * details.num_of_pieces, last_active="")
+    replay = SessionReplay(recorded, speed)
+    session = DownloadSession(details=details, resume_data=resume_data, storage=Storage(details),
+                              picker=PiecePicker(details, resume_data), replay=replay,
+                              max_claim=MAX_CLAIM_PER_PEER, claim_size=MAX_CLAIM_PER_PEER)
+
+    # The client logs every message, that is not what is being measured
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        asyncio.run(main(replay.peers(), session, Logger()))
+        elapsed = time.perf_counter() - started
+    session.storage.close()
+    shutil.rmtree(dir_path, ignore_errors=True)
+    return elapsed, details, resume_data.downloaded
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("torrent_file")
+    parser.add_argument("recording")
+    parser.add_argument("--speed", type=float, default=0)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    metainfo = Metainfo.load(args.torrent_file)
+    recorded = load_recording(args.recording)
+    received = sum(len(connection.received) for connection in recorded)
+    print(f"{len(recorded)} recorded connections, {received / 2**20:.1f} MiB received")
+
+    failed = False
+    for run in range(args.runs):
+        elapsed, details, verified = replay(metainfo, recorded, args.speed)
+        expected = recorded_pieces(recorded, details)
+        print(f"run {run + 1}: {elapsed:.2f} s, {received / elapsed / 2**20:.1f} MiB/s, "
+              f"{verified} of {expected} recorded pieces verified")
+        failed = failed or verified < expected
+    sys.exit(1 if failed else 0)
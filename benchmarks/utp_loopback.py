@@ -0,0 +1,94 @@
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils.utp as utp
+
+# Transfers data over uTP on loopback through an emulated bottleneck link and reports
+# throughput together with the queueing delay LEDBAT builds up in front of the link.
+# Usage: python3 benchmarks/utp_loopback.py --size-mb 8 --latency-ms 25 --rate-mbit 20
+
+class EmulatedLinkEndpoint(utp.UTPEndpoint):
+    def __init__(self, accept_callback=None, latency=0.0, rate=0.0, loss=0.0):
+        super().__init__(accept_callback)
+        self.latency = latency
+        self.rate = rate
+        self.loss = loss
+        self.link_free_at = 0.0
+        self.queue_delays = []
+
+    def send(self, data: bytes, addr) -> None:
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+
+        if self.loss and random.random() < self.loss:
+            return
+
+        # Packets leave the bottleneck one after another at the link rate, then travel for latency seconds
+        start = max(now, self.link_free_at)
+        self.queue_delays.append(start - now)
+        departure = start + (len(data) / self.rate if self.rate else 0.0)
+        self.link_free_at = departure
+        loop.call_at(departure + self.latency, super().send, data, addr)
+
+async def run(size: int, latency: float, rate: float, loss: float) -> None:
+    payload = os.urandom(size)
+    done = asyncio.get_running_loop().create_future()
+    server_connection = {}
+
+    async def serve(reader, writer):
+        server_connection['conn'] = writer.connection
+        writer.write(payload)
+        await writer.drain()
+        writer.close()
+        await writer.wait_closed()
+
+    server = await utp.start_utp_server(serve, "127.0.0.1", 0,
+                                        endpoint_factory=lambda cb: EmulatedLinkEndpoint(cb, latency, rate, loss))
+    port = server.transport.get_extra_info("sockname")[1]
+
+    loop = asyncio.get_running_loop()
+    _, client = await loop.create_datagram_endpoint(lambda: EmulatedLinkEndpoint(None, latency, 0.0, loss),
+                                                    local_addr=("127.0.0.1", 0))
+
+    started = time.perf_counter()
+    reader, writer = await utp.open_utp_connection("127.0.0.1", port, endpoint=client)
+    received = 0
+    while True:
+        chunk = await reader.read(65536)
+        if not chunk:
+            break
+        received += len(chunk)
+    elapsed = time.perf_counter() - started
+    writer.close()
+    await writer.wait_closed()
+
+    delays = sorted(server.queue_delays) or [0.0]
+    print(f"transferred      : {received / 2**20:.1f} MiB in {elapsed:.2f} s")
+    print(f"throughput       : {received * 8 / elapsed / 1e6:.1f} Mbit/s"
+          + (f" (link {rate * 8 / 1e6:.1f} Mbit/s)" if rate else ""))
+    print(f"queueing delay   : mean {statistics.mean(delays) * 1000:.1f} ms, "
+          f"p95 {delays[int(len(delays) * 0.95)] * 1000:.1f} ms, "
+          f"target {utp.CCONTROL_TARGET / 1000:.0f} ms")
+    if 'conn' in server_connection:
+        conn = server_connection['conn']
+        print(f"final window     : {conn.max_window / 1024:.0f} KiB, rtt {conn.rtt * 1000:.1f} ms")
+
+    server.close()
+    client.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=float, default=8)
+    parser.add_argument("--latency-ms", type=float, default=25, help="one-way latency added in each direction")
+    parser.add_argument("--rate-mbit", type=float, default=20, help="bottleneck rate of the sending side, 0 for unlimited")
+    parser.add_argument("--loss", type=float, default=0.0, help="random packet loss probability")
+    args = parser.parse_args()
+
+    asyncio.run(run(int(args.size_mb * 2**20), args.latency_ms / 1000, args.rate_mbit * 1e6 / 8, args.loss))
@@ -0,0 +1,229 @@
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from urllib.parse import unquote
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils.merkle as merkle
+from utils.details import TorrentDetails
+from utils.json_data import ResumeData
+from utils.logger import Logger
+from utils.piece_picker import PiecePicker
+from utils.session import DownloadSession
+from utils.storage import Storage
+from utils.web_seed import WEB_SEED_CLAIM, WEB_SEED_CONNECTIONS, HTTPConnectionPool, WebSeedError, web_seed_main
+
+# Downloads v1, hybrid and v2-only multi-file torrents from a web seed served on loopback, and
+# checks every file on disk against the served one. Hybrid torrents list padding files in their v1
+# file list that the server does not have, v2-only torrents have no v1 file list at all, so both
+# only work when file URLs follow the v2 file tree. Reports the throughput of each layout.
+# The server also runs as one that ignores Range and answers 200 with the whole file, and as one
+# that is busy (503) at first: range requests are checked against each directly, then a download
+# has to finish through the 503s and stop using the server that ignores ranges.
+# Usage: python3 benchmarks/web_seed_loopback.py --size-mb 16 --piece-kb 64 --files 5
+
+NAME = "web seed"
+BUSY_RESPONSES = 2 # Requests answered with 503 before a busy server starts serving
+
+def make_files(size: int, num_files: int, rng: random.Random) -> list:
+    # Uneven sizes so files end mid-piece, one of them in a subfolder with a space in its name
+    cuts = sorted(rng.sample(range(1, size), num_files - 1))
+    lengths = [end - start for start, end in zip([0] + cuts, cuts + [size])]
+    return [(f"part {index}/file{index}.bin" if index % 2 else f"file{index}.bin", os.urandom(length))
+            for index, length in enumerate(lengths)]
+
+def v1_info(files: list, piece_length: int, pad: bool) -> dict:
+    # With pad, every file but the last is followed by a BEP 47 padding file up to the next piece boundary
+    entries = []
+    blob = bytearray()
+    for index, (path, data) in enumerate(files):
+        entries.append({b'length': len(data), b'path': [part.encode() for part in path.split('/')]})
+        blob += data
+        padding = (-len(blob)) % piece_length
+        if pad and padding and index < len(files) - 1:
+            entries.append({b'length': padding, b'path': [b'.pad', str(padding).encode()], b'attr': b'p'})
+            blob += bytes(padding)
+    pieces = b''.join(hashlib.sha1(blob[start:start + piece_length]).digest() for start in range(0, len(blob), piece_length))
+    return {b'name': NAME.encode(), b'piece length': piece_length, b'files': entries, b'pieces': pieces}
+
+def v2_info(files: list, piece_length: int):
+    # BEP 52 file tree and piece layers
+    tree = {}
+    piece_layers = {}
+    blocks_per_piece = piece_length // merkle.BLOCK_SIZE
+    for path, data in files:
+        leaves = merkle.block_hashes(data)
+        if len(data) <= piece_length:
+            root = merkle.root_of(leaves, merkle.next_power_of_two(len(leaves)))
+        else:
+            layer = [merkle.root_of(leaves[start:start + blocks_per_piece], blocks_per_piece)
+                     for start in range(0, len(leaves), blocks_per_piece)]
+            root = merkle.file_root(layer, blocks_per_piece, len(data))
+            piece_layers[root] = b''.join(layer)
+        node = tree
+        parts = path.split('/')
+        for part in parts[:-1]:
+            node = node.setdefault(part.encode(), {})
+        node[parts[-1].encode()] = {b'': {b'length': len(data), b'pieces root': root}}
+    return {b'name': NAME.encode(), b'piece length': piece_length, b'meta version': 2, b'file tree': tree}, piece_layers
+
+def make_torrent(layout: str, files: list, piece_length: int):
+    if layout == "v1":
+        return v1_info(files, piece_length, pad=False), None
+    info, piece_layers = v2_info(files, piece_length)
+    if layout == "hybrid":
+        hybrid = v1_info(files, piece_length, pad=True)
+        info[b'files'] = hybrid[b'files']
+        info[b'pieces'] = hybrid[b'pieces']
+    return info, piece_layers
+
+def new_stats() -> dict:
+    return {'requests': 0, 'not_found': 0, 'open': 0, 'connections': 0, 'busy': BUSY_RESPONSES}
+
+async def serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, files: dict, stats: dict, mode: str) -> None:
+    # Keep-alive HTTP/1.1 with single ranges, 404 for anything that is not one of the files.
+    # mode "full" ignores Range and always sends the whole file, "busy" answers 503 to the first requests
+    stats['open'] += 1
+    stats['connections'] += 1
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            path = unquote(request_line.split()[1].decode('latin-1'))
+            data = files.get(path)
+            stats['requests'] += 1
+            if data is None:
+                stats['not_found'] += 1
+                writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+            elif mode == "busy" and stats['busy'] > 0:
+                stats['busy'] -= 1
+                writer.write(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n\r\n")
+            elif mode == "full":
+                writer.write(f"HTTP/1.1 200 OK\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data)
+            else:
+                start, end = (int(value) for value in headers['range'].split('=')[1].split('-'))
+                body = data[start:end + 1]
+                writer.write(f"HTTP/1.1 206 Partial Content\r\nContent-Length: {len(body)}\r\n"
+                             f"Content-Range: bytes {start}-{start + len(body) - 1}/{len(data)}\r\n\r\n".encode() + body)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        stats['open'] -= 1
+        writer.close()
+
+async def stop_server(server, stats: dict) -> None:
+    # The client closed its connections, the handlers see EOF and finish before the loop goes away
+    while stats['open']:
+        await asyncio.sleep(0.01)
+    server.close()
+    await server.wait_closed()
+
+async def check_responses(data: bytes) -> list:
+    # A range request through the connection pool in every server mode: (mode, passed)
+    results = []
+    start, end = len(data) // 3, len(data) // 3 + 2**14
+    for mode in ("range", "full", "busy"):
+        stats = new_stats()
+        server = await asyncio.start_server(lambda r, w: serve(r, w, {"/file.bin": data}, stats, mode), "127.0.0.1", 0)
+        host = f"127.0.0.1:{server.sockets[0].getsockname()[1]}"
+        pool = HTTPConnectionPool()
+
+        if mode == "busy":
+            # Every 503 is an error, the connection stays open for the next try
+            errors = 0
+            for _ in range(BUSY_RESPONSES):
+                try:
+                    await pool.get_range(f"http://{host}/file.bin", start, end)
+                except WebSeedError:
+                    errors += 1
+            body = await pool.get_range(f"http://{host}/file.bin", start, end)
+            passed = errors == BUSY_RESPONSES and body == data[start:end] and stats['connections'] == 1
+        else:
+            body = await pool.get_range(f"http://{host}/file.bin", start, end)
+            # A 200 is cut off at the range end, so its connection cannot be reused
+            kept = sum(len(connections) for connections in pool.idle.values())
+            passed = body == data[start:end] and (host in pool.ignores_ranges) == (mode == "full") and kept == (mode != "full")
+        pool.close()
+        await stop_server(server, stats)
+        results.append((mode, passed))
+    return results
+
+async def download(info: dict, piece_layers, files: list, dir_path: str, mode: str):
+    served = {f"/{NAME}/{path}": data for path, data in files}
+    stats = new_stats()
+    server = await asyncio.start_server(lambda r, w: serve(r, w, served, stats, mode), "127.0.0.1", 0)
+    url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/"
+
+    details = TorrentDetails(info, dir_path, piece_layers=piece_layers)
+    resume_data = ResumeData(info_hash=details.info_hash.hex(), piece_length=details.piece_length,
+                             total_pieces=details.num_of_pieces, downloaded=0, file_sizes=details.file_sizes,
+                             mtime=0, verified_pieces=[False] * details.num_of_pieces, last_active="")
+    session = DownloadSession(details=details, resume_data=resume_data, storage=Storage(details),
+                              picker=PiecePicker(details, resume_data))
+
+    # The web seed logs every piece, that is not what is being measured
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        await web_seed_main([url], info, session, Logger())
+        elapsed = time.perf_counter() - started
+    session.storage.close()
+    await stop_server(server, stats)
+    return elapsed, details, resume_data.downloaded, stats
+
+def files_match(details: TorrentDetails, files: list) -> bool:
+    for file_index, (path, data) in enumerate(files):
+        if details.files.relative_paths[file_index] != path:
+            return False
+        with open(details.files.path(file_index), "rb") as f:
+            if f.read() != data:
+                return False
+    return True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=16)
+    parser.add_argument("--piece-kb", type=int, default=64)
+    parser.add_argument("--files", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    files = make_files(args.size_mb * 2**20, args.files, random.Random(args.seed))
+    print(f"{args.size_mb} MiB in {args.files} files, {args.piece_kb} KiB pieces")
+
+    failed = False
+    for mode, passed in asyncio.run(check_responses(files[0][1])):
+        print(f"get_range, {mode:>5} server: {'ok' if passed else 'FAILED'}")
+        failed = failed or not passed
+
+    for layout, mode in (("v1", "range"), ("hybrid", "range"), ("v2", "range"), ("v1", "busy"), ("v1", "full")):
+        info, piece_layers = make_torrent(layout, files, args.piece_kb * 2**10)
+        dir_path = tempfile.mkdtemp(prefix="web-seed-bench-") + '/'
+        elapsed, details, verified, stats = asyncio.run(download(info, piece_layers, files, dir_path, mode))
+        if mode == "full":
+            # A few pieces come through before the server is dropped, each request reads its file from the start
+            ok = 0 < verified < details.num_of_pieces and stats['requests'] <= WEB_SEED_CONNECTIONS * WEB_SEED_CLAIM * 2
+        else:
+            ok = verified == details.num_of_pieces and stats['not_found'] == 0 and files_match(details, files)
+        shutil.rmtree(dir_path, ignore_errors=True)
+        print(f"{layout:>7}, {mode:>5}: {verified * details.piece_length / elapsed / 2**20:8.1f} MiB/s, {verified} of {details.num_of_pieces} pieces, "
+              f"{stats['requests']} requests, {stats['not_found']} not found{'' if ok else '  FAILED'}")
+        failed = failed or not ok
+    sys.exit(1 if failed else 0)
@@ -1,46 +1,130 @@
-import bencodepy
 import sys
+import argparse
 import threading
 import queue
-import hashlib
 import os
 import time
 import asyncio
+import signal
 
 from utils.get_peers import *
 from utils.download import *
 from utils.json_data import ResumeData
-from utils.details import TorrentDetails
+from utils.details import TorrentDetails, METADATA_CACHE_FILENAME
+from utils.metainfo import Metainfo
 from utils.logger import Logger
+from utils.peer_cache import PeerCache
+from utils.block_journal import BlockJournal
+from utils.web_seed import get_web_seed_urls, run_web_seeds
+from utils.lsd import LocalServiceDiscovery, PeerIntake
+from utils.choker import Choker, UPLOAD_SLOTS
+from utils.upload import run_upload_server
+from utils.piece_picker import PiecePicker, FILE_PRIORITIES, PRIORITY_NORMAL
+from utils.multiproc import DownloadProcesses, SharedPieceState, SharedPiecePicker
+from utils.profiler import Profiler, PROFILE_WINDOW, LAG_THRESHOLD, stage
+from utils.replay import SessionRecorder
+from utils.content_index import ContentIndex, LocalReuse, INDEX_PATH
+from utils.session import DownloadSession
+from utils.storage import Storage, WRITE_CACHE_SIZE, FSYNC_POLICIES
 
 
 RESUME_FILENAME = "resume.json"
+PEER_CACHE_FILENAME = "peers.json"
+JOURNAL_FILENAME = "blocks.json"
 
 peers_list = queue.Queue()
 
 logger = Logger()
 logger.display_stats_loop()
 
-def populate_peers(torrent_info: dict, info_hash: bytes, logger: Logger):
+def populate_peers(torrent_info: dict, info_hash: bytes, logger: Logger, profiler: Profiler = None):
     while True:
-        get_peers_list(torrent_info, info_hash, peers_list, logger)
+        with stage(profiler, "tracker"):
+            get_peers_list(torrent_info, info_hash, peers_list, logger)
         [Interval, Seeder, Leecher] = get_interval_data()
         print(f"Interval:{Interval}, Seeders:{Seeder}, Leechers:{Leecher}")
         time.sleep(Interval+1)
 
-def connect_to_peers(details: TorrentDetails, resume_data: ResumeData, logger: Logger):
+def connect_to_peers(session: DownloadSession, logger: Logger):
     while True:
         peers = peers_list.get()
-        asyncio.run(main(peers, details, resume_data, logger))
+        asyncio.run(main(peers, session, logger))
+
+def handle_sigterm(signum, frame):
+    # Deploys and pod evictions stop us with SIGTERM, save progress the same way as Ctrl + C
+    raise KeyboardInterrupt
+
+def parse_args():
+    parser = argparse.ArgumentParser(usage="python3 master.py <path_to_torrent_file> <path_to_download> [options]")
+    parser.add_argument("torrent_file", help="path to the .torrent file")
+    parser.add_argument("download_dir", help="destination folder for the downloaded content")
+    parser.add_argument("--write-through", action="store_true",
+                        help="stream blocks to disk as they arrive and hash pieces incrementally (lower memory for large pieces)")
+    parser.add_argument("--sequential", action="store_true",
+                        help="download pieces in order ahead of a read cursor so files can be consumed while downloading")
+    parser.add_argument("--transport", choices=["tcp", "utp", "auto"], default="tcp",
+                        help="peer transport: TCP, uTP (BEP 29, LEDBAT congestion control) or TCP with uTP fallback")
+    parser.add_argument("--max-half-open", type=int, default=MAX_HALF_OPEN,
+                        help="maximum number of peer connects and handshakes in flight at once")
+    parser.add_argument("--min-peers", type=int, default=MIN_PEERS,
+                        help="lower bound on peers downloaded from at once")
+    parser.add_argument("--max-peers", type=int, default=MAX_PEERS,
+                        help="upper bound on peers downloaded from at once, the download pool grows while extra peers raise throughput")
+    parser.add_argument("--preallocate", action="store_true",
+                        help="allocate every file at full size when it is created (fallocate) instead of leaving it sparse")
+    parser.add_argument("--write-cache", type=int, default=WRITE_CACHE_SIZE // 2**20, metavar="MIB",
+                        help="MiB of written pieces held back and merged into larger sequential writes, 0 writes straight away")
+    parser.add_argument("--fsync", choices=FSYNC_POLICIES, default="checkpoint",
+                        help="fsync the downloaded files before progress is saved (checkpoint) or leave it to the OS (never)")
+    parser.add_argument("--processes", type=int, default=1, metavar="N",
+                        help="run the peer connections in N worker processes that share piece state through shared memory")
+    parser.add_argument("--no-web-seeds", action="store_true",
+                        help="ignore the HTTP mirrors listed in the torrent's url-list")
+    parser.add_argument("--no-upload", action="store_true",
+                        help="do not accept incoming peers or upload to them")
+    parser.add_argument("--upload-slots", type=int, default=UPLOAD_SLOTS, metavar="N",
+                        help="peers unchoked for their rate at once, plus one optimistic unchoke")
+    parser.add_argument("--no-lsd", action="store_true",
+                        help="do not announce the torrent on the local network or look for LAN peers (BEP 14)")
+    parser.add_argument("--lsd-interface", default="0.0.0.0", metavar="ADDRESS",
+                        help="address of the network interface used for Local Service Discovery")
+    parser.add_argument("--content-index", default=INDEX_PATH, metavar="FILE",
+                        help="index of files from completed torrents, checked for data this torrent can reuse")
+    parser.add_argument("--no-reuse", action="store_true",
+                        help="do not look for this torrent's data in files of earlier torrents")
+    parser.add_argument("--file-priority", action="append", default=[], metavar="INDEX=LEVEL",
+                        help="priority of one file of a multi-file torrent (skip, low, normal or high), may be repeated")
+    parser.add_argument("--list-files", action="store_true",
+                        help="print the files of the torrent with their indices and exit")
+    parser.add_argument("--record", metavar="FILE",
+                        help="record the raw bytes of every peer connection to FILE, for replay with benchmarks/replay_session.py")
+    parser.add_argument("--profile", metavar="DIR",
+                        help="write a CPU profile, event loop stalls, memory snapshots and stage timings to DIR")
+    parser.add_argument("--profile-window", type=float, default=PROFILE_WINDOW, metavar="SECONDS",
+                        help="how long the CPU profile records after the download starts")
+    parser.add_argument("--lag-threshold", type=float, default=LAG_THRESHOLD, metavar="SECONDS",
+                        help="report every event loop stall longer than this, with the stack that caused it")
+    return parser.parse_args()
+
+def get_file_priorities(args, details: TorrentDetails, resume_data: ResumeData) -> list:
+    priorities = list(resume_data.file_priorities) or [PRIORITY_NORMAL] * len(details.files)
+
+    for entry in args.file_priority:
+        try:
+            index, level = entry.split("=")
+            priorities[int(index)] = FILE_PRIORITIES[level.strip().lower()]
+        except (ValueError, KeyError, IndexError):
+            print(f"Error : invalid --file-priority {entry!r}, expected INDEX=skip|low|normal|high")
+            sys.exit(1)
+
+    return priorities
 
 if __name__=="__main__":
-  
-    if len(sys.argv) != 3:
-        print("Usage: python3 master.py <path_to_torrent_file> <path_to_download>")
-        sys.exit(1)
 
-    file_name=sys.argv[1]
-    save_loc=sys.argv[2]
+    args = parse_args()
+
+    file_name=args.torrent_file
+    save_loc=args.download_dir
 
     try:
         with open(file_name,"rb") as torrent_file:
@@ -53,33 +137,41 @@ if __name__=="__main__":
         sys.exit(1)
 
     try:
-        torrent_info = bencodepy.decode(file_content)
-    except Exception as E:
-        print(f"Error : {E}")
-        sys.exit(1)
-
-    try:
-        info_dict = torrent_info[b'info']
-
-        info_bencoded = bencodepy.encode(info_dict)
-        info_hash = hashlib.sha1(info_bencoded).digest()       
+        # Only the info dictionary's raw bytes are hashed, everything else is decoded when first used
+        metainfo = Metainfo(file_content)
+        torrent_info = metainfo.torrent
+        info_dict = metainfo.info
+        info_hash = metainfo.info_hash
     except Exception as E:
         print(f"Error : {E}")
         sys.exit(1)
 
     name = info_dict[b'name'].decode('utf-8')
     
-    if b'files' in info_dict:
+    if is_multi_file(info_dict):
             dir_path=os.path.join(save_loc, name)
     else:
         root, ext = os.path.splitext(name)
         dir_path=os.path.join(save_loc, root)
 
     dir_path=dir_path+'/'
-    details = TorrentDetails(info_dict, dir_path)
+    # The metadata cache is written into the download folder, so it has to exist first.
+    # Listing the files creates nothing, but still reads the cache of an earlier run
+    if not args.list_files:
+        try:
+            os.makedirs(dir_path, exist_ok=True)
+        except Exception as E:
+            print(f"Error : {type(E).__name__} {E}")
+            sys.exit(1)
+    cache_path = os.path.join(dir_path, METADATA_CACHE_FILENAME) if os.path.isdir(dir_path) else None
+    details = TorrentDetails(info_dict, dir_path, cache_path, metainfo.piece_layers, info_hash)
+
+    if args.list_files:
+        for index, (length, relative_path) in enumerate(zip(details.files.lengths, details.files.relative_paths)):
+            print(f"{index}\t{length}\t{relative_path}")
+        sys.exit(0)
 
     try:
-        os.makedirs(dir_path, exist_ok=True)
         json_file_path=os.path.join(dir_path, RESUME_FILENAME)
 
         if RESUME_FILENAME in os.listdir(dir_path):
@@ -102,17 +194,142 @@ if __name__=="__main__":
     # print(info_dict)
     # print(details.files)
 
+    # Dial the best peers from the previous run right away, trackers are contacted in parallel
+    peer_cache = PeerCache.load(os.path.join(dir_path, PEER_CACHE_FILENAME))
+    cached_peers = peer_cache.best()
+    if cached_peers:
+        print(f"Warm start with {len(cached_peers)} cached peers")
+        peers_list.put(cached_peers)
+
+    multi_process = args.processes > 1
+    if multi_process and args.write_through:
+        print("Note: the block journal is not shared between processes, partial pieces are refetched after a restart")
+    if multi_process and args.write_cache:
+        print("Note: download processes write pieces straight to disk, the write cache only holds web seed pieces")
+
+    # With several processes, claims and verified pieces live in shared memory so every process sees them
+    shared_state = SharedPieceState(resume_data.verified_pieces, workers=args.processes) if multi_process else None
+    if shared_state:
+        picker = SharedPiecePicker(details, resume_data, shared_state, streaming=args.sequential)
+    else:
+        picker = PiecePicker(details, resume_data, streaming=args.sequential)
+
+    session = DownloadSession(
+        details=details,
+        resume_data=resume_data,
+        storage=Storage(details, args.preallocate, args.write_cache * 2**20, fsync=args.fsync),
+        picker=picker,
+        peer_cache=peer_cache,
+        content_index=ContentIndex.load(args.content_index),
+        # Partial pieces can only survive a restart if their blocks are already on disk
+        journal=BlockJournal.load(os.path.join(dir_path, JOURNAL_FILENAME), BLOCK_SIZE) if args.write_through and not multi_process else None,
+        write_through=args.write_through,
+        transport=args.transport,
+        max_half_open=args.max_half_open,
+        min_peers=args.min_peers,
+        max_peers=args.max_peers,
+        max_claim=MAX_CLAIM_PER_PEER,
+        claim_size=MAX_CLAIM_PER_PEER,
+        profiler=Profiler(args.profile, args.profile_window, args.lag_threshold) if args.profile else None,
+        # Worker processes would all append to the same file, so recording needs the single process pipeline
+        recorder=SessionRecorder(args.record) if args.record and not multi_process else None,
+        # Pieces verified by worker processes only reach this picker on exit, the parent would have nothing to serve
+        choker=Choker(args.upload_slots, picker.is_complete) if not args.no_upload and not multi_process else None,
+        # Worker processes run their own pipelines, LAN peers reach them through peers_list like tracker peers
+        peer_intake=PeerIntake(peers_list) if not args.no_lsd and not multi_process else None,
+    )
+    if args.record and multi_process:
+        print("Note: --record is ignored with --processes")
+    if not args.no_upload and multi_process:
+        print("Note: uploading is off with --processes")
+    session.set_file_priorities(get_file_priorities(args, details, resume_data))
+
+    # Repacks and new dataset versions often contain files we already have, those pieces never go to the network
+    if not args.no_reuse and not picker.is_complete():
+        reused = LocalReuse(details, picker, session.storage, session.content_index, logger).run()
+        if reused:
+            session.storage.checkpoint()
+            resume_data.to_json(json_file_path)
+            print(f"Reused {reused} pieces from local files")
+
+    processes = None
+    if multi_process:
+        processes = DownloadProcesses(args.processes, info_dict, metainfo.piece_layers, dir_path, resume_data, shared_state, {
+            'streaming': args.sequential,
+            'write_through': args.write_through,
+            'transport': args.transport,
+            'max_half_open': args.max_half_open,
+            'min_peers': args.min_peers,
+            'max_peers': args.max_peers,
+            'max_claim': MAX_CLAIM_PER_PEER,
+            'preallocate': args.preallocate,
+            'fsync': args.fsync,
+        })
+        processes.start()
+
+    if session.profiler:
+        if multi_process:
+            print("Note: only the parent process is profiled, the worker processes are not")
+        session.profiler.start()
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
     try:
-        tracker_thread = threading.Thread(target=populate_peers, args=(torrent_info, info_hash, logger))
-        connector_thread = threading.Thread(target=connect_to_peers, args=(details, resume_data, logger))
+        tracker_thread = threading.Thread(target=populate_peers, args=(torrent_info, info_hash, logger, session.profiler))
+        if processes:
+            # Peers are sharded over the worker processes, each runs its own copy of the pipeline
+            connector_thread = threading.Thread(target=processes.dispatch_loop, args=(peers_list, logger), daemon=True)
+        else:
+            connector_thread = threading.Thread(target=connect_to_peers, args=(session, logger))
 
         tracker_thread.start()
         connector_thread.start()
 
+        # HTTP mirrors (BEP 19) share the piece picker with the peers, so they never fetch the same piece
+        web_seed_urls = [] if args.no_web_seeds else get_web_seed_urls(torrent_info)
+        if web_seed_urls:
+            print(f"Using {len(web_seed_urls)} web seeds")
+            web_seed_thread = threading.Thread(target=run_web_seeds, args=(web_seed_urls, info_dict, session, logger), daemon=True)
+            web_seed_thread.start()
+
+        # Peers that connect to us on the port we announce are served by the choker's rules
+        if session.choker:
+            threading.Thread(target=run_upload_server, args=(session, session.choker, logger, PORT_NUMBER), daemon=True).start()
+
+        # Local Service Discovery (BEP 14): neighbours on the LAN with the same torrent are dialled before WAN peers
+        if not args.no_lsd:
+            try:
+                lsd = LocalServiceDiscovery(info_hash, PORT_NUMBER, session.peer_intake or PeerIntake(peers_list), logger,
+                                            interface=args.lsd_interface)
+                threading.Thread(target=lsd.run, daemon=True).start()
+            except OSError as e:
+                print(f"Local Service Discovery unavailable: {e}")
+
         tracker_thread.join()
         connector_thread.join()
         
     except KeyboardInterrupt:
         print("Exiting. Saving resume data.")
-        resume_data.to_json(json_file_path)
-        sys.exit(0)
\ No newline at end of file
+        if processes:
+            processes.stop()
+            shared_state.sync_to(resume_data)
+        # Progress is copied before the checkpoint: other threads keep verifying pieces, and those may
+        # still be in the write cache when the copy is written
+        progress = resume_data.snapshot()
+        journal_state = session.journal.snapshot() if session.journal else None
+        session.storage.checkpoint()
+        progress.to_json(json_file_path)
+        if session.journal:
+            session.journal.save(journal_state)
+        peer_cache.save()
+        if session.content_index.add_torrent(details, picker):
+            session.content_index.save()
+        if session.recorder:
+            session.recorder.close()
+        sys.exit(0)
+    finally:
+        # Also when the download ends on its own: the CPU profile window may still be open, and the
+        # last stage times and memory snapshot are only written here
+        if session.profiler:
+            session.profiler.stop()
+            print(f"Profile written to {session.profiler.out_dir}")
\ No newline at end of file
@@ -0,0 +1,59 @@
+import json
+import os
+import threading
+from typing import Dict, Set
+
+class BlockJournal:
+    # Remembers which blocks of unfinished pieces are already written to disk, so a restart only asks for the rest
+    def __init__(self, path: str, block_size: int):
+        self.path = path
+        self.block_size = block_size
+        self.pieces: Dict[int, Set[int]] = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str, block_size: int) -> "BlockJournal":
+        journal = cls(path, block_size)
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    data = json.load(f)
+                # Block numbers are meaningless if the block size changed between runs
+                if data.get('block_size') == block_size:
+                    journal.pieces = {int(piece_index): set(blocks) for piece_index, blocks in data['pieces'].items()}
+            except (OSError, ValueError, KeyError):
+                journal.pieces = {}
+        return journal
+
+    def snapshot(self) -> dict:
+        # Taken before a storage checkpoint, so nothing saved refers to blocks still in the write cache
+        with self.lock:
+            return {
+                'block_size': self.block_size,
+                'pieces': {str(piece_index): sorted(blocks) for piece_index, blocks in self.pieces.items() if blocks},
+            }
+
+    def save(self, data: dict = None) -> None:
+        if data is None:
+            data = self.snapshot()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def mark_block(self, piece_index: int, begin: int) -> None:
+        with self.lock:
+            self.pieces.setdefault(piece_index, set()).add(begin // self.block_size)
+
+    def blocks_on_disk(self, piece_index: int) -> Set[int]:
+        # Returns the begin offsets of the blocks already written for this piece
+        with self.lock:
+            return {block_num * self.block_size for block_num in self.pieces.get(piece_index, ())}
+
+    def clear(self, piece_index: int) -> None:
+        with self.lock:
+            self.pieces.pop(piece_index, None)
+
+    def partial_pieces(self) -> Set[int]:
+        with self.lock:
+            return {piece_index for piece_index, blocks in self.pieces.items() if blocks}
@@ -1,85 +1,115 @@
+import os
 import struct
-import random
 import socket
 import asyncio
+from typing import List, Tuple
 import utils.details as details
 from utils.details import TorrentDetails, ParsedMessage
 import utils.handlers as handler
 
-def build_bitTorrent_handshake(details: TorrentDetails):
+# Formats are compiled once, struct.pack with a format string goes through the format cache on every call
+LENGTH = struct.Struct(">I")
+HEADER = struct.Struct(">Ib")
+HANDSHAKE = struct.Struct(">B19s8s20s20s")
+HAVE = struct.Struct(">IbI")
+REQUEST = struct.Struct(">IbIII")
+REQUEST_BODY = struct.Struct(">bIII") # A request as recv_message_body returns it, without the length prefix
+PIECE_HEADER = struct.Struct(">IbII")
+PORT = struct.Struct(">IbH")
+HASH_REQUEST = struct.Struct(">Ib32sIIII")
+
+# One peer id for the whole run, trackers and peers see the same client on every connection
+PEER_ID = b'-TR4003-' + os.urandom(12)
+
+# Messages without a payload never change
+KEEP_ALIVE = LENGTH.pack(0)
+CHOKE = HEADER.pack(1, 0)
+UNCHOKE = HEADER.pack(1, 1)
+INTERESTED = HEADER.pack(1, 2)
+NOT_INTERESTED = HEADER.pack(1, 3)
+BIT_CHARS = bytes.maketrans(b'\x00\x01', b'01')
+
+def build_bitTorrent_handshake(details: TorrentDetails, peer_id: bytes = PEER_ID):
     pstrlen = 19
     pstr = b"BitTorrent protocol"
-    peer_id = b'-TR4003-' + bytes(random.getrandbits(8) for _ in range(12))
-    handshake_req = struct.pack(">B19s8x20s20s", pstrlen, pstr, details.info_hash, peer_id)
+    # BEP 52: the 0x10 bit of the last reserved byte says we speak v2 (hash request / hashes)
+    reserved = b'\x00' * 7 + (b'\x10' if details.meta_version == 2 else b'\x00')
+    handshake_req = HANDSHAKE.pack(pstrlen, pstr, reserved, details.info_hash, peer_id)
     return handshake_req
 
 def build_keep_alive():
     # length, msg_id
-    keep_alive_req = struct.pack(">I", 0)
-    return keep_alive_req
+    return KEEP_ALIVE
 
 def build_choke():
     # length, msg_id
-    chock_resp = struct.pack(">Ib", 1, 0)
-    return chock_resp
+    return CHOKE
 
 def build_unchoke():
     # length, msg_id
-    unchock_resp = struct.pack(">Ib", 1, 1)
-    return unchock_resp
+    return UNCHOKE
 
 def build_interested():
     # length, msg_id
-    interested_req = struct.pack(">Ib", 1, 2)
-    return interested_req
+    return INTERESTED
 
 def build_uninterested():
     # length, msg_id
-    uninterested_req = struct.pack(">Ib", 1, 2)
-    return uninterested_req
+    return NOT_INTERESTED
 
 def build_have(piece_index: int):
     # length, msg_id, piece_index
-    have_resp = struct.pack(">IbI", 5, 4, piece_index)
+    have_resp = HAVE.pack(5, 4, piece_index)
     return have_resp
 
 def build_bitfeild(bitfeild: list, details: TorrentDetails):
     bitfield_length = (details.num_of_pieces+7)//8
 
-    bitfield_bytes = bytearray(bitfield_length)
-    
-    for i, has_piece in enumerate(bitfeild):
-        if has_piece:
-            # Set the bit at the appropriate position (MSB first in each byte)
-            bitfield_bytes[i // 8] |= (1 << (7 - (i % 8)))
-    
-    total_length = 1 + len(bitfield_bytes)  # 1 byte for msg_id plus payload length
-    bitfield_resp = struct.pack(">Ib", total_length, 5) + bytes(bitfield_bytes)
-    return bitfield_resp
+    # One '0' or '1' per piece, MSB first, turned into bytes by int() instead of setting bits one at a time
+    bits = bytes(map(bool, bitfeild)).translate(BIT_CHARS).ljust(bitfield_length * 8, b'0')
+    bitfield_bytes = int(bits, 2).to_bytes(bitfield_length, "big") if bitfield_length else b''
+
+    return HEADER.pack(1 + bitfield_length, 5) + bitfield_bytes
 
 def build_request(piece_index: int, begin: int, length: int):
     # request message: length, msg_id, followed by piece_index, begin, and request length (all 4 bytes each)
-    request_req = struct.pack(">IbIII", 13, 6, piece_index, begin, length)
+    request_req = REQUEST.pack(13, 6, piece_index, begin, length)
     return request_req
 
+def build_requests(piece_index: int, blocks: List[Tuple[int, int]]) -> bytearray:
+    # Request messages for (begin, length) blocks of one piece, encoded back to back into one buffer
+    # so a whole pipeline refill is a single write
+    buffer = bytearray(REQUEST.size * len(blocks))
+    pack_into = REQUEST.pack_into
+    position = 0
+    for begin, length in blocks:
+        pack_into(buffer, position, 13, 6, piece_index, begin, length)
+        position += REQUEST.size
+    return buffer
+
+def build_piece_header(piece_index: int, begin: int, block_length: int):
+    # Sent together with the block through writelines, so the block is not copied into a new message
+    return PIECE_HEADER.pack(9 + block_length, 7, piece_index, begin)
+
 def build_piece(piece_index: int, begin: int, block: bytes):
     # piece message: length, msg_id, followed bypiece index + begin + block
-    block_length = len(block)
-    total_length = 9 + block_length
-    header = struct.pack(">IbII", total_length, 7, piece_index, begin)
-    piece_resp = header + block
-    return piece_resp
+    return build_piece_header(piece_index, begin, len(block)) + block
 
 def build_cancel(piece_index: int, begin: int, length: int):
     # cancel message: length, msg_id, followed by piece_index, begin, and length
-    cancel_req = struct.pack(">IbIII", 13, 8, piece_index, begin, length)
+    cancel_req = REQUEST.pack(13, 8, piece_index, begin, length)
     return cancel_req
 
 def build_port(port: int):
     # port message: length=3, msg_id=9, followed by the 2-byte port number
-    port_resp = struct.pack(">IbH", 3, 9, port)
+    port_resp = PORT.pack(3, 9, port)
     return port_resp
 
+def build_hash_request(pieces_root: bytes, base_layer: int, index: int, length: int, proof_layers: int):
+    # hash request (BEP 52): length, msg_id, pieces root, base layer, index, length and proof layers
+    hash_req = HASH_REQUEST.pack(49, 21, pieces_root, base_layer, index, length, proof_layers)
+    return hash_req
+
 def recvall(sock: socket.socket, n: int)->bytes:
     data = b''
 
@@ -98,12 +128,21 @@ async def recv_whole_message(reader: asyncio.StreamReader, isHandshake: bool) ->
     else:
         # Read the 4-byte length prefix
         len_bytes = await reader.readexactly(4)
-        length = struct.unpack(">I", len_bytes)[0]
+        length = LENGTH.unpack(len_bytes)[0]
         # Now read the payload of the specified length
         payload = await reader.readexactly(length)
         message = len_bytes + payload
     return message
 
+async def recv_message_body(reader: asyncio.StreamReader) -> bytes:
+    # The message without its length prefix, body[0] is the message id. Keep-alives give b''.
+    # Used on the block path, where building a ParsedMessage and slicing copies per block adds up
+    len_bytes = await reader.readexactly(4)
+    length = LENGTH.unpack(len_bytes)[0]
+    if length == 0:
+        return b''
+    return await reader.readexactly(length)
+
 def parse_message(packet: bytes)->ParsedMessage:
     length = None if len(packet) < 4 else struct.unpack(">I", packet[:4])[0]
     id = None if len(packet) < 5 else struct.unpack(">b", packet[4:5])[0]
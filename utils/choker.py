@@ -0,0 +1,142 @@
+import asyncio
+import random
+import threading
+import time
+from typing import Callable, Dict, List
+
+import utils.build_messages as messages
+from utils.logger import Logger
+
+RECHOKE_INTERVAL = 10 # Seconds between two choking decisions
+OPTIMISTIC_INTERVAL = 30 # Seconds the optimistic unchoke stays with one peer
+UPLOAD_SLOTS = 4 # Peers unchoked for their rate, the optimistic unchoke comes on top
+RATE_SMOOTHING = 0.5 # Weight of the newest interval in the rate averages
+
+class ChokerPeer:
+    __slots__ = ('key', 'ip', 'send', 'interested', 'choked', 'optimistic', 'uploaded', 'upload_rate', 'connected_at')
+
+    def __init__(self, key: str, ip: str, send: Callable[[bytes], None], now: float):
+        self.key = key
+        self.ip = ip
+        self.send = send
+        self.interested = False
+        self.choked = True
+        self.optimistic = False
+        self.uploaded = 0
+        self.upload_rate = 0.0
+        self.connected_at = now
+
+class Choker:
+    # Tit-for-tat (BEP 3): every RECHOKE_INTERVAL the interested peers that gave us the most data lately are
+    # unchoked, and one more is unchoked optimistically for OPTIMISTIC_INTERVAL so new peers get a chance to
+    # prove themselves. Once we seed there is nothing to reciprocate, peers that take data fastest are kept.
+    # Download rates come from the download pipeline by IP, since peers that connect to us use another port
+    def __init__(self, slots: int = UPLOAD_SLOTS, is_seeding: Callable[[], bool] = lambda: False,
+                 clock: Callable[[], float] = time.monotonic):
+        self.slots = slots
+        self.is_seeding = is_seeding
+        self.clock = clock
+        self.peers: Dict[str, ChokerPeer] = {}
+        # Bytes received from each IP since the last rechoke, and the smoothed rate
+        self.downloaded: Dict[str, int] = {}
+        self.download_rates: Dict[str, float] = {}
+        self.optimistic_key = None
+        self.optimistic_since = None
+        self.last_rechoke = clock()
+        self.lock = threading.Lock()
+
+    def add(self, key: str, ip: str, send: Callable[[bytes], None]) -> ChokerPeer:
+        with self.lock:
+            peer = self.peers[key] = ChokerPeer(key, ip, send, self.clock())
+            return peer
+
+    def remove(self, key: str) -> None:
+        with self.lock:
+            self.peers.pop(key, None)
+            if self.optimistic_key == key:
+                self.optimistic_key = None
+
+    def set_interested(self, key: str, interested: bool) -> None:
+        with self.lock:
+            peer = self.peers.get(key)
+            if peer:
+                peer.interested = interested
+
+    def record_download(self, ip: str, num_bytes: int) -> None:
+        with self.lock:
+            self.downloaded[ip] = self.downloaded.get(ip, 0) + num_bytes
+
+    def record_upload(self, key: str, num_bytes: int) -> None:
+        with self.lock:
+            peer = self.peers.get(key)
+            if peer:
+                peer.uploaded += num_bytes
+
+    def _update_rates(self, elapsed: float) -> None:
+        for ip in set(self.download_rates) | set(self.downloaded):
+            rate = self.downloaded.pop(ip, 0) / elapsed
+            self.download_rates[ip] = RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * self.download_rates.get(ip, 0.0)
+        for peer in self.peers.values():
+            rate = peer.uploaded / elapsed
+            peer.upload_rate = RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * peer.upload_rate
+            peer.uploaded = 0
+
+    def _rotate_optimistic(self, now: float, regular: List[ChokerPeer]) -> None:
+        current = self.peers.get(self.optimistic_key)
+        if current and current.interested and current not in regular and now - self.optimistic_since < OPTIMISTIC_INTERVAL:
+            return
+        candidates = [peer for peer in self.peers.values() if peer.interested and peer not in regular]
+        if not candidates:
+            self.optimistic_key = None
+            return
+        # Newly connected peers are three times as likely to be picked, they have no rate to show yet
+        weights = [3 if now - peer.connected_at < OPTIMISTIC_INTERVAL * 3 else 1 for peer in candidates]
+        self.optimistic_key = random.choices(candidates, weights)[0].key
+        self.optimistic_since = now
+
+    def rechoke(self) -> dict:
+        with self.lock:
+            now = self.clock()
+            self._update_rates(max(now - self.last_rechoke, 1e-6))
+            self.last_rechoke = now
+            seeding = self.is_seeding()
+
+            if seeding:
+                rank = lambda peer: peer.upload_rate
+            else:
+                rank = lambda peer: self.download_rates.get(peer.ip, 0.0)
+            interested = [peer for peer in self.peers.values() if peer.interested]
+            regular = sorted(interested, key=rank, reverse=True)[:self.slots]
+            self._rotate_optimistic(now, regular)
+
+            changes = []
+            for peer in self.peers.values():
+                peer.optimistic = peer.key == self.optimistic_key
+                choke = peer not in regular and not peer.optimistic
+                if choke != peer.choked:
+                    peer.choked = choke
+                    changes.append((peer, messages.build_choke() if choke else messages.build_unchoke()))
+
+        for peer, message in changes:
+            try:
+                peer.send(message)
+            except Exception:
+                # A peer that went away is removed by its own connection handler
+                pass
+        return self.metrics()
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return {
+                'unchoked': sum(not peer.choked for peer in self.peers.values()),
+                'optimistic': self.optimistic_key,
+                'interested': sum(peer.interested for peer in self.peers.values()),
+                'upload_peers': len(self.peers),
+                'seeding': self.is_seeding(),
+                'upload_rate': sum(peer.upload_rate for peer in self.peers.values()),
+            }
+
+    async def run(self, logger: Logger) -> None:
+        while True:
+            await asyncio.sleep(RECHOKE_INTERVAL)
+            logger.set_metrics({'choker': self.rechoke()})
@@ -0,0 +1,256 @@
+import json
+import os
+import tempfile
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+from utils.details import TorrentDetails
+from utils.logger import Logger
+from utils.piece_picker import PiecePicker
+from utils.pieces import BufferedPiece
+from utils.storage import Storage
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+INDEX_PATH = os.path.join(os.path.expanduser("~"), ".torrent-client", "content-index.json")
+MAX_INDEXED_FILES = 100000 # Oldest entries are dropped past this many files
+FICLONE = 0x40049409 # Linux ioctl that shares the source's extents with the target (Btrfs, XFS)
+
+def pieces_in_file(details: TorrentDetails, file_index: int) -> List[int]:
+    # Pieces lying wholly inside the file, the only ones a same-sized file elsewhere can be checked against alone
+    start = details.files.offsets[file_index]
+    end = details.files.end(file_index)
+    return [piece_index for piece_index in details.pieces_of_file(file_index)
+            if piece_index * details.piece_length >= start and piece_index * details.piece_length + details.piece_size(piece_index) <= end]
+
+class ContentIndex:
+    # Files of completed torrents, shared by all torrents: size and mtime to notice when a file changed,
+    # and the hashes of the torrent's pieces that lie inside the file, by their offset in the file.
+    # A new torrent with a file of the same size is checked against it before any peer is contacted
+    def __init__(self, path: str, max_files: int = MAX_INDEXED_FILES):
+        self.path = path
+        self.max_files = max_files
+        self.entries: Dict[str, dict] = {}
+        # Paths added or refreshed since the last save, the only entries this process has news about
+        self.changed: Set[str] = set()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str) -> "ContentIndex":
+        index = cls(path)
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    index.entries = json.load(f)
+            except (OSError, ValueError):
+                # A corrupt index only costs us the reuse
+                index.entries = {}
+        return index
+
+    def save(self) -> None:
+        # Other clients may have saved since we loaded: under an exclusive lock the index is read again
+        # and our changes are merged into it, then it is replaced through a temp file of our own
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        with open(self.path + ".lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            entries = ContentIndex.load(self.path).entries
+            with self.lock:
+                for path in self.changed:
+                    if path in self.entries:
+                        entries.pop(path, None)
+                        entries[path] = self.entries[path]
+                self.changed.clear()
+                while len(entries) > self.max_files:
+                    entries.pop(next(iter(entries)))
+                self.entries = entries
+                data = json.dumps(entries)
+
+            with tempfile.NamedTemporaryFile("w", dir=directory, prefix=".content-index-", delete=False) as f:
+                tmp_path = f.name
+                try:
+                    f.write(data)
+                except BaseException:
+                    os.unlink(tmp_path)
+                    raise
+            os.replace(tmp_path, self.path)
+
+    def add_torrent(self, details: TorrentDetails, picker: PiecePicker) -> int:
+        # Indexes every file all pieces of which are verified, returns how many entries were added or refreshed
+        added = 0
+        for file_index in range(len(details.files)):
+            length = details.files.lengths[file_index]
+            if length == 0 or not all(picker.is_verified(piece_index) for piece_index in details.pieces_of_file(file_index)):
+                continue
+            path = os.path.realpath(details.files.path(file_index))
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if stat.st_size != length:
+                continue
+
+            with self.lock:
+                entry = self.entries.get(path)
+                if entry and entry['size'] == length and entry['mtime'] == stat.st_mtime_ns:
+                    continue
+                pieces = pieces_in_file(details, file_index)
+                self.entries.pop(path, None)
+                self.entries[path] = {
+                    'size': length,
+                    'mtime': stat.st_mtime_ns,
+                    'piece_length': details.piece_length,
+                    'meta_version': details.meta_version,
+                    'first_offset': pieces[0] * details.piece_length - details.files.offsets[file_index] if pieces else 0,
+                    'hashes': [bytes(details.hash_of_pieces[piece_index]).hex() for piece_index in pieces],
+                }
+                self.changed.add(path)
+                added += 1
+
+        with self.lock:
+            while len(self.entries) > self.max_files:
+                self.entries.pop(next(iter(self.entries)))
+        return added
+
+    def candidates(self, length: int, exclude: str) -> List[Tuple[str, dict]]:
+        # Indexed files of this size that are still as they were indexed
+        found = []
+        with self.lock:
+            entries = [(path, entry) for path, entry in self.entries.items() if entry['size'] == length and path != exclude]
+        for path, entry in entries:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if stat.st_size == length and stat.st_mtime_ns == entry['mtime']:
+                found.append((path, entry))
+        return found
+
+def known_matches(entry: dict, details: TorrentDetails, file_index: int, pieces: List[int]) -> List[int]:
+    # Pieces the index already says the candidate holds, found without reading it
+    if entry['piece_length'] != details.piece_length or entry['meta_version'] != details.meta_version:
+        return []
+    matches = []
+    for piece_index in pieces:
+        position = piece_index * details.piece_length - details.files.offsets[file_index] - entry['first_offset']
+        slot = position // details.piece_length
+        if position % details.piece_length == 0 and 0 <= slot < len(entry['hashes']) \
+                and entry['hashes'][slot] == bytes(details.hash_of_pieces[piece_index]).hex():
+            matches.append(piece_index)
+    return matches
+
+def clone_file(source: str, target: str) -> bool:
+    # Reflink: the target shares the source's blocks until either is written, no data is copied
+    if fcntl is None:
+        return False
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        with open(source, "rb") as src, open(target, "r+b" if os.path.exists(target) else "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        return False
+
+class LocalReuse:
+    # Fills a new torrent from files indexed earlier. Every piece is hashed before it counts, the index only
+    # says where to look. Files of a v1 torrent that share a piece are combined when each has a source
+    def __init__(self, details: TorrentDetails, picker: PiecePicker, storage: Storage, index: ContentIndex, logger: Logger):
+        self.details = details
+        self.picker = picker
+        self.storage = storage
+        self.index = index
+        self.logger = logger
+        self.sources: Dict[int, str] = {}
+        self.handles = {}
+
+    def _read_piece(self, piece_index: int) -> Optional[BufferedPiece]:
+        details = self.details
+        piece_start = piece_index * details.piece_length
+        piece_size = details.piece_size(piece_index)
+        piece = BufferedPiece(piece_index, piece_size, self.storage)
+        for file_index in details.files_of_piece(piece_index):
+            start = max(piece_start, details.files.offsets[file_index])
+            end = min(piece_start + piece_size, details.files.end(file_index))
+            if start >= end:
+                continue
+            source = self.sources.get(file_index)
+            if source is None:
+                return None
+            handle = self.handles.get(source)
+            if handle is None:
+                handle = self.handles[source] = os.open(source, os.O_RDONLY)
+            piece.add_block(start - piece_start, os.pread(handle, end - start, start - details.files.offsets[file_index]))
+        return piece
+
+    def _check(self, piece_index: int) -> Optional[BufferedPiece]:
+        piece = self._read_piece(piece_index)
+        if piece is None or not piece.verify(self.details.hash_of_pieces[piece_index]):
+            return None
+        return piece
+
+    def _missing(self, piece_index: int) -> bool:
+        return self.picker.is_wanted(piece_index) and not self.picker.is_verified(piece_index)
+
+    def pick_sources(self) -> None:
+        # One piece decides which same-sized file is the right one, candidates the index vouches for go first
+        details = self.details
+        for file_index in range(len(details.files)):
+            length = details.files.lengths[file_index]
+            if length == 0 or not any(self._missing(piece_index) for piece_index in details.pieces_of_file(file_index)):
+                continue
+            target = os.path.realpath(details.files.path(file_index))
+            pieces = pieces_in_file(details, file_index)
+            ranked = sorted(((known_matches(entry, details, file_index, pieces), path)
+                             for path, entry in self.index.candidates(length, target)), key=lambda item: -len(item[0]))
+
+            for matches, path in ranked:
+                self.sources[file_index] = path
+                probe = next(iter(matches), pieces[0] if pieces else None)
+                # A file inside a single piece can only be checked together with its neighbours, later
+                if probe is None or self._check(probe) is not None:
+                    break
+                del self.sources[file_index]
+
+    def run(self) -> int:
+        details = self.details
+        self.pick_sources()
+        if not self.sources:
+            return 0
+
+        # Files that do not exist yet can be reflinked whole, once every piece of them checks out
+        clonable = {file_index for file_index in self.sources if not os.path.exists(details.files.path(file_index))
+                    and all(self._missing(piece_index) for piece_index in details.pieces_of_file(file_index))}
+        deferred: Dict[int, List[int]] = {}
+        reused = 0
+
+        for piece_index in range(details.num_of_pieces):
+            if not self._missing(piece_index):
+                continue
+            piece = self._check(piece_index)
+            if piece is None:
+                clonable.difference_update(details.files_of_piece(piece_index))
+                continue
+            files = details.files_of_piece(piece_index)
+            if len(files) == 1 and files[0] in clonable:
+                deferred.setdefault(files[0], []).append(piece_index)
+                continue
+            piece.commit()
+            reused += self.picker.mark_verified(piece_index)
+
+        for file_index, pieces in deferred.items():
+            if file_index in clonable and clone_file(self.sources[file_index], details.files.path(file_index)):
+                self.logger.info(f"Reflinked {details.files.relative_paths[file_index]} from {self.sources[file_index]}")
+            else:
+                # No reflink support here, the pieces are copied
+                for piece_index in pieces:
+                    self._read_piece(piece_index).commit()
+            reused += sum(self.picker.mark_verified(piece_index) for piece_index in pieces)
+
+        for handle in self.handles.values():
+            os.close(handle)
+        self.handles.clear()
+        return reused
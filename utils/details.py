@@ -1,25 +1,88 @@
 from utils.get_details import *
+from utils.metainfo import FileTable
+import utils.merkle as merkle
+
+METADATA_CACHE_FILENAME = "metadata.cache"
 
 class TorrentDetails:
-    def __init__(self, info_dict: dict, root: str):
-        self.piece_length = get_piece_length(info_dict)
-        self.total_length = get_total_length(info_dict)
-        self.num_of_pieces = get_total_pieces(self.total_length, self.piece_length)
-        self.file_sizes = get_file_sizes(info_dict)
-        self.hash_of_pieces = get_hash_list(info_dict, self.num_of_pieces)
-        self.info_hash = get_info_hash(info_dict)
-        self.files = get_file_details(info_dict, root)
+    def __init__(self, info_dict: dict, root: str, cache_path: str = None, piece_layers=None, info_hash: bytes = None):
+        # Callers holding a Metainfo pass its info hash, the info dict is not encoded and hashed a second time
+        self.info_hash = info_hash or get_info_hash(info_dict)
+        self.root = root
+        # v2 and hybrid torrents (BEP 52) are verified with SHA-256 Merkle trees, per 16 KiB block
+        self.meta_version = get_meta_version(info_dict)
+
+        # The file table and piece to file map are reloaded from disk if this torrent was opened before
+        cached = load_metadata_cache(cache_path, self.info_hash) if cache_path else None
+        if cached:
+            self.piece_length = cached['piece_length']
+            self.total_length = cached['total_length']
+            self.num_of_pieces = cached['num_of_pieces']
+            self.files = FileTable(root, cached['paths'], cached['lengths'], cached['offsets'])
+            self.file_sizes = cached['lengths']
+            self.piece_first_file, self.piece_last_file = cached['piece_first_file'], cached['piece_last_file']
+        else:
+            self.piece_length = get_piece_length(info_dict)
+            self.total_length = get_total_length(info_dict)
+            self.num_of_pieces = get_total_pieces(self.total_length, self.piece_length)
+            self.file_sizes = get_file_sizes(info_dict)
+            self.files = get_file_details(info_dict, root)
+            self.piece_first_file, self.piece_last_file = get_piece_file_map(self.files, self.piece_length, self.num_of_pieces)
+            if cache_path:
+                save_metadata_cache(cache_path, self)
+
+        if self.meta_version == 2:
+            self.pieces_roots = [pieces_root for _, _, pieces_root in get_v2_files(info_dict)]
+            self.hash_of_pieces = get_v2_hash_list(info_dict, piece_layers, self.files, self.piece_length, self.num_of_pieces)
+            # Leaf hashes received from peers, kept per piece until it is verified
+            self.leaf_hashes = {}
+        else:
+            self.hash_of_pieces = get_hash_list(info_dict, self.num_of_pieces)
+
+    def piece_size(self, piece_index: int) -> int:
+        # The last piece is usually shorter than piece_length, in v2 so is the last piece of every file
+        if self.meta_version == 2:
+            return min(self.piece_length, self.files.end(self.piece_first_file[piece_index]) - piece_index * self.piece_length)
+        return min(self.piece_length, self.total_length - piece_index * self.piece_length)
+
+    def piece_leaves(self, piece_index: int):
+        # v2: (pieces root of the file, index of the piece's first leaf in the file tree, leaves under the piece hash).
+        # A file of at most one piece is a smaller tree of its own
+        file_index = self.piece_first_file[piece_index]
+        file_length = self.files.lengths[file_index]
+        first_piece = self.files.offsets[file_index] // self.piece_length
+        if file_length <= self.piece_length:
+            return self.pieces_roots[file_index], 0, merkle.next_power_of_two(merkle.num_blocks(file_length))
+        blocks_per_piece = self.piece_length // merkle.BLOCK_SIZE
+        return self.pieces_roots[file_index], (piece_index - first_piece) * blocks_per_piece, blocks_per_piece
+
+    def files_of_piece(self, piece_index: int) -> range:
+        return range(self.piece_first_file[piece_index], self.piece_last_file[piece_index] + 1)
+
+    def pieces_of_file(self, file_index: int) -> range:
+        if self.files.lengths[file_index] == 0:
+            return range(0)
+        first_piece = self.files.offsets[file_index] // self.piece_length
+        last_piece = (self.files.end(file_index) - 1) // self.piece_length
+        return range(first_piece, last_piece + 1)
 
 class ParsedMessage:
+    __slots__ = ('size', 'id', 'payload')
+
     def __init__(self, size, id, payload):
         self.size = size
         self.id = id
         self.payload = payload
 
 class Peer:
+    __slots__ = ('ip', 'port', 'latency', 'supports_v2')
+
     def __init__(self, ip: str, port: int):
         self.ip = ip
         self.port = port
+        self.latency = None
+        # Set from the handshake, only v2 peers are sent hash requests
+        self.supports_v2 = False
 
     def __str__(self):
         return f"{self.ip}:{self.port}"
\ No newline at end of file
@@ -1,4 +1,4 @@
-import asyncio 
+import asyncio
 import os
 from typing import List
 import struct
@@ -8,40 +8,127 @@ import utils.verify_messages as verify
 from utils.details import *
 from utils.json_data import ResumeData
 from utils.logger import Logger, CONNECTION_LOGGER, HANDLE_LOGGER
+from utils.lsd import is_lan_address
+from utils.pieces import BufferedPiece, MerklePiece, StreamingPiece
+from utils.pool_controller import PoolController, WorkerPool, MIN_CONN_TASKS, MIN_HANDLE_TASKS, MAX_HANDLE_TASKS
+from utils.profiler import stage
+from utils.session import DownloadSession
 import utils.handlers as handler
+import utils.utp as utp
+import heapq
+import itertools
+import time
 
 
 TIMEOUT=5 # Maximum Timeout for a particular ongoing connection
-NUM_CONN_TASKS = 4 # Number of threads alloted for handling TCP Connections and BitTorrent Handshake
-NUM_HANDLE_TASKS = 2 #Number of threads alloted for handling pieces messages, bit field messages, choke/unchoke messages
-NUM_DOWNLOAD_TASKS = 8 #Number of threads alloted for downloading the pieces (1 Thread/peer)
+MAX_HALF_OPEN = 32 # Default upper bound on connects/handshakes kept in flight at once
+NUM_HANDLE_TASKS = 2 #Initial number of tasks handling bit field and choke/unchoke messages, resized by the pool controller
+NUM_DOWNLOAD_TASKS = 8 #Initial number of download tasks (1 task/peer), resized between min_peers and max_peers
+MIN_PEERS = 2 # Default lower bound on peers downloaded from at once
+MAX_PEERS = 40 # Default upper bound on peers downloaded from at once
 MAX_CLAIM_PER_PEER = 30 #Maximum number of pieces a peer can claim to give/download from
 BLOCK_SIZE = 2**14
+PIPELINE_DEPTH = 5 # Number of block requests kept outstanding per peer
+MAX_BAD_BLOCKS = 3 # Corrupt blocks a peer may send for one piece before it is dropped
+UNKNOWN_LATENCY = 0.5 # Assumed connect latency (sec) for peers we have never reached
+
+_queue_order = itertools.count()
+
+class BadBlockError(Exception):
+    # A peer kept sending blocks that fail their Merkle leaf hash
+    def __init__(self, count: int):
+        super().__init__(f"{count} blocks failed their hash")
+        self.count = count
+
+class BoundedPriorityQueue(asyncio.PriorityQueue):
+    # Priority queue of (latency, order, item) that can hand back its worst entry when it grows past a bound
+    def __init__(self, bound: int = 0):
+        super().__init__()
+        self.bound = bound
+
+    def offer(self, item):
+        self.put_nowait(item)
+        if self.bound <= 0 or self.qsize() <= self.bound:
+            return None
+
+        worst = max(self._queue)
+        self._queue.remove(worst)
+        heapq.heapify(self._queue)
+        # The evicted entry will never be fetched, so balance the put for join()
+        self.task_done()
+        return worst
+
+async def close_quietly(writer) -> None:
+    # A peer that already reset the connection must not take the worker task down with it
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except Exception:
+        pass
 
-async def connection_worker(peer_queue: asyncio.Queue, handshake_queue: asyncio.Queue, torrent_details: TorrentDetails, logger: CONNECTION_LOGGER):
-    while True:
+async def open_peer_connection(peer: Peer, session: DownloadSession):
+    if session.replay:
+        return await session.replay.open_connection(peer.ip, peer.port)
+
+    reader, writer = await connect_transport(peer, session.transport)
+    if session.recorder:
+        session.recorder.tap(peer, reader, writer)
+    return reader, writer
+
+async def connect_transport(peer: Peer, transport: str):
+    # "auto" tries TCP first and falls back to uTP for peers that only speak uTP
+    if transport == "utp":
+        return await asyncio.wait_for(utp.open_utp_connection(peer.ip, peer.port), timeout=TIMEOUT)
+
+    try:
+        return await asyncio.wait_for(asyncio.open_connection(peer.ip, peer.port), timeout=TIMEOUT)
+    except Exception:
+        if transport != "auto":
+            raise
+
+    return await asyncio.wait_for(utp.open_utp_connection(peer.ip, peer.port), timeout=TIMEOUT)
+
+async def connection_worker(peer_queue: asyncio.Queue, handshake_queue: asyncio.Queue, session: DownloadSession, logger: CONNECTION_LOGGER, pool: WorkerPool):
+    torrent_details = session.details
+    peer_cache = session.peer_cache
+
+    while not pool.should_retire():
         try:
-            peer = await peer_queue.get()
+            _, _, peer = await pool.get(peer_queue)
         except asyncio.QueueEmpty:
             break
 
         try:
             logger.tcp_connection_attempt(peer.ip, peer.port)
-            # asyncio.open_connection returns (reader, writer)
-            reader, writer = await asyncio.wait_for(asyncio.open_connection(peer.ip, peer.port), timeout=TIMEOUT)
+            # Both transports return (reader, writer)
+            connect_started = time.monotonic()
+            with stage(session.profiler, "connect"):
+                reader, writer = await open_peer_connection(peer, session)
+            peer.latency = time.monotonic() - connect_started
+            if peer_cache:
+                peer_cache.record_latency(peer.ip, peer.port, peer.latency)
         except Exception as e:
             logger.tcp_connection_error(peer.ip, peer.port, f"{type(e).__name__}: {e}")
+            if peer_cache:
+                peer_cache.record_handshake(peer.ip, peer.port, False)
             peer_queue.task_done()
             continue
 
         try:
             logger.handshake_attempt(peer.ip, peer.port)
+            # Handshake and interested go out in one write, saving a round trip before the peer unchokes us
             handshake_req = messages.build_bitTorrent_handshake(torrent_details)
-            writer.write(handshake_req)
-            await writer.drain()
-            handshake_resp = await asyncio.wait_for(messages.recv_whole_message(reader, isHandshake=True), timeout=TIMEOUT)
+            with stage(session.profiler, "handshake"):
+                writer.write(handshake_req + messages.build_interested())
+                await writer.drain()
+                handshake_resp = await asyncio.wait_for(messages.recv_whole_message(reader, isHandshake=True), timeout=TIMEOUT)
+
+            is_valid = verify.is_handshake(handshake_resp, torrent_details.info_hash)
+            if peer_cache:
+                peer_cache.record_handshake(peer.ip, peer.port, is_valid)
 
-            if verify.is_handshake(handshake_resp, torrent_details.info_hash):
+            if is_valid:
+                peer.supports_v2 = bool(handshake_resp[27] & 0x10)
                 logger.handshake_success(peer.ip, peer.port)
             else:
                 logger.handshake_failure(peer.ip, peer.port)
@@ -52,13 +139,14 @@ async def connection_worker(peer_queue: asyncio.Queue, handshake_queue: asyncio.
 
         except Exception as e:
             logger.handshake_error(peer.ip, peer.port, str(e))
-            writer.close()
-            await writer.wait_closed()
+            if peer_cache:
+                peer_cache.record_handshake(peer.ip, peer.port, False)
+            await close_quietly(writer)
             peer_queue.task_done()
             continue
 
-        # Enqueue the successful connection for the next stage.
-        await handshake_queue.put((peer, reader, writer))
+        # Enqueue the successful connection for the next stage, fastest peers first.
+        await handshake_queue.put((peer.latency, next(_queue_order), (peer, reader, writer)))
         peer_queue.task_done()
 
 
@@ -73,29 +161,32 @@ async def wait_for_unchoke(reader: asyncio.StreamReader, peer: Peer, logger: HAN
         parsed = messages.parse_message(msg)
 
         if verify.is_unchoke(parsed):
-            logger.unchoke_received(peer.ip, peer.port)  
+            logger.unchoke_received(peer.ip, peer.port)
             return True
         elif verify.is_choke(parsed):
-            logger.choke_received(peer.ip, peer.port)  
+            logger.choke_received(peer.ip, peer.port)
         else:
-            logger.irrelevant_message(peer.ip, peer.port) 
+            logger.irrelevant_message(peer.ip, peer.port)
 
 
-async def handle_worker(handshake_queue: asyncio.Queue, download_queue: asyncio.Queue, resume_data: ResumeData, logger: HANDLE_LOGGER):
-    while True:
+async def handle_worker(handshake_queue: asyncio.Queue, download_queue: asyncio.Queue, session: DownloadSession, logger: HANDLE_LOGGER, pool: WorkerPool):
+    resume_data = session.resume_data
+
+    while not pool.should_retire():
         try:
-            peer, reader, writer = await handshake_queue.get()
+            _, _, (peer, reader, writer) = await pool.get(handshake_queue)
         except asyncio.TimeoutError:
             break  # No new peers in a while, exit
 
         try:
             # Wait for a bitfield or have message from the peer.
-            msg = await asyncio.wait_for(messages.recv_whole_message(reader, isHandshake=False), timeout=TIMEOUT)
+            with stage(session.profiler, "bitfield"):
+                msg = await asyncio.wait_for(messages.recv_whole_message(reader, isHandshake=False), timeout=TIMEOUT)
             parsed_message = messages.parse_message(msg)
 
             if verify.is_have(parsed_message):
-                logger.have_message_received(peer.ip, peer.port) 
-                
+                logger.have_message_received(peer.ip, peer.port)
+
                 try:
                     pieces_to_request = handler.have_handler(parsed_message, resume_data.verified_pieces)
 
@@ -104,21 +195,22 @@ async def handle_worker(handshake_queue: asyncio.Queue, download_queue: asyncio.
                         handshake_queue.task_done()
                         continue
 
-                    unchoked = await wait_for_unchoke(reader, peer, logger)
-                    
+                    with stage(session.profiler, "unchoke"):
+                        unchoked = await wait_for_unchoke(reader, peer, logger)
+
                     if unchoked:
-                        await download_queue.put((peer, reader, writer, pieces_to_request))
+                        await queue_for_download(download_queue, peer, reader, writer, pieces_to_request, session, logger)
                     else:
                         print(f"Did not receive unchoke from {peer}. Closing connection.")
                         writer.close()
                         await writer.wait_closed()
 
                 except Exception as e:
-                    logger.failed_handling_have(peer.ip, peer.port, str(e)) 
+                    logger.failed_handling_have(peer.ip, peer.port, str(e))
 
             elif verify.is_bitfeild(parsed_message):
                 logger.bitfield_message_received(peer.ip, peer.port)
-                
+
                 try:
                     pieces_to_request = handler.bitfield_handler(parsed_message, resume_data.verified_pieces)
 
@@ -127,45 +219,111 @@ async def handle_worker(handshake_queue: asyncio.Queue, download_queue: asyncio.
                         handshake_queue.task_done()
                         continue
 
-                    writer.write(messages.build_interested())
-                    await writer.drain()
-                    await download_queue.put((peer, reader, writer, pieces_to_request))
+                    await queue_for_download(download_queue, peer, reader, writer, pieces_to_request, session, logger)
 
                 except Exception as e:
-                    logger.failed_handling_bitfield(peer.ip, peer.port, str(e)) 
+                    logger.failed_handling_bitfield(peer.ip, peer.port, str(e))
             else:
                 print(f"Received unexpected message from {peer}")
 
         except Exception as e:
-            logger.error_handling_message(peer.ip, peer.port, str(e)) 
+            logger.error_handling_message(peer.ip, peer.port, str(e))
             writer.close()
             await writer.wait_closed()
 
         handshake_queue.task_done()
 
-async def download_worker(download_queue: asyncio.Queue, torrent_details: TorrentDetails, resume_data: ResumeData, logger: Logger):
+async def queue_for_download(download_queue: BoundedPriorityQueue, peer: Peer, reader, writer,
+                             pieces_to_request: List[int], session: DownloadSession, logger: HANDLE_LOGGER):
+    # Once every download slot is busy only as many lowest-latency connections as there are slots are kept waiting
+    evicted = download_queue.offer((peer.latency, next(_queue_order), (peer, reader, writer, pieces_to_request)))
+    if evicted is not None:
+        slow_peer, _, slow_writer, _ = evicted[2]
+        print(f"Dropping slower connection to {slow_peer} ({slow_peer.latency * 1000:.0f} ms)")
+        await close_quietly(slow_writer)
 
-    while True:
+async def download_worker(download_queue: asyncio.Queue, session: DownloadSession, logger: Logger, pool: WorkerPool):
+
+    while not pool.should_retire():
         try:
-            peer, reader, writer, pieces_to_request = await download_queue.get()
+            _, _, (peer, reader, writer, pieces_to_request) = await pool.get(download_queue)
         except asyncio.TimeoutError:
             break  # Exit if no new items to download
 
         try:
             logger.info(f"Started download from {peer.ip}:{peer.port}")
-            await download_from_peer(peer, reader, writer, pieces_to_request, torrent_details, resume_data, logger)
+            await download_from_peer(peer, reader, writer, pieces_to_request, session, logger)
 
         except Exception as e:
             logger.error(f"Download failed from {peer.ip}:{peer.port} — {e}")
 
         download_queue.task_done()
 
+async def fetch_piece(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, piece_index: int, piece_size: int, piece):
+    # Keeps up to PIPELINE_DEPTH block requests in flight and hands every block to the piece as it arrives.
+    # Blocks the piece already has on disk from an earlier run are not requested again.
+    # Blocks the piece rejects (v2 leaf hash mismatch) are requested again. Returns (bytes received, bad blocks)
+    present = piece.present_blocks()
+    blocks = [(begin, min(BLOCK_SIZE, piece_size - begin)) for begin in range(0, piece_size, BLOCK_SIZE) if begin not in present]
+    next_block = 0
+    pending = set()
+    received = 0
+    bad_blocks = 0
+
+    writer.writelines(piece.hash_requests())
+
+    while next_block < len(blocks) or pending:
+        # The pipeline is refilled with one buffer of requests, one write and one drain
+        batch = blocks[next_block:next_block + PIPELINE_DEPTH - len(pending)]
+        if batch:
+            writer.write(messages.build_requests(piece_index, batch))
+            pending.update(begin for begin, _ in batch)
+            next_block += len(batch)
+            await writer.drain()
+
+        body = await messages.recv_message_body(reader)
+
+        if verify.is_piece_body(body):
+            r_index, r_begin = struct.unpack_from(">II", body, 1)
+
+            if r_index == piece_index and r_begin in pending:
+                pending.discard(r_begin)
+                # The block stays a view into the received message, it is not copied again
+                r_block = memoryview(body)[9:]
+                received += len(r_block)
+                if not piece.add_block(r_begin, r_block):
+                    bad_blocks += 1
+                    blocks.append((r_begin, len(r_block)))
+
+        elif verify.is_unchoke_body(body):
+            # Peers drop requests while they choke us (BEP 3), whatever is still pending is asked for again
+            writer.write(messages.build_requests(piece_index, [(r_begin, min(BLOCK_SIZE, piece_size - r_begin)) for r_begin in pending]))
+
+        elif verify.is_hashes_body(body) or verify.is_hash_reject_body(body):
+            # Blocks that arrived before their leaf hashes are checked now
+            for r_begin in piece.add_hashes(body):
+                bad_blocks += 1
+                blocks.append((r_begin, min(BLOCK_SIZE, piece_size - r_begin)))
+
+        if bad_blocks > MAX_BAD_BLOCKS:
+            raise BadBlockError(bad_blocks)
+
+    return received, bad_blocks
+
+def report_bad_blocks(peer: Peer, piece_index: int, count: int, session: DownloadSession, logger: Logger) -> None:
+    logger.warn(f"[{peer.ip}:{peer.port}] Sent {count} corrupt block(s) of piece {piece_index}")
+    if session.peer_cache:
+        session.peer_cache.record_bad_blocks(peer.ip, peer.port, count)
+
 async def download_from_peer(peer: Peer, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
-                             pieces_available_from_peer: List[int], torrent_details: TorrentDetails,
-                             resume_data: ResumeData, logger: Logger):
+                             pieces_available_from_peer: List[int], session: DownloadSession, logger: Logger):
 
-    piece_length = torrent_details.piece_length
-    total_pieces = torrent_details.num_of_pieces
+    torrent_details = session.details
+    picker = session.picker
+    peer_cache = session.peer_cache
+    claimed = []
+    bytes_received = 0
+    started_at = time.monotonic()
 
     try:
         logger.info(f"[{peer.ip}:{peer.port}] Starting download")
@@ -173,14 +331,7 @@ async def download_from_peer(peer: Peer, reader: asyncio.StreamReader, writer: a
         while True:
             logger.info(f"[{peer.ip}:{peer.port}] Claiming a batch to download")
 
-            claimed = []
-            async with resume_data.lock:
-                for piece_index in pieces_available_from_peer:
-                    if len(claimed) >= MAX_CLAIM_PER_PEER:
-                        break
-                    if not resume_data.verified_pieces[piece_index] and piece_index not in resume_data.claimed_pieces:
-                        resume_data.claimed_pieces.add(piece_index)
-                        claimed.append(piece_index)
+            claimed = picker.claim(pieces_available_from_peer, session.claim_size)
 
             if not claimed:
                 logger.warn(f"[{peer.ip}] No more claimable pieces. Closing connection.")
@@ -188,133 +339,152 @@ async def download_from_peer(peer: Peer, reader: asyncio.StreamReader, writer: a
 
             logger.info(f"[{peer.ip}:{peer.port}] Batch Claimed → {claimed}")
 
-            for piece_index in claimed:
-                
-                num_blocks = (piece_length + BLOCK_SIZE - 1) // BLOCK_SIZE
-                piece_data = bytearray(piece_length)
-
-                for block_num in range(num_blocks):
-                
-                    begin = block_num * BLOCK_SIZE
-                    block_length = min(BLOCK_SIZE, piece_length - begin)
-                    request_msg = messages.build_request(piece_index, begin, block_length)
-                    writer.write(request_msg)
-                    await writer.drain()
-
-                    while True:
-                        try:
-                            msg = await messages.recv_whole_message(reader, isHandshake=False)
-                            parsed = messages.parse_message(msg)
-
-                            if verify.is_piece(parsed):
-                                r_index, r_begin = struct.unpack(">II", parsed.payload[:8])
-                                r_block = parsed.payload[8:]
-
-                                if r_index == piece_index and r_begin == begin:
-                                    piece_data[begin:begin + len(r_block)] = r_block
-                                    break
-                                
-                        except Exception as e:
-                            logger.error(f"[{peer.ip}] Error during block read: {e}")
-                            raise e
+            while claimed:
+                piece_index = claimed[0]
+
+                if picker.is_verified(piece_index):
+                    # Another peer won the race for an urgent piece
+                    picker.release(claimed.pop(0))
+                    continue
+
+                piece_size = torrent_details.piece_size(piece_index)
+                # Pieces fetched from several peers at once stay in memory so a bad copy never touches the disk.
+                # v2 blocks are verified one by one, only good ones are written in either mode
+                if torrent_details.meta_version == 2:
+                    piece = MerklePiece(piece_index, piece_size, session.storage, picker, request_hashes=peer.supports_v2)
+                elif session.write_through and not picker.is_duplicate(piece_index):
+                    piece = StreamingPiece(piece_index, piece_size, session.storage, picker, session.journal)
+                else:
+                    piece = BufferedPiece(piece_index, piece_size, session.storage, session.journal)
+
+                try:
+                    with stage(session.profiler, "fetch"):
+                        received, bad_blocks = await fetch_piece(reader, writer, piece_index, piece_size, piece)
+                    bytes_received += received
+                    session.bytes_received += received
+                    if session.choker:
+                        session.choker.record_download(peer.ip, received)
+                    if bad_blocks:
+                        report_bad_blocks(peer, piece_index, bad_blocks, session, logger)
+                except BadBlockError as e:
+                    report_bad_blocks(peer, piece_index, e.count, session, logger)
+                    raise e
+                except Exception as e:
+                    logger.error(f"[{peer.ip}] Error during block read: {e}")
+                    raise e
 
                 # Hash verification
-                if not handler.verify_piece_hash(piece_data, torrent_details.hash_of_pieces[piece_index]):
+                with stage(session.profiler, "verify"):
+                    valid = piece.verify(torrent_details.hash_of_pieces[piece_index])
+                if not valid:
                     logger.warn(f"[{peer.ip}] Invalid hash for piece {piece_index}. Discarding...")
-                    async with resume_data.lock:
-                        resume_data.claimed_pieces.discard(piece_index)
+                    piece.rollback()
+                    picker.release(claimed.pop(0))
                     continue
 
-                save_piece_to_disk(piece_index, piece_data, torrent_details)
-                logger.success(f"[{peer.ip}] Piece {piece_index} downloaded and verified ✅")
-
-                async with resume_data.lock:
-                    resume_data.verified_pieces[piece_index] = True
-                    resume_data.downloaded += 1
-                    resume_data.claimed_pieces.discard(piece_index)
+                if not picker.is_verified(piece_index):
+                    with stage(session.profiler, "commit"):
+                        piece.commit()
+                    if picker.mark_verified(piece_index):
+                        logger.success(f"[{peer.ip}] Piece {piece_index} downloaded and verified ✅")
+                picker.release(claimed.pop(0))
 
-                logger.update_stats(resume_data.downloaded, torrent_details.num_of_pieces, peer.ip)
+                logger.update_stats(session.resume_data.downloaded, torrent_details.num_of_pieces, peer.ip)
 
     except Exception as e:
         logger.error(f"[{peer.ip}] Peer download error: {e}")
-        async with resume_data.lock:
-            for piece_index in claimed:
-                resume_data.claimed_pieces.discard(piece_index)
+        for piece_index in claimed:
+            picker.release(piece_index)
 
     finally:
+        if peer_cache:
+            peer_cache.record_throughput(peer.ip, peer.port, bytes_received, time.monotonic() - started_at)
         writer.close()
         await writer.wait_closed()
 
-def save_piece_to_disk(piece_index: int, piece_data: bytes, torrent_details: TorrentDetails):
-    
-    # Global offset within the entire torrent data for this piece.
-    global_offset = piece_index * torrent_details.piece_length
-    piece_size = len(piece_data)
-    piece_end = global_offset + piece_size
-
-    # Iterate over each file to see if the piece overlaps.
-    for file_entry in torrent_details.files:
-        file_path = file_entry['path']
-        file_offset = file_entry['offset']
-        file_length = file_entry['length']
-        file_end = file_offset + file_length
-
-        # Check if there is an intersection between [global_offset, piece_end) and [file_offset, file_end)
-        overlap_start = max(global_offset, file_offset)
-        overlap_end = min(piece_end, file_end)
-
-        if overlap_start < overlap_end:
-            # There is an overlapping region. Calculating the corresponding part in the piece data.
-            piece_data_start = overlap_start - global_offset
-            piece_data_end = overlap_end - global_offset
-            data_to_write = piece_data[piece_data_start:piece_data_end]
-
-            # Determine the offset within the file where the data should go.
-            file_write_offset = overlap_start - file_offset
-
-            # Ensure the directory exists.
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            
-            #Make the file
-            if not os.path.exists(file_path):
-                with open(file_path, 'wb') as f:
-                    f.truncate(file_length)
-
-            # Open the file in binary read/write mode.
-            with open(file_path, 'r+b') as f:
-                f.seek(file_write_offset)
-                f.write(data_to_write)
-    
-async def main(peers: list, details: TorrentDetails, resume_data: ResumeData, logger: Logger):
-    # Create async queues for pipeline stages
-    peer_queue = asyncio.Queue()
-    handshake_queue = asyncio.Queue()
-    download_queue = asyncio.Queue()
+async def main(peers: list, session: DownloadSession, logger: Logger):
+    try:
+        if session.profiler:
+            with session.profiler.watch_loop():
+                await run_pipeline(peers, session, logger)
+        else:
+            await run_pipeline(peers, session, logger)
+    finally:
+        # Every batch runs on a new loop, the uTP socket of this one goes with it
+        utp.close_endpoint()
 
-    # Populate the peer_queue
+async def run_pipeline(peers: list, session: DownloadSession, logger: Logger):
+    # Create async queues for pipeline stages
+    peer_queue = asyncio.PriorityQueue()
+    handshake_queue = asyncio.PriorityQueue()
+    download_queue = BoundedPriorityQueue(NUM_DOWNLOAD_TASKS)
+
+    # Populate the peer_queue, LAN peers first, then peers that answered quickly before
+    peers = [Peer(peer[0],peer[1]) for peer in dict.fromkeys(map(tuple, peers))]
+    if session.peer_cache:
+        peers.sort(key=lambda peer: session.peer_cache.expected_latency(peer.ip, peer.port, UNKNOWN_LATENCY))
     for peer in peers:
-        await peer_queue.put(Peer(peer[0],peer[1]))
+        await peer_queue.put((not is_lan_address(peer.ip), next(_queue_order), peer))
 
-    # Launch connection tasks.
+    # Launch connection tasks, one per allowed half-open connection.
     tcp_bit_logger = CONNECTION_LOGGER()
-    conn_tasks = [asyncio.create_task(connection_worker(peer_queue, handshake_queue, details, tcp_bit_logger))
-                  for _ in range(NUM_CONN_TASKS)]
+    conn_pool = WorkerPool(lambda pool: connection_worker(peer_queue, handshake_queue, session, tcp_bit_logger, pool),
+                           MIN_CONN_TASKS, session.max_half_open)
+    conn_pool.resize(len(peers))
     # Launch handling tasks.
     handle_logger = HANDLE_LOGGER()
-    handle_tasks = [asyncio.create_task(handle_worker(handshake_queue, download_queue, resume_data, handle_logger))
-                    for _ in range(NUM_HANDLE_TASKS)]
+    handle_pool = WorkerPool(lambda pool: handle_worker(handshake_queue, download_queue, session, handle_logger, pool),
+                             MIN_HANDLE_TASKS, MAX_HANDLE_TASKS)
+    handle_pool.resize(NUM_HANDLE_TASKS)
     # Launch download tasks.
-    download_tasks = [asyncio.create_task(download_worker(download_queue, details, resume_data, logger))
-                      for _ in range(NUM_DOWNLOAD_TASKS)]
+    download_pool = WorkerPool(lambda pool: download_worker(download_queue, session, logger, pool),
+                               session.min_peers, session.max_peers)
+    download_queue.bound = download_pool.resize(NUM_DOWNLOAD_TASKS)
+
+    # Resize the three stages while they run
+    controller = PoolController(session, logger, peer_queue, handshake_queue, download_queue,
+                                conn_pool, handle_pool, download_pool)
+    controller.size_claims()
+    controller_task = asyncio.create_task(controller.run())
+
+    # LAN peers found while this batch runs are dialled ahead of the WAN peers still queued
+    def add_peers(new_peers: list) -> None:
+        for peer in new_peers:
+            peer_queue.put_nowait((not is_lan_address(peer[0]), next(_queue_order), Peer(peer[0], peer[1])))
+    if session.peer_intake:
+        session.peer_intake.open(asyncio.get_running_loop(), add_peers)
 
-    # Wait until all peers have been processed by the connection stage.
-    await peer_queue.join()
-    # Wait until all handshake tasks have processed their peers.
-    await handshake_queue.join()
-    # Wait until downloads are complete.
-    await download_queue.join()
+    try:
+        while True:
+            # Wait until all peers have been processed by the connection stage.
+            await peer_queue.join()
+            # Wait until all handshake tasks have processed their peers.
+            await handshake_queue.join()
+            # Wait until downloads are complete.
+            await download_queue.join()
+            if session.peer_intake:
+                session.peer_intake.close()
+            # Peers handed over just before the close are already scheduled, they get this batch's workers too
+            await asyncio.sleep(0)
+            if peer_queue.empty():
+                break
+    finally:
+        if session.peer_intake:
+            session.peer_intake.close()
 
     # Cancel remaining tasks if any
-    for task in conn_tasks + handle_tasks + download_tasks:
-        task.cancel()
+    controller_task.cancel()
+    for pool in (conn_pool, handle_pool, download_pool):
+        pool.cancel_all()
+
+    # Blocks written after the snapshot may still be in the write cache, they are not saved as on disk
+    journal_state = session.journal.snapshot() if session.journal else None
+    session.storage.checkpoint()
+    if session.journal:
+        session.journal.save(journal_state)
+    if session.peer_cache:
+        session.peer_cache.save()
+    # After the checkpoint, so the recorded mtimes are final
+    if session.content_index and session.content_index.add_torrent(session.details, session.picker):
+        session.content_index.save()
     print("All tasks completed.")
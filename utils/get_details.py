@@ -1,9 +1,17 @@
 import sys
+import json
+import os
+from array import array
 from math import ceil
-from typing import List
+from typing import List, Optional, Tuple
 import bencodepy
 import hashlib
 
+import utils.merkle as merkle
+from utils.metainfo import BencodeError, FileTable, PieceHashes
+
+METADATA_CACHE_VERSION = 3
+
 def get_piece_length(info_dict:dict)->int:
     try:
         len = info_dict[b'piece length']      
@@ -13,7 +21,49 @@ def get_piece_length(info_dict:dict)->int:
 
     return len
 
+def get_meta_version(info_dict: dict) -> int:
+    return info_dict.get(b'meta version', 1)
+
+def get_v2_files(info_dict: dict) -> List[Tuple[str, int, Optional[bytes]]]:
+    # (relative path, length, pieces root) for every file of a BEP 52 file tree, in tree order
+    files = []
+
+    def walk(tree, path):
+        for name, node in tree.items():
+            if name == b'':
+                files.append(('/'.join(path), node[b'length'], node.get(b'pieces root')))
+            else:
+                walk(node, path + [name.decode('utf-8')])
+
+    walk(info_dict[b'file tree'], [])
+    return files
+
+def get_v2_offsets(lengths: List[int], piece_length: int) -> List[int]:
+    # v2 files never share a piece, each one starts on a piece boundary
+    offsets = []
+    offset = 0
+    for length in lengths:
+        offsets.append(offset)
+        offset += (length + piece_length - 1) // piece_length * piece_length
+    return offsets
+
+def is_multi_file(info_dict: dict) -> bool:
+    if b'files' in info_dict:
+        return True
+    if b'file tree' in info_dict:
+        tree = info_dict[b'file tree']
+        return len(tree) != 1 or b'' not in next(iter(tree.values()))
+    return False
+
 def get_total_length(info_dict:dict)->int:
+    if get_meta_version(info_dict) == 2:
+        # Up to the end of the last file, including the gaps that align files to pieces
+        files = get_v2_files(info_dict)
+        if not files:
+            return 0
+        offsets = get_v2_offsets([length for _, length, _ in files], get_piece_length(info_dict))
+        return offsets[-1] + files[-1][1]
+
     total_length = 0
     try:
 
@@ -35,6 +85,9 @@ def get_total_pieces(total_length: int, peice_length: int)->int:
     return ceil(total_length/peice_length)
 
 def get_file_sizes(info_dict: dict)->list:
+    if get_meta_version(info_dict) == 2:
+        return [length for _, length, _ in get_v2_files(info_dict)]
+
     file_sizes = []
     try:
         if b'files' in info_dict:
@@ -51,47 +104,130 @@ def get_file_sizes(info_dict: dict)->list:
 
     return file_sizes
 
-def get_hash_list(info_dict: dict, num_of_pieces: int)->List[bytes]:
-    hashes = list()
-
-    pieces = info_dict[b'pieces']
-    
-    for i in range(num_of_pieces):
-        hashes.append(pieces[20*i:20*(i+1)])
-    
-    return hashes
+def get_hash_list(info_dict: dict, num_of_pieces: int)->PieceHashes:
+    # One shared buffer instead of a bytes object per piece, a lazily decoded info dict is not even copied
+    if hasattr(info_dict, 'string_view'):
+        return PieceHashes(info_dict.string_view(b'pieces'), num_of_pieces)
+    return PieceHashes(info_dict[b'pieces'], num_of_pieces)
+
+def get_v2_hash_list(info_dict: dict, piece_layers, files: FileTable, piece_length: int, num_of_pieces: int) -> PieceHashes:
+    # One piece layer hash per piece: the file's piece layer for files longer than a piece, else its pieces root.
+    # Every piece layer is checked against its pieces root before it is trusted
+    buffer = bytearray(merkle.HASH_SIZE * num_of_pieces)
+    blocks_per_piece = piece_length // merkle.BLOCK_SIZE
+
+    for file_index, (_, length, pieces_root) in enumerate(get_v2_files(info_dict)):
+        if length == 0:
+            continue
+        first_piece = files.offsets[file_index] // piece_length
+        if length <= piece_length:
+            layer = [pieces_root]
+        else:
+            if piece_layers is None or pieces_root not in piece_layers:
+                raise BencodeError(f"piece layers are missing for file {files.relative_paths[file_index]}")
+            layer = merkle.split_hashes(piece_layers[pieces_root])
+            if len(layer) != (length + piece_length - 1) // piece_length or \
+                    merkle.file_root(layer, blocks_per_piece, length) != pieces_root:
+                raise BencodeError(f"piece layer does not match the pieces root of {files.relative_paths[file_index]}")
+        for piece_offset, piece_hash in enumerate(layer):
+            start = merkle.HASH_SIZE * (first_piece + piece_offset)
+            buffer[start:start + merkle.HASH_SIZE] = piece_hash
+
+    return PieceHashes(buffer, num_of_pieces, merkle.HASH_SIZE)
 
 def get_info_hash(info_dict: dict)->bytes:
-    info_bencoded = bencodepy.encode(info_dict)
-    info_hash = hashlib.sha1(info_bencoded).digest()
-
-    return info_hash
-
-def get_file_details(info_dict: dict, root: str):
-    files_list = []
+    # A lazily decoded info dict still has its original bytes, which is what the info hash is defined on
+    raw = getattr(info_dict, 'raw', None)
+    if raw is None:
+        raw = bencodepy.encode(info_dict)
+
+    # Hybrid torrents keep the v1 hash on the wire, v2-only torrents use the SHA-256 hash cut to 20 bytes
+    if get_meta_version(info_dict) == 2 and b'pieces' not in info_dict:
+        return hashlib.sha256(raw).digest()[:20]
+    return hashlib.sha1(raw).digest()
+
+def get_file_details(info_dict: dict, root: str) -> FileTable:
+    if get_meta_version(info_dict) == 2:
+        # The v1 file list of a hybrid torrent describes the same layout with padding files, the tree has no padding
+        files = get_v2_files(info_dict)
+        lengths = [length for _, length, _ in files]
+        return FileTable(root, [path for path, _, _ in files], lengths, get_v2_offsets(lengths, get_piece_length(info_dict)))
+
+    relative_paths = []
+    lengths = []
 
     # If the torrent is in multifile mode
     if b'files' in info_dict:
-        offset = 0
         for file_info in info_dict[b'files']:
             file_path_str = [s.decode('utf-8') for s in file_info[b'path']]
-            file_path = '/'.join(file_path_str)
-            file_length = file_info[b'length']
-            
-            files_list.append({
-                'path': root+file_path,
-                'length': file_length,
-                'offset': offset,
-            })
-            offset += file_length  # update offset for next file
+            relative_paths.append('/'.join(file_path_str))
+            lengths.append(file_info[b'length'])
     else:
-        file_length = info_dict.get(b'length', 0)
-        files_list.append({
-            'path': root+info_dict.get(b'name','').decode('utf-8'),
-            'length': file_length,
-            'offset': 0,
-        })
+        relative_paths.append(info_dict.get(b'name', b'').decode('utf-8'))
+        lengths.append(info_dict.get(b'length', 0))
+
+    return FileTable(root, relative_paths, lengths)
+
+def get_piece_file_map(files: FileTable, piece_length: int, num_of_pieces: int):
+    # For every piece, the index of the first and last file it overlaps, packed as 32-bit arrays
+    first_file = array('I', [0]) * num_of_pieces
+    last_file = array('I', [0]) * num_of_pieces
+    seen = bytearray(num_of_pieces)
+
+    for file_index, (file_offset, file_length) in enumerate(zip(files.offsets, files.lengths)):
+        if file_length == 0:
+            continue
 
-    return files_list
+        first_piece = file_offset // piece_length
+        last_piece = (file_offset + file_length - 1) // piece_length
 
-__all__=["get_piece_length", "get_total_length", "get_total_pieces", "get_file_sizes", "get_hash_list", "get_info_hash", "get_file_details"]
\ No newline at end of file
+        for piece_index in range(first_piece, last_piece + 1):
+            if not seen[piece_index]:
+                first_file[piece_index] = file_index
+                seen[piece_index] = 1
+            last_file[piece_index] = file_index
+
+    return first_file, last_file
+
+def load_metadata_cache(path: str, info_hash: bytes) -> Optional[dict]:
+    # Layout: one JSON header line, then the piece to first file and piece to last file arrays
+    try:
+        with open(path, "rb") as f:
+            header = json.loads(f.readline())
+            if header.get('version') != METADATA_CACHE_VERSION or header.get('info_hash') != info_hash.hex():
+                return None
+            if header.get('itemsize') != array('I').itemsize:
+                return None
+            num_of_pieces = header['num_of_pieces']
+            header['piece_first_file'] = array('I')
+            header['piece_first_file'].fromfile(f, num_of_pieces)
+            header['piece_last_file'] = array('I')
+            header['piece_last_file'].fromfile(f, num_of_pieces)
+    except (OSError, ValueError, KeyError, EOFError):
+        return None
+    return header
+
+def save_metadata_cache(path: str, details) -> None:
+    header = {
+        'version': METADATA_CACHE_VERSION,
+        'info_hash': details.info_hash.hex(),
+        'itemsize': array('I').itemsize,
+        'piece_length': details.piece_length,
+        'total_length': details.total_length,
+        'num_of_pieces': details.num_of_pieces,
+        'paths': details.files.relative_paths,
+        'lengths': details.files.lengths.tolist(),
+        'offsets': details.files.offsets.tolist(),
+    }
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(json.dumps(header).encode() + b"\n")
+            array('I', details.piece_first_file).tofile(f)
+            array('I', details.piece_last_file).tofile(f)
+        os.replace(tmp_path, path)
+    except OSError:
+        # The download folder may not exist yet, the cache is simply written on the next start
+        pass
+
+__all__=["get_meta_version", "get_v2_files", "get_v2_offsets", "is_multi_file", "get_v2_hash_list", "get_piece_length", "get_total_length", "get_total_pieces", "get_file_sizes", "get_hash_list", "get_info_hash", "get_file_details", "get_piece_file_map", "load_metadata_cache", "save_metadata_cache"]
\ No newline at end of file
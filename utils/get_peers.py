@@ -6,6 +6,8 @@ from urllib.parse import urlparse
 from typing import List, Tuple
 import queue
 from .logger import Logger, CONNECTION_LOGGER, HANDLE_LOGGER, TRACKER_LOGGER
+from .get_details import get_file_sizes
+from .build_messages import PEER_ID
 
 PORT_NUMBER = 6881
 MAX_TRY = 1
@@ -75,7 +77,7 @@ def get_interval_data() -> List[int]:
 
 def _make_announce_request(connection_id: int, info_hash: bytes, total_length: int, tracker_ip: str, tracker_port: int, count: int, logger: TRACKER_LOGGER) -> List[Tuple[str, int]]:
     transaction_id = random.randint(0, 2**32 - 1)
-    peer_id = b'-TR4003-' + bytes(random.getrandbits(8) for _ in range(12))
+    peer_id = PEER_ID
     port = PORT_NUMBER
     action = 1  # Announce request action
 
@@ -187,7 +189,10 @@ def get_peers_list(torrent_info: dict, info_hash: bytes, peer_list: queue.Queue,
         total_length = 0
         info_dict = torrent_info[b'info']
 
-        if b'files' in info_dict:
+        if b'file tree' in info_dict:
+            # v2: the file tree has no padding files, unlike the v1 list of a hybrid torrent
+            total_length = sum(get_file_sizes(info_dict))
+        elif b'files' in info_dict:
             files_list = info_dict[b'files']
 
             for file in files_list:
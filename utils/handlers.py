@@ -21,7 +21,7 @@ def bitfield_handler(parsed_message: ParsedMessage, verified_pieces: List[bool])
         for bit in range(8):
             piece_index = byte_index * 8 + (7 - bit)
             if piece_index >= total_pieces:
-                break
+                continue
             has_piece = (byte >> bit) & 1
             if has_piece and not verified_pieces[piece_index]:
                 result.append(piece_index)
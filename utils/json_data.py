@@ -1,4 +1,4 @@
-from dataclasses import dataclass, asdict, field
+from dataclasses import dataclass, asdict, field, replace
 from typing import List, Set
 import json
 from asyncio import Lock
@@ -13,6 +13,7 @@ class ResumeData:
     mtime: int
     verified_pieces: List[bool]
     last_active: str
+    file_priorities: List[int] = field(default_factory=list)
 
     # These fields are excluded from serialization
     lock: Lock = field(init=False, repr=False, compare=False)
@@ -28,6 +29,11 @@ class ResumeData:
         with open(path, "w") as f:
             json.dump(data, f, indent=1)
 
+    def snapshot(self) -> "ResumeData":
+        # A copy whose verified flags stop changing, taken before a storage checkpoint and written after it
+        verified = list(self.verified_pieces)
+        return replace(self, verified_pieces=verified, downloaded=sum(verified), file_priorities=list(self.file_priorities))
+
     @classmethod
     def from_json(cls, path: str) -> "ResumeData":
         with open(path, "r") as f:
@@ -7,6 +7,7 @@ class Logger:
         self.downloaded = 0
         self.total = 1
         self.active_peers = set()
+        self.metrics = {}
         self.lock = threading.Lock()
 
     def success(self, msg: str):
@@ -28,6 +29,11 @@ class Logger:
             if peer_ip:
                 self.active_peers.add(peer_ip)
 
+    def set_metrics(self, metrics: dict):
+        # The pool controller and the choker report separately, each one replaces only its own keys
+        with self.lock:
+            self.metrics.update(metrics)
+
     def display_stats_loop(self, interval=10):
         def loop():
             while True:
@@ -37,6 +43,14 @@ class Logger:
                     print("\n\033[96m" + "━" * 40)
                     print(f"📦 Progress: {self.downloaded}/{self.total} pieces ({percent:.2f}%)")
                     print(f"⏱️  Time Elapsed: {int(elapsed)} sec")
+                    m = self.metrics
+                    if 'connect' in m:
+                        print(f"⚙️  Workers: connect {m['connect']}, handle {m['handle']}, download {m['download']}, claim {m['claim']}")
+                        print(f"🚀 Rate: {m['rate'] / 2**20:.2f} MiB/s, CPU {m['cpu'] * 100:.0f}%")
+                    if 'choker' in m:
+                        c = m['choker']
+                        print(f"⬆️  Upload: {c['unchoked']}/{c['interested']} interested peers unchoked, "
+                              f"{c['upload_rate'] / 2**20:.2f} MiB/s{' (seeding)' if c['seeding'] else ''}")
                     # print(f"🧑‍🤝‍🧑 Active Peers: {len(self.active_peers)}")
                     print("━" * 40 + "\033[0m\n")
                 time.sleep(interval)
@@ -0,0 +1,176 @@
+import asyncio
+import ipaddress
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from utils.logger import Logger
+
+LSD_GROUP = "239.192.152.143" # BEP 14 IPv4 multicast group
+LSD_PORT = 6771
+LSD_INTERVAL = 300 # Seconds between announces, BEP 14 asks for no more than one a minute per torrent
+LSD_MIN_INTERVAL = 60 # Announces sent, and a LAN peer's announces queued, at most this often
+LSD_TTL = 1 # Announces must not leave the local network
+RECV_TIMEOUT = 1
+
+def is_lan_address(ip: str) -> bool:
+    # Peers on private, link-local or loopback addresses are on our side of the WAN link
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    return address.is_private or address.is_loopback or address.is_link_local
+
+def build_announce(info_hash: bytes, port: int, cookie: str, group: str = LSD_GROUP, mcast_port: int = LSD_PORT) -> bytes:
+    return (f"BT-SEARCH * HTTP/1.1\r\n"
+            f"Host: {group}:{mcast_port}\r\n"
+            f"Port: {port}\r\n"
+            f"Infohash: {info_hash.hex()}\r\n"
+            f"cookie: {cookie}\r\n"
+            f"\r\n\r\n").encode()
+
+def parse_announce(data: bytes) -> Optional[Tuple[int, List[bytes], str]]:
+    # Returns (port, info hashes, cookie), or None for anything that is not a BT-SEARCH announce
+    try:
+        lines = data.decode("ascii").split("\r\n")
+    except UnicodeDecodeError:
+        return None
+    if not lines or not lines[0].startswith("BT-SEARCH * HTTP/1.1"):
+        return None
+
+    port = None
+    info_hashes = []
+    cookie = ""
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        name, value = name.strip().lower(), value.strip()
+        try:
+            if name == "port":
+                port = int(value)
+            elif name == "infohash":
+                info_hashes.append(bytes.fromhex(value))
+        except ValueError:
+            return None
+        if name == "cookie":
+            cookie = value
+
+    if port is None or not 0 < port < 65536 or not info_hashes:
+        return None
+    return port, info_hashes, cookie
+
+class PeerIntake:
+    # Peers found by other threads (LSD) go straight into the pipeline run in progress, and into
+    # peers_list for the next batch when no pipeline is running
+    def __init__(self, peers_list: queue.Queue):
+        self.peers_list = peers_list
+        self.lock = threading.Lock()
+        self.pipeline = None
+
+    def open(self, loop: asyncio.AbstractEventLoop, add_peers: Callable[[list], None]) -> None:
+        with self.lock:
+            self.pipeline = (loop, add_peers)
+
+    def close(self) -> None:
+        with self.lock:
+            self.pipeline = None
+
+    def put(self, peers: list) -> None:
+        with self.lock:
+            if self.pipeline:
+                loop, add_peers = self.pipeline
+                loop.call_soon_threadsafe(add_peers, peers)
+                return
+        self.peers_list.put(peers)
+
+class LocalServiceDiscovery:
+    # Announces the torrent on the LAN multicast group and hands peers announcing the same info hash to
+    # the peer pipeline, next to the tracker results. Our own announces come back over multicast
+    # loopback and are recognised by their cookie
+    def __init__(self, info_hash: bytes, port: int, intake: PeerIntake, logger: Logger,
+                 group: str = LSD_GROUP, mcast_port: int = LSD_PORT, interface: str = "0.0.0.0",
+                 interval: float = LSD_INTERVAL, min_interval: float = LSD_MIN_INTERVAL):
+        self.info_hash = info_hash
+        self.port = port
+        self.intake = intake
+        self.logger = logger
+        self.group = group
+        self.mcast_port = mcast_port
+        self.interface = interface
+        self.interval = interval
+        self.min_interval = min_interval
+        self.cookie = os.urandom(8).hex()
+        self.last_announce = None
+        # LAN peer -> when it was last handed to the pipeline
+        self.lan_peers: Dict[Tuple[str, int], float] = {}
+        self.sock = self._open_socket()
+
+    def _open_socket(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        # Every BitTorrent client on the host listens on the same port
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(("", self.mcast_port))
+        membership = struct.pack("4s4s", socket.inet_aton(self.group), socket.inet_aton(self.interface))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, LSD_TTL)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        if self.interface != "0.0.0.0":
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.interface))
+        sock.settimeout(RECV_TIMEOUT)
+        return sock
+
+    def announce(self) -> bool:
+        # Returns False if the last announce was too recent to send another one
+        now = time.monotonic()
+        if self.last_announce is not None and now - self.last_announce < self.min_interval:
+            return False
+        self.last_announce = now
+        message = build_announce(self.info_hash, self.port, self.cookie, self.group, self.mcast_port)
+        try:
+            self.sock.sendto(message, (self.group, self.mcast_port))
+        except OSError as e:
+            self.logger.warn(f"LSD announce failed: {e}")
+        return True
+
+    def handle(self, data: bytes, addr: Tuple[str, int]) -> Optional[Tuple[str, int]]:
+        announce = parse_announce(data)
+        if announce is None:
+            return None
+        port, info_hashes, cookie = announce
+        if cookie == self.cookie or self.info_hash not in info_hashes:
+            return None
+
+        # A host that announces too often (a restarting client, several torrents, a broken one) is queued once per min_interval
+        peer = (addr[0], port)
+        now = time.monotonic()
+        queued_at = self.lan_peers.get(peer)
+        if queued_at is not None and now - queued_at < self.min_interval:
+            return None
+        if queued_at is None:
+            self.logger.info(f"LSD: found LAN peer {peer[0]}:{peer[1]}")
+        self.lan_peers[peer] = now
+        self.intake.put([peer])
+        return peer
+
+    def run(self) -> None:
+        next_announce = 0
+        while True:
+            now = time.monotonic()
+            if now >= next_announce:
+                self.announce()
+                next_announce = now + self.interval
+            try:
+                data, addr = self.sock.recvfrom(1400)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            self.handle(data, addr)
+
+    def close(self) -> None:
+        self.sock.close()
@@ -0,0 +1,48 @@
+import hashlib
+from functools import lru_cache
+from typing import List
+
+BLOCK_SIZE = 2**14 # BEP 52 leaves always cover 16 KiB, whatever the request size
+HASH_SIZE = 32
+ZERO_HASH = bytes(HASH_SIZE)
+
+def next_power_of_two(n: int) -> int:
+    return 1 << max(0, n - 1).bit_length()
+
+def num_blocks(length: int) -> int:
+    return (length + BLOCK_SIZE - 1) // BLOCK_SIZE
+
+@lru_cache(maxsize=None)
+def pad_hash(height: int) -> bytes:
+    # Root of a subtree of 2**height padding leaves
+    if height == 0:
+        return ZERO_HASH
+    child = pad_hash(height - 1)
+    return hashlib.sha256(child + child).digest()
+
+def root_of(nodes: List[bytes], width: int, height: int = 0) -> bytes:
+    # Root over `width` (a power of two) nodes of the given height, nodes past the end are padding subtrees
+    if not nodes:
+        return pad_hash(height + (width.bit_length() - 1))
+    layer = list(nodes)
+    while width > 1:
+        if len(layer) % 2:
+            layer.append(pad_hash(height))
+        layer = [hashlib.sha256(layer[i] + layer[i + 1]).digest() for i in range(0, len(layer), 2)]
+        width //= 2
+        height += 1
+    return layer[0]
+
+def block_hashes(data) -> List[bytes]:
+    view = memoryview(data)
+    return [hashlib.sha256(view[begin:begin + BLOCK_SIZE]).digest() for begin in range(0, len(view), BLOCK_SIZE)]
+
+def split_hashes(data) -> List[bytes]:
+    view = memoryview(data)
+    return [bytes(view[i:i + HASH_SIZE]) for i in range(0, len(view) - HASH_SIZE + 1, HASH_SIZE)]
+
+def file_root(piece_layer: List[bytes], blocks_per_piece: int, file_length: int) -> bytes:
+    # The pieces root of a file larger than one piece, from its piece layer
+    piece_height = blocks_per_piece.bit_length() - 1
+    width = next_power_of_two(num_blocks(file_length)) // blocks_per_piece
+    return root_of(piece_layer, max(1, width), piece_height)
@@ -0,0 +1,202 @@
+import hashlib
+from array import array
+from collections.abc import Mapping, Sequence
+from typing import Dict, List, Tuple, Union
+
+DIGITS = b'0123456789'
+
+class BencodeError(ValueError):
+    pass
+
+def _string_bounds(data, pos: int) -> Tuple[int, int]:
+    # Returns (start, end) of the payload of the byte string at pos
+    colon = data.find(b':', pos)
+    if colon < 0:
+        raise BencodeError(f"Unterminated string length at {pos}")
+    start = colon + 1
+    end = start + int(data[pos:colon])
+    if end > len(data):
+        raise BencodeError(f"String at {pos} runs past the end of the data")
+    return start, end
+
+def skip_value(data, pos: int) -> int:
+    # Returns the end of the value starting at pos without building any objects
+    depth = 0
+    while True:
+        token = data[pos]
+        if token == 0x69: # i
+            end = data.find(b'e', pos)
+            if end < 0:
+                raise BencodeError(f"Unterminated integer at {pos}")
+            pos = end + 1
+        elif token in (0x6c, 0x64): # l, d
+            depth += 1
+            pos += 1
+        elif token == 0x65: # e
+            depth -= 1
+            pos += 1
+        elif token in DIGITS:
+            pos = _string_bounds(data, pos)[1]
+        else:
+            raise BencodeError(f"Invalid token {chr(token)!r} at {pos}")
+
+        if depth == 0:
+            return pos
+        if depth < 0:
+            raise BencodeError(f"Unexpected end marker at {pos - 1}")
+
+def decode_value(data, pos: int):
+    # Eager decoder for nested values, returns (value, end)
+    token = data[pos]
+    if token == 0x69:
+        end = data.find(b'e', pos)
+        return int(data[pos + 1:end]), end + 1
+    if token in DIGITS:
+        start, end = _string_bounds(data, pos)
+        return bytes(data[start:end]), end
+    if token == 0x6c:
+        items = []
+        pos += 1
+        while data[pos] != 0x65:
+            item, pos = decode_value(data, pos)
+            items.append(item)
+        return items, pos + 1
+    if token == 0x64:
+        result = {}
+        pos += 1
+        while data[pos] != 0x65:
+            key, pos = decode_value(data, pos)
+            result[key], pos = decode_value(data, pos)
+        return result, pos + 1
+    raise BencodeError(f"Invalid token {chr(token)!r} at {pos}")
+
+class LazyDict(Mapping):
+    # A bencoded dictionary that only records where its values are, and decodes one on first access.
+    # Nested dictionaries are lazy as well, lists and strings are decoded as a whole
+    def __init__(self, data: Union[bytes, memoryview], start: int = 0, end: int = None):
+        self.data = data
+        self.start = start
+        self.end = skip_value(data, start) if end is None else end
+        self._spans: Dict[bytes, Tuple[int, int]] = None
+        self._values = {}
+
+    def _index(self) -> Dict[bytes, Tuple[int, int]]:
+        if self._spans is None:
+            data = self.data
+            if data[self.start] != 0x64:
+                raise BencodeError(f"Expected a dictionary at {self.start}")
+            spans = {}
+            pos = self.start + 1
+            while data[pos] != 0x65:
+                key_start, key_end = _string_bounds(data, pos)
+                value_end = skip_value(data, key_end)
+                spans[bytes(data[key_start:key_end])] = (key_end, value_end)
+                pos = value_end
+            self._spans = spans
+        return self._spans
+
+    def __getitem__(self, key: bytes):
+        if key in self._values:
+            return self._values[key]
+        value_start, value_end = self._index()[key]
+        if self.data[value_start] == 0x64:
+            value = LazyDict(self.data, value_start, value_end)
+        else:
+            value = decode_value(self.data, value_start)[0]
+        self._values[key] = value
+        return value
+
+    def __iter__(self):
+        return iter(self._index())
+
+    def __len__(self) -> int:
+        return len(self._index())
+
+    def __contains__(self, key) -> bool:
+        return key in self._index()
+
+    @property
+    def raw(self) -> memoryview:
+        # The exact bytes this dictionary was read from, e.g. for the info hash
+        return memoryview(self.data)[self.start:self.end]
+
+    def string_view(self, key: bytes) -> memoryview:
+        # A byte string value as a view into the original data, without copying it
+        start, end = _string_bounds(self.data, self._index()[key][0])
+        return memoryview(self.data)[start:end]
+
+    def __reduce__(self):
+        # Pickles (e.g. for worker processes) carry only this dictionary's own bytes
+        return LazyDict, (bytes(self.raw),)
+
+class PieceHashes(Sequence):
+    # All piece hashes in one contiguous buffer, hash i is a view into it.
+    # 20 byte SHA-1 hashes for v1 torrents, 32 byte piece layer hashes for v2
+    def __init__(self, buffer, num_of_pieces: int, hash_size: int = 20):
+        self.view = memoryview(buffer)
+        self.num_of_pieces = num_of_pieces
+        self.hash_size = hash_size
+        if len(self.view) < hash_size * num_of_pieces:
+            raise BencodeError(f"pieces holds {len(self.view) // hash_size} hashes, expected {num_of_pieces}")
+
+    def __getitem__(self, piece_index: int) -> memoryview:
+        if not 0 <= piece_index < self.num_of_pieces:
+            raise IndexError(piece_index)
+        return self.view[self.hash_size * piece_index:self.hash_size * (piece_index + 1)]
+
+    def __len__(self) -> int:
+        return self.num_of_pieces
+
+class FileTable:
+    # The files of a torrent as parallel arrays instead of one dict per file.
+    # Paths are kept relative to root and joined only when a file is opened.
+    # Files are back to back unless offsets are given, v2 torrents start every file on a piece boundary
+    __slots__ = ('root', 'relative_paths', 'offsets', 'lengths')
+
+    def __init__(self, root: str, relative_paths: List[str], lengths, offsets=None):
+        self.root = root
+        self.relative_paths = relative_paths
+        self.lengths = array('Q', lengths)
+        if offsets is not None:
+            self.offsets = array('Q', offsets)
+            return
+        self.offsets = array('Q', bytes(8 * len(self.lengths)))
+        offset = 0
+        for file_index, length in enumerate(self.lengths):
+            self.offsets[file_index] = offset
+            offset += length
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def path(self, file_index: int) -> str:
+        return self.root + self.relative_paths[file_index]
+
+    def end(self, file_index: int) -> int:
+        return self.offsets[file_index] + self.lengths[file_index]
+
+class Metainfo:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.torrent = LazyDict(data)
+        self.info = self.torrent[b'info']
+        # Hash the info dictionary exactly as it appears in the file, re-encoding could change it.
+        # Hybrid torrents are announced with the v1 hash, v2-only ones with the SHA-256 hash cut to 20 bytes
+        self.info_hash_v2 = hashlib.sha256(self.info.raw).digest() if self.meta_version == 2 else None
+        if b'pieces' in self.info:
+            self.info_hash = hashlib.sha1(self.info.raw).digest()
+        else:
+            self.info_hash = self.info_hash_v2[:20]
+
+    @property
+    def meta_version(self) -> int:
+        return self.info.get(b'meta version', 1)
+
+    @property
+    def piece_layers(self):
+        return self.torrent.get(b'piece layers')
+
+    @classmethod
+    def load(cls, path: str) -> "Metainfo":
+        with open(path, "rb") as f:
+            return cls(f.read())
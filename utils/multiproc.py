@@ -0,0 +1,246 @@
+import asyncio
+import ctypes
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import zlib
+from typing import List
+
+from utils.details import TorrentDetails, METADATA_CACHE_FILENAME
+from utils.download import main
+from utils.json_data import ResumeData
+from utils.logger import Logger
+from utils.piece_picker import PiecePicker
+from utils.session import DownloadSession
+from utils.storage import Storage
+
+STOP_TIMEOUT = 10 # Seconds a worker process gets to flush its files after SIGTERM
+
+class SharedPieceState:
+    # Verified flags, claim counts and claim times in shared memory behind one cross-process lock.
+    # Every worker also counts its own claims, so the parent can hand back the pieces of a worker that died
+    def __init__(self, verified_pieces: List[bool], context=None, workers: int = 0):
+        context = context or multiprocessing.get_context()
+        num_of_pieces = len(verified_pieces)
+        self.lock = context.Lock()
+        self.verified = context.RawArray(ctypes.c_bool, num_of_pieces)
+        self.claims = context.RawArray(ctypes.c_ubyte, num_of_pieces)
+        # time.monotonic() is system wide on Linux, so one process can compare another's claim times
+        self.claimed_at = context.RawArray(ctypes.c_double, num_of_pieces)
+        self.worker_claims = context.RawArray(ctypes.c_ubyte, num_of_pieces * workers)
+        self.verified[:] = [bool(flag) for flag in verified_pieces]
+
+    def downloaded(self) -> int:
+        return sum(self.verified)
+
+    def sync_to(self, resume_data: ResumeData) -> None:
+        # Resume data is written as JSON, so it gets a plain copy of the shared flags
+        with self.lock:
+            resume_data.verified_pieces = list(self.verified)
+        resume_data.downloaded = sum(resume_data.verified_pieces)
+
+    def release_worker(self, worker: int) -> int:
+        # Drops every claim the worker still held, returns how many pieces it had claimed
+        num_of_pieces = len(self.claims)
+        start = worker * num_of_pieces
+        released = 0
+        with self.lock:
+            held = self.worker_claims[start:start + num_of_pieces]
+            for piece_index, count in enumerate(held):
+                if not count:
+                    continue
+                remaining = max(0, self.claims[piece_index] - count)
+                self.claims[piece_index] = remaining
+                if not remaining:
+                    self.claimed_at[piece_index] = 0
+                released += 1
+            self.worker_claims[start:start + num_of_pieces] = bytes(num_of_pieces)
+        return released
+
+class SharedClaims:
+    # The subset of the dict interface PiecePicker uses for its claim counts, backed by shared memory
+    def __init__(self, counts):
+        self.counts = counts
+
+    def __contains__(self, piece_index: int) -> bool:
+        return self.counts[piece_index] > 0
+
+    def __getitem__(self, piece_index: int) -> int:
+        return self.counts[piece_index]
+
+    def __setitem__(self, piece_index: int, count: int) -> None:
+        self.counts[piece_index] = count
+
+    def get(self, piece_index: int, default=None):
+        return self.counts[piece_index] or default
+
+    def pop(self, piece_index: int, default=None):
+        count = self.counts[piece_index]
+        self.counts[piece_index] = 0
+        return count or default
+
+class SharedClaimTimes:
+    # Claim times for PiecePicker.claimed_at, 0 stands for a piece nobody claimed
+    def __init__(self, times):
+        self.times = times
+
+    def __getitem__(self, piece_index: int) -> float:
+        return self.times[piece_index]
+
+    def get(self, piece_index: int, default=None):
+        return self.times[piece_index] or default
+
+    def setdefault(self, piece_index: int, claimed_at: float) -> float:
+        if not self.times[piece_index]:
+            self.times[piece_index] = claimed_at
+        return self.times[piece_index]
+
+    def pop(self, piece_index: int, default=None):
+        claimed_at = self.times[piece_index]
+        self.times[piece_index] = 0
+        return claimed_at or default
+
+class SharedPiecePicker(PiecePicker):
+    # Same picking rules, but claims and verified flags are seen by every process.
+    # resume_data.verified_pieces is replaced by the shared array. A worker process passes its
+    # index so its claims are counted apart, the parent's own picker has none
+    def __init__(self, details: TorrentDetails, resume_data: ResumeData, shared: SharedPieceState,
+                 streaming: bool = False, worker: int = None):
+        resume_data.verified_pieces = shared.verified
+        super().__init__(details, resume_data, streaming)
+        self.shared = shared
+        self.lock = shared.lock
+        self.piece_done = threading.Condition(self.lock)
+        self.claims = SharedClaims(shared.claims)
+        self.claimed_at = SharedClaimTimes(shared.claimed_at)
+        self.owned_offset = None if worker is None else worker * details.num_of_pieces
+
+    def _add_claim(self, piece_index: int) -> None:
+        super()._add_claim(piece_index)
+        if self.owned_offset is not None:
+            self.shared.worker_claims[self.owned_offset + piece_index] += 1
+
+    def _remove_claim(self, piece_index: int) -> None:
+        if self.owned_offset is not None and self.shared.worker_claims[self.owned_offset + piece_index]:
+            self.shared.worker_claims[self.owned_offset + piece_index] -= 1
+        super()._remove_claim(piece_index)
+
+def shard_of(peer, count: int) -> int:
+    # Stable across processes and runs, so a peer re-announced by the tracker lands on the same worker
+    return zlib.crc32(f"{peer[0]}:{peer[1]}".encode()) % count
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def worker_process(worker: int, info_dict: dict, piece_layers, dir_path: str, resume_fields: dict,
+                   shared: SharedPieceState, peer_queue, options: dict) -> None:
+    # Ctrl + C reaches the whole process group, the parent stops its workers with SIGTERM instead
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+
+    resume_data = ResumeData(**resume_fields)
+    details = TorrentDetails(info_dict, dir_path, os.path.join(dir_path, METADATA_CACHE_FILENAME), piece_layers,
+                             bytes.fromhex(resume_data.info_hash) or None)
+    session = DownloadSession(
+        details=details,
+        resume_data=resume_data,
+        # No write cache: the verified flag is shared as soon as a piece is committed, and a worker that is
+        # killed before its next flush would leave pieces marked verified whose data never left its memory
+        storage=Storage(details, options['preallocate'], fsync=options['fsync']),
+        picker=SharedPiecePicker(details, resume_data, shared, streaming=options['streaming'], worker=worker),
+        write_through=options['write_through'],
+        transport=options['transport'],
+        max_half_open=options['max_half_open'],
+        min_peers=options['min_peers'],
+        max_peers=options['max_peers'],
+        max_claim=options['max_claim'],
+        claim_size=options['max_claim'],
+    )
+    # The parent already moved partfile data for files that became wanted, here the priorities only steer picking
+    if resume_data.file_priorities:
+        session.set_file_priorities(resume_data.file_priorities)
+    logger = Logger()
+
+    try:
+        while True:
+            peers = peer_queue.get()
+            asyncio.run(main(peers, session, logger))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Pieces this process verified are already marked in shared memory, their data must reach the disk
+        session.storage.checkpoint()
+        session.storage.close()
+
+class DownloadProcesses:
+    # Runs the peer pipeline in several processes, each with its own event loop and a shard of the peers
+    def __init__(self, count: int, info_dict: dict, piece_layers, dir_path: str, resume_data: ResumeData,
+                 shared: SharedPieceState, options: dict, context=None):
+        self.context = context or multiprocessing.get_context()
+        self.shared = shared
+        self.peer_queues = [self.context.Queue() for _ in range(count)]
+
+        resume_fields = {
+            'info_hash': resume_data.info_hash,
+            'piece_length': resume_data.piece_length,
+            'total_pieces': resume_data.total_pieces,
+            'downloaded': 0,
+            'file_sizes': resume_data.file_sizes,
+            'mtime': resume_data.mtime,
+            'verified_pieces': [],
+            'last_active': resume_data.last_active,
+            'file_priorities': list(resume_data.file_priorities),
+        }
+        self.worker_args = (info_dict, piece_layers, dir_path, resume_fields, shared)
+        self.options = options
+        self.processes = [self._new_process(worker) for worker in range(count)]
+        self.stopping = False
+
+    def _new_process(self, worker: int):
+        return self.context.Process(target=worker_process, daemon=True,
+                                    args=(worker, *self.worker_args, self.peer_queues[worker], self.options))
+
+    def start(self) -> None:
+        for process in self.processes:
+            process.start()
+
+    def revive(self, logger: Logger) -> None:
+        # A worker that died (OOM killer, a crash in a peer handler) would keep its pieces claimed for
+        # good: its claims are handed back and a new process takes over its shard of the peers
+        for worker, process in enumerate(self.processes):
+            if self.stopping or process.exitcode is None:
+                continue
+            released = self.shared.release_worker(worker)
+            logger.warn(f"Download process {worker} exited with code {process.exitcode}, "
+                        f"released {released} claimed pieces and restarted it")
+            self.processes[worker] = self._new_process(worker)
+            self.processes[worker].start()
+
+    def dispatch(self, peers: list) -> None:
+        shards = [[] for _ in self.peer_queues]
+        for peer in peers:
+            shards[shard_of(peer, len(shards))].append(tuple(peer))
+        for peer_queue, shard in zip(self.peer_queues, shards):
+            if shard:
+                peer_queue.put(shard)
+
+    def dispatch_loop(self, peers_list: queue.Queue, logger: Logger, interval: float = 1) -> None:
+        # Feeds tracker batches to the workers and keeps the parent's progress display current
+        num_of_pieces = len(self.shared.verified)
+        while True:
+            try:
+                self.dispatch(peers_list.get(timeout=interval))
+            except queue.Empty:
+                pass
+            self.revive(logger)
+            logger.update_stats(self.shared.downloaded(), num_of_pieces)
+
+    def stop(self) -> None:
+        self.stopping = True
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join(STOP_TIMEOUT)
@@ -0,0 +1,145 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from utils.lsd import is_lan_address
+
+MAX_CACHED_PEERS = 500 # Size cap for the per-torrent peer database
+MAX_PEER_AGE = 7 * 24 * 3600 # Entries not seen for this many seconds are evicted
+WARM_START_PEERS = 50 # Number of cached peers dialled immediately on startup
+LAN_PEER_BONUS = 4 # Score multiplier for peers on the local network, their bytes do not cross the WAN link
+
+class PeerCache:
+    def __init__(self, path: str, max_peers: int = MAX_CACHED_PEERS, max_age: int = MAX_PEER_AGE):
+        self.path = path
+        self.max_peers = max_peers
+        self.max_age = max_age
+        self.entries: Dict[str, dict] = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str) -> "PeerCache":
+        cache = cls(path)
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    cache.entries = json.load(f)
+            except (OSError, ValueError):
+                # A corrupt cache only costs us the warm start
+                cache.entries = {}
+        cache.evict()
+        return cache
+
+    def save(self) -> None:
+        with self.lock:
+            self._evict_locked()
+            data = json.dumps(self.entries, indent=1)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+    def _entry(self, ip: str, port: int) -> dict:
+        key = f"{ip}:{port}"
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = {
+                'ip': ip,
+                'port': port,
+                'handshake_ok': 0,
+                'handshake_failed': 0,
+                'bytes': 0,
+                'throughput': 0.0,
+                'latency': None,
+                'bad_blocks': 0,
+                'last_seen': 0,
+                'first_seen': int(time.time()),
+            }
+            self.entries[key] = entry
+        return entry
+
+    def record_handshake(self, ip: str, port: int, success: bool) -> None:
+        with self.lock:
+            entry = self._entry(ip, port)
+            if success:
+                entry['handshake_ok'] += 1
+                entry['last_seen'] = int(time.time())
+            else:
+                entry['handshake_failed'] += 1
+
+    def record_throughput(self, ip: str, port: int, num_bytes: int, seconds: float) -> None:
+        if num_bytes <= 0 or seconds <= 0:
+            return
+        with self.lock:
+            entry = self._entry(ip, port)
+            rate = num_bytes / seconds
+            # Exponential moving average so one lucky burst does not dominate
+            if entry['throughput'] > 0:
+                entry['throughput'] = 0.7 * entry['throughput'] + 0.3 * rate
+            else:
+                entry['throughput'] = rate
+            entry['bytes'] += num_bytes
+            entry['last_seen'] = int(time.time())
+
+    def record_latency(self, ip: str, port: int, seconds: float) -> None:
+        with self.lock:
+            entry = self._entry(ip, port)
+            if entry.get('latency') is None:
+                entry['latency'] = seconds
+            else:
+                entry['latency'] = 0.7 * entry['latency'] + 0.3 * seconds
+
+    def record_bad_blocks(self, ip: str, port: int, count: int) -> None:
+        with self.lock:
+            entry = self._entry(ip, port)
+            entry['bad_blocks'] = entry.get('bad_blocks', 0) + count
+
+    def expected_latency(self, ip: str, port: int, default: float) -> float:
+        with self.lock:
+            entry = self.entries.get(f"{ip}:{port}")
+            if entry is None or entry.get('latency') is None:
+                return default
+            return entry['latency']
+
+    def score(self, entry: dict) -> float:
+        attempts = entry['handshake_ok'] + entry['handshake_failed']
+        success_rate = (entry['handshake_ok'] + 1) / (attempts + 2)
+        age = max(0, time.time() - entry['last_seen'])
+        freshness = max(0.0, 1 - age / self.max_age)
+        # Faster connects rank higher, unknown latency counts as a slow-ish peer
+        latency = entry.get('latency')
+        latency_factor = 1 / (1 + (latency if latency is not None else 0.5))
+        lan_factor = LAN_PEER_BONUS if is_lan_address(entry['ip']) else 1
+        # Every corrupt block (only detectable on v2 torrents) halves the score
+        trust = 0.5 ** entry.get('bad_blocks', 0)
+        # Peers that never sent data still rank above dead ones if they handshake reliably
+        return (entry['throughput'] + 1024) * success_rate * freshness * latency_factor * lan_factor * trust
+
+    def best(self, count: int = WARM_START_PEERS) -> List[Tuple[str, int]]:
+        with self.lock:
+            ranked = sorted(self.entries.values(), key=self.score, reverse=True)
+            return [(entry['ip'], entry['port']) for entry in ranked[:count] if entry['handshake_ok'] > 0]
+
+    def evict(self) -> None:
+        with self.lock:
+            self._evict_locked()
+
+    def _evict_locked(self) -> None:
+        now = time.time()
+        # Peers we never got a handshake from age from when they were first recorded, entries
+        # written before first_seen existed start aging now
+        for entry in self.entries.values():
+            entry.setdefault('first_seen', int(now))
+        stale = [key for key, entry in self.entries.items()
+                 if now - (entry['last_seen'] or entry['first_seen']) > self.max_age]
+        # Peers that have failed repeatedly and never succeeded are not worth keeping
+        stale += [key for key, entry in self.entries.items()
+                  if entry['handshake_ok'] == 0 and entry['handshake_failed'] >= 3]
+        for key in stale:
+            self.entries.pop(key, None)
+
+        if len(self.entries) > self.max_peers:
+            ranked = sorted(self.entries.items(), key=lambda item: self.score(item[1]), reverse=True)
+            self.entries = dict(ranked[:self.max_peers])
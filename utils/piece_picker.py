@@ -0,0 +1,182 @@
+import asyncio
+import threading
+import time
+from typing import Dict, List
+
+from utils.details import TorrentDetails
+from utils.json_data import ResumeData
+
+STREAM_WINDOW = 32 # Pieces ahead of the read cursor that are picked strictly in order
+URGENT_PIECES = 4 # Pieces right at the cursor that may be fetched from several peers at once
+URGENT_DEADLINE = 3.0 # Seconds an urgent piece may stay claimed before another peer is asked for it too
+MAX_DUPLICATE_CLAIMS = 3 # Maximum number of peers fetching the same urgent piece
+STREAM_CLAIM_PER_PEER = 2 # Batch size in streaming mode so claims do not run far ahead of the cursor
+
+PRIORITY_SKIP = 0
+PRIORITY_LOW = 1
+PRIORITY_NORMAL = 4
+PRIORITY_HIGH = 7
+FILE_PRIORITIES = {'skip': PRIORITY_SKIP, 'low': PRIORITY_LOW, 'normal': PRIORITY_NORMAL, 'high': PRIORITY_HIGH}
+
+class PiecePicker:
+    def __init__(self, details: TorrentDetails, resume_data: ResumeData, streaming: bool = False):
+        self.details = details
+        self.resume_data = resume_data
+        self.streaming = streaming
+        self.cursor = 0
+        self.claims: Dict[int, int] = {}
+        self.claimed_at: Dict[int, float] = {}
+        self.lock = threading.Lock()
+        self.piece_done = threading.Condition(self.lock)
+        self.async_waiters: Dict[int, list] = {}
+        self.piece_priority = bytearray([PRIORITY_NORMAL]) * details.num_of_pieces
+        self.uniform_priority = True
+
+        if resume_data.file_priorities:
+            self.set_file_priorities(resume_data.file_priorities)
+
+    def set_file_priorities(self, file_priorities: List[int]) -> None:
+        # A piece gets the highest priority of the files it overlaps, so a piece shared with a wanted file is still fetched
+        first_file = self.details.piece_first_file
+        last_file = self.details.piece_last_file
+        piece_priority = bytearray(self.details.num_of_pieces)
+
+        for piece_index in range(self.details.num_of_pieces):
+            piece_priority[piece_index] = max(file_priorities[first_file[piece_index]:last_file[piece_index] + 1])
+
+        with self.lock:
+            self.piece_priority = piece_priority
+            self.uniform_priority = len(set(file_priorities)) <= 1
+            self.resume_data.file_priorities = list(file_priorities)
+
+    def is_wanted(self, piece_index: int) -> bool:
+        return self.piece_priority[piece_index] != PRIORITY_SKIP
+
+    def is_verified(self, piece_index: int) -> bool:
+        return self.resume_data.verified_pieces[piece_index]
+
+    def is_complete(self) -> bool:
+        verified = self.resume_data.verified_pieces
+        return all(verified[i] or not self.piece_priority[i] for i in range(self.details.num_of_pieces))
+
+    def remaining(self) -> int:
+        verified = self.resume_data.verified_pieces
+        return sum(1 for i in range(self.details.num_of_pieces) if not verified[i] and self.piece_priority[i])
+
+    def set_cursor(self, piece_index: int) -> None:
+        with self.lock:
+            self.cursor = max(0, min(piece_index, self.details.num_of_pieces - 1))
+
+    def _add_claim(self, piece_index: int) -> None:
+        self.claims[piece_index] = self.claims.get(piece_index, 0) + 1
+        self.claimed_at.setdefault(piece_index, time.monotonic())
+        self.resume_data.claimed_pieces.add(piece_index)
+
+    def _urgent_pieces(self) -> List[int]:
+        urgent = []
+        verified = self.resume_data.verified_pieces
+        for piece_index in range(self.cursor, self.details.num_of_pieces):
+            if len(urgent) >= URGENT_PIECES:
+                break
+            if not verified[piece_index] and self.piece_priority[piece_index]:
+                urgent.append(piece_index)
+        return urgent
+
+    def _is_late(self, piece_index: int, now: float) -> bool:
+        # Pieces closer to the cursor get a tighter deadline
+        distance = piece_index - self.cursor
+        deadline = self.claimed_at.get(piece_index, now) + URGENT_DEADLINE * (1 + distance)
+        return now >= deadline and self.claims[piece_index] < MAX_DUPLICATE_CLAIMS
+
+    def claim(self, available: List[int], max_count: int) -> List[int]:
+        claimed = []
+        verified = self.resume_data.verified_pieces
+
+        with self.lock:
+            priority = self.piece_priority
+
+            if not self.streaming:
+                # Higher priority files first, bitfield order within a priority level
+                ordered = available if self.uniform_priority else sorted(available, key=lambda i: -priority[i])
+                for piece_index in ordered:
+                    if len(claimed) >= max_count:
+                        break
+                    if priority[piece_index] and not verified[piece_index] and piece_index not in self.claims:
+                        self._add_claim(piece_index)
+                        claimed.append(piece_index)
+                return claimed
+
+            max_count = min(max_count, STREAM_CLAIM_PER_PEER)
+            available_set = set(available)
+            now = time.monotonic()
+
+            # Urgent pieces first, duplicating the request if the current holder missed its deadline
+            for piece_index in self._urgent_pieces():
+                if len(claimed) >= max_count:
+                    return claimed
+                if piece_index not in available_set:
+                    continue
+                if piece_index not in self.claims or self._is_late(piece_index, now):
+                    self._add_claim(piece_index)
+                    claimed.append(piece_index)
+
+            # Then the sliding window ahead of the cursor, then everything after it.
+            # Outside the window higher priority files go first, in order within a level
+            window_end = min(self.cursor + STREAM_WINDOW, self.details.num_of_pieces)
+            ordered = sorted(available, key=lambda i: (i < self.cursor, i >= window_end, -priority[i] if i >= window_end else 0, i))
+
+            for piece_index in ordered:
+                if len(claimed) >= max_count:
+                    break
+                if priority[piece_index] and not verified[piece_index] and piece_index not in self.claims:
+                    self._add_claim(piece_index)
+                    claimed.append(piece_index)
+
+        return claimed
+
+    def is_duplicate(self, piece_index: int) -> bool:
+        with self.lock:
+            return self.claims.get(piece_index, 0) > 1
+
+    def _remove_claim(self, piece_index: int) -> None:
+        count = self.claims.get(piece_index, 0) - 1
+        if count > 0:
+            self.claims[piece_index] = count
+            return
+        self.claims.pop(piece_index, None)
+        self.claimed_at.pop(piece_index, None)
+        self.resume_data.claimed_pieces.discard(piece_index)
+
+    def release(self, piece_index: int) -> None:
+        with self.lock:
+            self._remove_claim(piece_index)
+
+    def mark_verified(self, piece_index: int) -> bool:
+        # Returns False if another peer already delivered this piece
+        with self.lock:
+            if self.resume_data.verified_pieces[piece_index]:
+                return False
+            self.resume_data.verified_pieces[piece_index] = True
+            self.resume_data.downloaded += 1
+            self.piece_done.notify_all()
+
+            for loop, future in self.async_waiters.pop(piece_index, []):
+                loop.call_soon_threadsafe(_resolve, future)
+        return True
+
+    def wait_for_piece(self, piece_index: int, timeout: float = None) -> bool:
+        with self.lock:
+            return self.piece_done.wait_for(lambda: self.resume_data.verified_pieces[piece_index], timeout)
+
+    async def wait_for_piece_async(self, piece_index: int) -> None:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.lock:
+            if self.resume_data.verified_pieces[piece_index]:
+                return
+            self.async_waiters.setdefault(piece_index, []).append((loop, future))
+        await future
+
+def _resolve(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
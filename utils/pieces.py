@@ -0,0 +1,224 @@
+import hashlib
+import struct
+from typing import Dict, List, Set
+
+import utils.build_messages as messages
+import utils.merkle as merkle
+import utils.verify_messages as verify
+from utils.block_journal import BlockJournal
+from utils.piece_picker import PiecePicker
+from utils.storage import Storage
+import utils.handlers as handler
+
+MAX_HASHES_PER_REQUEST = 512 # Leaf hashes asked for in one hash request
+
+class BufferedPiece:
+    # Holds the whole piece in memory, hashes it once and writes it in one go
+    def __init__(self, piece_index: int, piece_size: int, storage: Storage, journal: BlockJournal = None):
+        self.piece_index = piece_index
+        self.piece_size = piece_size
+        self.storage = storage
+        self.journal = journal
+        self.data = bytearray(piece_size)
+
+    def present_blocks(self) -> Set[int]:
+        return set()
+
+    def hash_requests(self) -> List[bytes]:
+        return []
+
+    def add_hashes(self, body: bytes) -> List[int]:
+        return []
+
+    def add_block(self, begin: int, block: bytes) -> bool:
+        self.data[begin:begin + len(block)] = block
+        return True
+
+    def verify(self, piece_hash: bytes) -> bool:
+        details = self.storage.details
+        if details.meta_version == 2:
+            leaf_count = details.piece_leaves(self.piece_index)[2]
+            return merkle.root_of(merkle.block_hashes(self.data), leaf_count) == piece_hash
+        return handler.verify_piece_hash(self.data, piece_hash)
+
+    def commit(self) -> None:
+        self.storage.write_piece(self.piece_index, self.data)
+        # A duplicate request for an urgent piece may have streamed some of its blocks through the journal
+        if self.journal:
+            self.journal.clear(self.piece_index)
+
+    def rollback(self) -> None:
+        self.data = bytearray(self.piece_size)
+
+
+class StreamingPiece:
+    # Writes every block straight to its final file position and feeds an incremental SHA-1
+    # in order, so only blocks that arrive ahead of the hash cursor are kept in memory
+    def __init__(self, piece_index: int, piece_size: int, storage: Storage, picker: PiecePicker = None,
+                 journal: BlockJournal = None):
+        self.piece_index = piece_index
+        self.piece_size = piece_size
+        self.storage = storage
+        self.picker = picker
+        self.journal = journal
+        self.base_offset = piece_index * storage.details.piece_length
+        self.hasher = hashlib.sha1()
+        self.hashed_upto = 0
+        self.out_of_order: Dict[int, bytes] = {}
+        # Blocks written by an earlier run, read back from disk when the hash cursor reaches them
+        self.on_disk = journal.blocks_on_disk(piece_index) if journal else set()
+        self._advance()
+
+    def present_blocks(self) -> Set[int]:
+        return self.on_disk
+
+    def hash_requests(self) -> List[bytes]:
+        return []
+
+    def add_hashes(self, body: bytes) -> List[int]:
+        return []
+
+    def add_block(self, begin: int, block: bytes) -> bool:
+        # Never write over a piece another peer has already delivered and verified
+        if self.picker is None or not self.picker.is_verified(self.piece_index):
+            self.storage.write(self.base_offset + begin, block)
+            if self.journal:
+                self.journal.mark_block(self.piece_index, begin)
+
+        if begin != self.hashed_upto:
+            self.out_of_order[begin] = block
+            return True
+
+        self.hasher.update(block)
+        self.hashed_upto += len(block)
+        self._advance()
+        return True
+
+    def _advance(self) -> None:
+        # Drain any blocks that are now contiguous with the hash cursor, from memory or from disk
+        while self.hashed_upto < self.piece_size:
+            if self.hashed_upto in self.out_of_order:
+                pending = self.out_of_order.pop(self.hashed_upto)
+            elif self.hashed_upto in self.on_disk:
+                block_length = min(self.journal.block_size, self.piece_size - self.hashed_upto)
+                pending = self.storage.read(self.base_offset + self.hashed_upto, block_length)
+            else:
+                break
+            self.hasher.update(pending)
+            self.hashed_upto += len(pending)
+
+    def verify(self, piece_hash: bytes) -> bool:
+        if self.hashed_upto != self.piece_size:
+            return False
+        return self.hasher.digest() == piece_hash
+
+    def commit(self) -> None:
+        # Blocks are already on disk, the piece only becomes visible once it is marked verified
+        if self.journal:
+            self.journal.clear(self.piece_index)
+
+    def rollback(self) -> None:
+        # The bad bytes stay on disk but the piece is never marked verified, so it is re-fetched and overwritten
+        self.hasher = hashlib.sha1()
+        self.hashed_upto = 0
+        self.out_of_order.clear()
+        self.on_disk = set()
+        if self.journal:
+            self.journal.clear(self.piece_index)
+
+
+class MerklePiece:
+    # v2 pieces (BEP 52). Every 16 KiB block is checked against its leaf hash as it arrives and only good
+    # blocks are written, so a corrupt block is re-requested on its own and the peer that sent it is known.
+    # Leaf hashes are asked from the peer and trusted once they hash up to the piece layer hash of the torrent.
+    # Until they arrive blocks wait in memory; if the peer never sends them the piece is checked as a whole
+    def __init__(self, piece_index: int, piece_size: int, storage: Storage, picker: PiecePicker = None,
+                 request_hashes: bool = True):
+        details = storage.details
+        self.piece_index = piece_index
+        self.piece_size = piece_size
+        self.storage = storage
+        self.picker = picker
+        self.details = details
+        self.request_hashes = request_hashes
+        self.base_offset = piece_index * details.piece_length
+        self.pieces_root, self.first_leaf, self.leaf_count = details.piece_leaves(piece_index)
+        self.piece_hash = bytes(details.hash_of_pieces[piece_index])
+        self.num_blocks = merkle.num_blocks(piece_size)
+        # Leaf hashes proven by an earlier attempt are kept until the piece is committed
+        self.leaf_hashes = details.leaf_hashes.get(piece_index)
+        if self.leaf_hashes is None and self.leaf_count == 1:
+            self.leaf_hashes = [self.piece_hash]
+        self.received_hashes: Dict[int, List[bytes]] = {}
+        self.pending: Dict[int, bytes] = {}
+        self.written: Set[int] = set()
+
+    def present_blocks(self) -> Set[int]:
+        return set()
+
+    def hash_requests(self) -> List[bytes]:
+        if self.leaf_hashes is not None or not self.request_hashes:
+            return []
+        length = min(self.leaf_count, MAX_HASHES_PER_REQUEST)
+        return [messages.build_hash_request(self.pieces_root, 0, self.first_leaf + index, length, 0)
+                for index in range(0, self.leaf_count, length)]
+
+    def add_hashes(self, body: bytes) -> List[int]:
+        # Takes a hashes or hash reject message, returns the waiting blocks that turned out to be corrupt
+        if not verify.is_hashes_body(body) or self.leaf_hashes is not None:
+            return []
+        pieces_root, base_layer, index, _, _ = struct.unpack_from(">32sIIII", body, 1)
+        if pieces_root != self.pieces_root or base_layer != 0:
+            return []
+        self.received_hashes[index - self.first_leaf] = merkle.split_hashes(memoryview(body)[49:])
+        if sum(map(len, self.received_hashes.values())) < self.leaf_count:
+            return []
+
+        leaves = [leaf for _, chunk in sorted(self.received_hashes.items()) for leaf in chunk]
+        self.received_hashes.clear()
+        if merkle.root_of(leaves, self.leaf_count) != self.piece_hash:
+            # Made up hashes, fall back to checking the piece as a whole
+            return []
+        self.leaf_hashes = leaves
+        self.details.leaf_hashes[self.piece_index] = leaves
+
+        pending, self.pending = self.pending, {}
+        return [begin for begin, block in pending.items() if not self._check(begin, block)]
+
+    def _check(self, begin: int, block) -> bool:
+        if hashlib.sha256(block).digest() != self.leaf_hashes[begin // merkle.BLOCK_SIZE]:
+            return False
+        self._write(begin, block)
+        return True
+
+    def _write(self, begin: int, block) -> None:
+        # Never write over a piece another peer has already delivered and verified
+        if self.picker is None or not self.picker.is_verified(self.piece_index):
+            self.storage.write(self.base_offset + begin, block)
+        self.written.add(begin)
+
+    def add_block(self, begin: int, block: bytes) -> bool:
+        if self.leaf_hashes is None:
+            self.pending[begin] = block
+            return True
+        return self._check(begin, block)
+
+    def verify(self, piece_hash: bytes) -> bool:
+        if self.leaf_hashes is not None:
+            return len(self.written) == self.num_blocks
+        if len(self.pending) != self.num_blocks:
+            return False
+        leaves = [hashlib.sha256(self.pending[begin]).digest() for begin in sorted(self.pending)]
+        if merkle.root_of(leaves, self.leaf_count) != piece_hash:
+            return False
+        for begin, block in self.pending.items():
+            self._write(begin, block)
+        return True
+
+    def commit(self) -> None:
+        # Blocks are already on disk
+        self.details.leaf_hashes.pop(self.piece_index, None)
+
+    def rollback(self) -> None:
+        self.pending.clear()
+        self.written.clear()
@@ -0,0 +1,168 @@
+import asyncio
+import time
+from typing import Callable, Set
+
+from utils.logger import Logger
+from utils.session import DownloadSession
+
+ADJUST_INTERVAL = 2.0 # Seconds between two sizing decisions
+CPU_HIGH = 0.85 # Fraction of one core above which we stop adding work
+MIN_GAIN = 0.05 # Relative throughput gain a new download slot has to bring to be kept
+HOLD_TICKS = 3 # Ticks to wait after undoing a growth step before trying again
+MIN_CONN_TASKS = 4
+MIN_HANDLE_TASKS = 2
+MAX_HANDLE_TASKS = 16
+MIN_CLAIM = 2
+
+class WorkerPool:
+    # A resizable set of identical worker tasks. Workers fetch items through get() and
+    # call should_retire() before each fetch, so shrinking never drops an item in flight
+    def __init__(self, worker_factory: Callable, min_size: int, max_size: int):
+        self.worker_factory = worker_factory
+        self.min_size = max(1, min_size)
+        self.max_size = max(self.min_size, max_size)
+        self.target = self.min_size
+        self.tasks: Set[asyncio.Task] = set()
+        self.idle: Set[asyncio.Task] = set()
+
+    def resize(self, target: int) -> int:
+        self.target = max(self.min_size, min(self.max_size, target))
+
+        while len(self.tasks) < self.target:
+            self.tasks.add(asyncio.create_task(self.worker_factory(self)))
+
+        # Idle workers are parked in queue.get(), cancelling them there cannot lose an item
+        for task in list(self.idle):
+            if len(self.tasks) <= self.target:
+                break
+            self.tasks.discard(task)
+            self.idle.discard(task)
+            task.cancel()
+        return self.target
+
+    async def get(self, queue: asyncio.Queue):
+        task = asyncio.current_task()
+        self.idle.add(task)
+        try:
+            return await queue.get()
+        finally:
+            self.idle.discard(task)
+
+    def should_retire(self) -> bool:
+        if len(self.tasks) <= self.target:
+            return False
+        self.tasks.discard(asyncio.current_task())
+        return True
+
+    @property
+    def busy(self) -> int:
+        return len(self.tasks) - len(self.idle)
+
+    def cancel_all(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        self.tasks.clear()
+        self.idle.clear()
+
+
+class PoolController:
+    # Sizes the connect, handle and download stages from queue depths, throughput and CPU use
+    def __init__(self, session: DownloadSession, logger: Logger, peer_queue: asyncio.Queue,
+                 handshake_queue: asyncio.Queue, download_queue: asyncio.Queue,
+                 conn_pool: WorkerPool, handle_pool: WorkerPool, download_pool: WorkerPool):
+        self.session = session
+        self.logger = logger
+        self.peer_queue = peer_queue
+        self.handshake_queue = handshake_queue
+        self.download_queue = download_queue
+        self.conn_pool = conn_pool
+        self.handle_pool = handle_pool
+        self.download_pool = download_pool
+
+        self.rate = 0.0
+        self.rate_before_growth = None
+        self.hold = 0
+        self.cpu = 0.0
+        self.last_bytes = session.bytes_received
+        self.last_wall = time.monotonic()
+        self.last_cpu = time.process_time()
+
+    def _sample(self) -> None:
+        now = time.monotonic()
+        cpu_now = time.process_time()
+        elapsed = max(now - self.last_wall, 1e-6)
+
+        rate = (self.session.bytes_received - self.last_bytes) / elapsed
+        # Smoothed so one slow piece does not undo a good decision
+        self.rate = rate if self.rate == 0 else 0.5 * self.rate + 0.5 * rate
+        self.cpu = (cpu_now - self.last_cpu) / elapsed
+
+        self.last_bytes = self.session.bytes_received
+        self.last_wall = now
+        self.last_cpu = cpu_now
+
+    def _size_downloads(self) -> None:
+        pool = self.download_pool
+        target = pool.target
+
+        if self.hold:
+            self.hold -= 1
+
+        if self.cpu > CPU_HIGH:
+            target -= 1
+            self.rate_before_growth = None
+        elif self.rate_before_growth is not None:
+            # Keep the last growth step only if the extra peers actually moved more data
+            if self.rate < self.rate_before_growth * (1 + MIN_GAIN):
+                target = max(pool.min_size, target - max(1, target // 5))
+                self.hold = HOLD_TICKS
+            self.rate_before_growth = None
+        elif self.download_queue.qsize() > 0 and pool.busy >= target and not self.hold:
+            # Peers are waiting for a slot, grow faster the bigger the pool already is
+            self.rate_before_growth = self.rate
+            target += max(1, target // 4)
+
+        pool.resize(target)
+        # Only as many ready peers wait for a slot as there are slots
+        self.download_queue.bound = pool.target
+
+    def _size_connections(self) -> None:
+        pool = self.conn_pool
+        waiting_peers = self.peer_queue.qsize()
+        ready = self.handshake_queue.qsize() + self.download_queue.qsize()
+
+        if ready >= self.download_pool.target:
+            # Enough connected peers are queued up, dialling more only gets them dropped
+            pool.resize(pool.target // 2)
+        elif waiting_peers:
+            pool.resize(pool.target * 2)
+
+    def _size_handlers(self) -> None:
+        self.handle_pool.resize(self.handshake_queue.qsize() + MIN_HANDLE_TASKS)
+
+    def size_claims(self) -> None:
+        # Big batches on a fresh torrent, small ones near the end so slow peers do not hold the last pieces
+        remaining = self.session.picker.remaining()
+        per_peer = remaining // (2 * self.download_pool.target)
+        self.session.claim_size = max(MIN_CLAIM, min(self.session.max_claim, per_peer))
+
+    def adjust(self) -> None:
+        self._sample()
+        self._size_downloads()
+        self._size_connections()
+        self._size_handlers()
+        self.size_claims()
+
+        self.logger.set_metrics({
+            'connect': self.conn_pool.target,
+            'handle': self.handle_pool.target,
+            'download': self.download_pool.target,
+            'claim': self.session.claim_size,
+            'rate': self.rate,
+            'cpu': self.cpu,
+        })
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(ADJUST_INTERVAL)
+            self.adjust()
@@ -0,0 +1,220 @@
+import asyncio
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from typing import Dict
+
+try:
+    import yappi
+except ImportError:
+    yappi = None
+
+PROFILE_WINDOW = 60 # Seconds of CPU profile captured after the download starts
+LAG_THRESHOLD = 0.1 # A loop that does not come back for this many seconds is reported with its stack
+HEARTBEAT_INTERVAL = 0.02
+SNAPSHOT_INTERVAL = 30 # Seconds between tracemalloc snapshots
+SNAPSHOT_TOP = 25 # Allocation sites listed per snapshot
+TRACEMALLOC_FRAMES = 10
+
+class StageStats:
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'total': round(self.total, 6),
+            'mean': round(self.total / self.count, 6) if self.count else 0.0,
+            'max': round(self.max, 6),
+        }
+
+class Profiler:
+    # Everything goes to files in out_dir so runs can be compared offline:
+    #   cpu.pstats           cProfile (or yappi, if installed) for the first `window` seconds, read with pstats
+    #   loop_lag.log         every time the event loop was blocked longer than lag_threshold, with the blocking stack
+    #   memory-NNN.txt       top allocation sites, memory-NNN.snapshot can be loaded with tracemalloc.Snapshot.load
+    #   stages.json          count / total / mean / max seconds of every pipeline stage
+    def __init__(self, out_dir: str, window: float = PROFILE_WINDOW, lag_threshold: float = LAG_THRESHOLD,
+                 snapshot_interval: float = SNAPSHOT_INTERVAL):
+        self.out_dir = out_dir
+        self.window = window
+        self.lag_threshold = lag_threshold
+        self.snapshot_interval = snapshot_interval
+        self.started_at = None
+        self.stages: Dict[str, StageStats] = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.cpu_profile = None
+        self.cpu_profile_done = False
+        self.window_timer = None
+        # Loop thread id -> time of its last heartbeat
+        self.heartbeats: Dict[int, float] = {}
+        self.snapshot_count = 0
+        os.makedirs(out_dir, exist_ok=True)
+
+    def start(self) -> None:
+        self.started_at = time.monotonic()
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+
+        if yappi:
+            # yappi sees every thread: tracker, connector and web seeds
+            yappi.set_clock_type("wall")
+            yappi.start()
+            # A daemon, and cancelled in stop(), so a finished download does not wait for the window to close
+            self.window_timer = threading.Timer(self.window, self._stop_cpu_profile)
+            self.window_timer.daemon = True
+            self.window_timer.start()
+        else:
+            self.cpu_profile = cProfile.Profile()
+
+        threading.Thread(target=self._watchdog, daemon=True).start()
+        threading.Thread(target=self._snapshot_loop, daemon=True).start()
+
+    def stop(self) -> None:
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        if self.window_timer:
+            self.window_timer.cancel()
+        self._stop_cpu_profile()
+        self.take_snapshot()
+        self.write_stages()
+        tracemalloc.stop()
+
+    # --- CPU profile
+
+    def _in_window(self) -> bool:
+        return self.started_at is not None and time.monotonic() - self.started_at < self.window
+
+    def _stop_cpu_profile(self) -> None:
+        with self.lock:
+            if self.cpu_profile_done:
+                return
+            self.cpu_profile_done = True
+
+        path = os.path.join(self.out_dir, "cpu.pstats")
+        if yappi:
+            yappi.stop()
+            yappi.get_func_stats().save(path, type="pstat")
+        elif self.cpu_profile:
+            # cProfile only sees the thread that enabled it, the loop thread, see watch_loop
+            self.cpu_profile.dump_stats(path)
+
+    # --- Event loop lag
+
+    @contextlib.contextmanager
+    def watch_loop(self):
+        # Wrap one run of the download pipeline. Heartbeats show whether the loop is alive, the cProfile
+        # capture is switched on for this thread while the window is open
+        loop = asyncio.get_running_loop()
+        thread_id = threading.get_ident()
+        heartbeat = loop.create_task(self._heartbeat(thread_id))
+
+        profiling = self.cpu_profile is not None and not self.cpu_profile_done and self._in_window()
+        if profiling:
+            self.cpu_profile.enable()
+            loop.call_later(max(0.0, self.window - (time.monotonic() - self.started_at)), self._end_window)
+        try:
+            yield
+        finally:
+            heartbeat.cancel()
+            self.heartbeats.pop(thread_id, None)
+            if profiling:
+                self.cpu_profile.disable()
+
+    def _end_window(self) -> None:
+        self.cpu_profile.disable()
+        self._stop_cpu_profile()
+
+    async def _heartbeat(self, thread_id: int) -> None:
+        while True:
+            self.heartbeats[thread_id] = time.monotonic()
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    def _watchdog(self) -> None:
+        # Runs in its own thread, so it can look at a loop thread while that thread is stuck
+        reported = {}
+        path = os.path.join(self.out_dir, "loop_lag.log")
+        while not self.stopped.wait(self.lag_threshold / 2):
+            now = time.monotonic()
+            frames = sys._current_frames()
+            for thread_id, beat in list(self.heartbeats.items()):
+                lag = now - beat
+                if lag < self.lag_threshold + HEARTBEAT_INTERVAL or reported.get(thread_id) == beat:
+                    continue
+                # One report per stall, with the stack of whatever is holding the loop
+                reported[thread_id] = beat
+                frame = frames.get(thread_id)
+                stack = ''.join(traceback.format_stack(frame)) if frame else "  <no frame>\n"
+                with open(path, "a") as f:
+                    f.write(f"[{time.strftime('%H:%M:%S')}] loop in thread {thread_id} blocked for {lag * 1000:.0f} ms\n{stack}\n")
+
+    # --- Memory
+
+    def _snapshot_loop(self) -> None:
+        while not self.stopped.wait(self.snapshot_interval):
+            self.take_snapshot()
+            self.write_stages()
+
+    def take_snapshot(self) -> None:
+        if not tracemalloc.is_tracing():
+            return
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        with self.lock:
+            self.snapshot_count += 1
+            name = f"memory-{self.snapshot_count:03d}"
+
+        snapshot.dump(os.path.join(self.out_dir, name + ".snapshot"))
+        current, peak = tracemalloc.get_traced_memory()
+        with open(os.path.join(self.out_dir, name + ".txt"), "w") as f:
+            f.write(f"elapsed {time.monotonic() - self.started_at:.0f} s, traced {current / 2**20:.1f} MiB, peak {peak / 2**20:.1f} MiB\n")
+            for stat in snapshot.statistics("lineno")[:SNAPSHOT_TOP]:
+                f.write(f"{stat}\n")
+
+    # --- Pipeline stages
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def record(self, name: str, seconds: float) -> None:
+        with self.lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = StageStats()
+            stats.add(seconds)
+
+    def write_stages(self) -> None:
+        with self.lock:
+            data = {name: stats.to_dict() for name, stats in sorted(self.stages.items())}
+        tmp_path = os.path.join(self.out_dir, "stages.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp_path, os.path.join(self.out_dir, "stages.json"))
+
+def stage(profiler, name: str):
+    # Stage timer that costs nothing when profiling is off
+    return profiler.stage(name) if profiler else contextlib.nullcontext()
@@ -0,0 +1,290 @@
+import asyncio
+import itertools
+import struct
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Dict, List, Optional, Tuple
+
+import utils.build_messages as messages
+
+RECORDING_MAGIC = b"BTREC1\n"
+RECORD_HEADER = struct.Struct(">BIdI") # kind, connection id, seconds since the recording started, payload length
+OPEN, RECV, SEND, EOF, CLOSE = range(5)
+HANDSHAKE_LENGTH = messages.HANDSHAKE.size
+MSG_REQUEST = 6
+MSG_PIECE = 7
+
+class SessionRecorder:
+    # Appends the raw bytes of every peer connection to one file, as they arrive and leave, with timestamps.
+    # Taps the reader and writer in place so the pipeline does not see any difference
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(RECORDING_MAGIC)
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.connection_ids = itertools.count()
+
+    def _write(self, kind: int, conn_id: int, payload=b'') -> None:
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(RECORD_HEADER.pack(kind, conn_id, time.monotonic() - self.started_at, len(payload)))
+            self.file.write(payload)
+
+    def tap(self, peer, reader: asyncio.StreamReader, writer) -> None:
+        conn_id = next(self.connection_ids)
+        self._write(OPEN, conn_id, f"{peer.ip}:{peer.port}".encode())
+
+        feed_data, feed_eof = reader.feed_data, reader.feed_eof
+        write, close = writer.write, writer.close
+
+        def recording_feed_data(data):
+            self._write(RECV, conn_id, data)
+            feed_data(data)
+
+        def recording_feed_eof():
+            self._write(EOF, conn_id)
+            feed_eof()
+
+        def recording_write(data):
+            self._write(SEND, conn_id, data)
+            write(data)
+
+        def recording_close():
+            self._write(CLOSE, conn_id)
+            close()
+
+        reader.feed_data = recording_feed_data
+        reader.feed_eof = recording_feed_eof
+        writer.write = recording_write
+        writer.writelines = lambda chunks: recording_write(b''.join(chunks))
+        writer.close = recording_close
+
+    def close(self) -> None:
+        with self.lock:
+            self.file.close()
+
+class RecordedConnection:
+    # Everything one connection received, split into protocol messages with the time (since the connect)
+    # each one was complete. Piece blocks also keep how long after their request they arrived
+    def __init__(self, peer: Tuple[str, int], opened_at: float):
+        self.peer = peer
+        self.opened_at = opened_at
+        self.received = bytearray()
+        self.received_at: List[Tuple[int, float]] = [] # (end offset in received, time) per chunk
+        self.sent = bytearray()
+        self.sent_at: List[Tuple[int, float]] = []
+        self.eof_at: Optional[float] = None
+        self._messages = None
+
+    def _times(self, chunks: List[Tuple[int, float]]):
+        # Time at which byte offset `end` had been transferred
+        position = 0
+        def time_of(end: int) -> float:
+            nonlocal position
+            while chunks[position][0] < end:
+                position += 1
+            return chunks[position][1]
+        return time_of
+
+    def _split(self, data: bytearray, chunks):
+        # (time, message) for the handshake and every length prefixed message after it
+        split = []
+        if len(data) < HANDSHAKE_LENGTH:
+            return split
+        time_of = self._times(chunks)
+        split.append((time_of(HANDSHAKE_LENGTH), bytes(data[:HANDSHAKE_LENGTH])))
+        pos = HANDSHAKE_LENGTH
+        while pos + 4 <= len(data):
+            end = pos + 4 + messages.LENGTH.unpack_from(data, pos)[0]
+            if end > len(data):
+                break
+            split.append((time_of(end), bytes(data[pos:end])))
+            pos = end
+        return split
+
+    def messages(self):
+        # Returns (control messages in order, piece blocks by (index, begin))
+        if self._messages is None:
+            self._messages = self._parse_messages()
+        return self._messages
+
+    def _parse_messages(self):
+        requested_at = {}
+        for sent_time, msg in self._split(self.sent, self.sent_at)[1:]:
+            if len(msg) == messages.REQUEST.size and msg[4] == MSG_REQUEST:
+                requested_at[tuple(messages.REQUEST.unpack_from(msg)[2:4])] = sent_time
+
+        control = []
+        blocks = {}
+        for received_time, msg in self._split(self.received, self.received_at):
+            if len(msg) > messages.PIECE_HEADER.size and msg[4] == MSG_PIECE:
+                key = messages.PIECE_HEADER.unpack_from(msg)[2:]
+                blocks[key] = (received_time - requested_at.get(key, received_time), msg)
+            else:
+                control.append((received_time, msg))
+        return control, blocks
+
+def load_recording(path: str) -> List[RecordedConnection]:
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(RECORDING_MAGIC):
+        raise ValueError(f"{path} is not a peer session recording")
+
+    connections: Dict[int, RecordedConnection] = {}
+    pos = len(RECORDING_MAGIC)
+    while pos + RECORD_HEADER.size <= len(data):
+        kind, conn_id, at, length = RECORD_HEADER.unpack_from(data, pos)
+        pos += RECORD_HEADER.size
+        payload = data[pos:pos + length]
+        pos += length
+
+        if kind == OPEN:
+            ip, port = payload.decode().rsplit(":", 1)
+            connections[conn_id] = RecordedConnection((ip, int(port)), at)
+            continue
+        connection = connections.get(conn_id)
+        if connection is None:
+            continue
+        at -= connection.opened_at
+        if kind == RECV:
+            connection.received += payload
+            connection.received_at.append((len(connection.received), at))
+        elif kind == SEND:
+            connection.sent += payload
+            connection.sent_at.append((len(connection.sent), at))
+        elif kind == EOF and connection.eof_at is None:
+            connection.eof_at = at
+
+    return list(connections.values())
+
+class ReplayWriter:
+    # Mirrors the subset of asyncio.StreamWriter used by the download pipeline, requests go to the replay
+    def __init__(self, connection: "ReplayConnection"):
+        self.connection = connection
+        self.buffer = bytearray()
+        self.handshake_seen = False
+        self.closing = False
+
+    def write(self, data) -> None:
+        if self.closing:
+            raise ConnectionError("Replayed connection is closed")
+        self.buffer += data
+        if not self.handshake_seen:
+            if len(self.buffer) < HANDSHAKE_LENGTH:
+                return
+            del self.buffer[:HANDSHAKE_LENGTH]
+            self.handshake_seen = True
+
+        pos = 0
+        while pos + 4 <= len(self.buffer):
+            end = pos + 4 + messages.LENGTH.unpack_from(self.buffer, pos)[0]
+            if end > len(self.buffer):
+                break
+            if end - pos == messages.REQUEST.size and self.buffer[pos + 4] == MSG_REQUEST:
+                self.connection.request(*messages.REQUEST.unpack_from(self.buffer, pos)[2:])
+            pos = end
+        del self.buffer[:pos]
+
+    def writelines(self, data) -> None:
+        for chunk in data:
+            self.write(chunk)
+
+    async def drain(self) -> None:
+        await asyncio.sleep(0)
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+    def close(self) -> None:
+        self.closing = True
+        self.connection.close()
+
+    async def wait_closed(self) -> None:
+        pass
+
+    def get_extra_info(self, name: str, default=None):
+        if name == "peername":
+            return self.connection.recorded.peer
+        return default
+
+class ReplayConnection:
+    # Plays one recorded connection back. Handshake, bitfield, have, choke and unchoke come at their recorded
+    # times; piece blocks are answered when the pipeline requests them, after this peer's recorded request
+    # latency, so the replay still works when the piece picker chooses differently than in the recording.
+    # Block data is the same whichever peer sent it, so blocks are looked up in the whole recording.
+    # A block that was never recorded ends the connection, like a peer going away
+    def __init__(self, recorded: RecordedConnection, speed: float, blocks: Dict[Tuple[int, int], bytes]):
+        self.recorded = recorded
+        self.speed = speed
+        self.blocks = blocks
+        self.control, own_blocks = recorded.messages()
+        latencies = sorted(latency for latency, _ in own_blocks.values())
+        self.latency = latencies[len(latencies) // 2] if latencies else 0.0
+        self.sent_blocks = bool(own_blocks)
+        self.reader = asyncio.StreamReader()
+        self.writer = ReplayWriter(self)
+        self.timers = []
+        self.loop = asyncio.get_running_loop()
+        self.control_task = self.loop.create_task(self._play_control())
+
+    def _delay(self, seconds: float) -> float:
+        return seconds / self.speed if self.speed else 0
+
+    async def _play_control(self) -> None:
+        # One task, so the messages keep their order even when they are due at the same time
+        started = self.loop.time()
+        for at, msg in self.control:
+            await asyncio.sleep(max(0.0, started + self._delay(at) - self.loop.time()))
+            self._feed(msg)
+        if self.recorded.eof_at is not None and not self.sent_blocks:
+            # A peer that never sent a block hung up on its own
+            await asyncio.sleep(max(0.0, started + self._delay(self.recorded.eof_at) - self.loop.time()))
+            self._eof()
+
+    def _feed(self, msg: bytes) -> None:
+        if not self.reader.at_eof():
+            self.reader.feed_data(msg)
+
+    def _eof(self) -> None:
+        if not self.reader.at_eof():
+            self.reader.feed_eof()
+
+    def request(self, piece_index: int, begin: int, length: int) -> None:
+        msg = self.blocks.get((piece_index, begin))
+        if msg is None or len(msg) != messages.PIECE_HEADER.size + length:
+            self.loop.call_soon(self._eof)
+            return
+        if self.speed:
+            self.timers.append(self.loop.call_later(self._delay(self.latency), self._feed, msg))
+        else:
+            self.loop.call_soon(self._feed, msg)
+
+    def close(self) -> None:
+        self.control_task.cancel()
+        for timer in self.timers:
+            timer.cancel()
+        self._eof()
+
+class SessionReplay:
+    # Stands in for the network: every connect to a recorded peer gets that peer's next recorded connection
+    def __init__(self, recorded: List[RecordedConnection], speed: float = 1.0):
+        self.speed = speed
+        self.pending: Dict[Tuple[str, int], deque] = defaultdict(deque)
+        self.blocks: Dict[Tuple[int, int], bytes] = {}
+        for connection in recorded:
+            self.pending[connection.peer].append(connection)
+            for key, (_, msg) in connection.messages()[1].items():
+                self.blocks[key] = msg
+
+    def peers(self) -> List[Tuple[str, int]]:
+        return list(self.pending)
+
+    async def open_connection(self, ip: str, port: int):
+        connections = self.pending.get((ip, port))
+        if not connections:
+            raise ConnectionRefusedError(f"No recorded connection left for {ip}:{port}")
+        connection = ReplayConnection(connections.popleft(), self.speed, self.blocks)
+        return connection.reader, connection.writer
@@ -0,0 +1,54 @@
+from dataclasses import dataclass
+from typing import List, Optional
+
+from utils.block_journal import BlockJournal
+from utils.choker import Choker
+from utils.content_index import ContentIndex
+from utils.details import TorrentDetails
+from utils.json_data import ResumeData
+from utils.lsd import PeerIntake
+from utils.peer_cache import PeerCache
+from utils.piece_picker import PiecePicker, PRIORITY_SKIP
+from utils.profiler import Profiler
+from utils.replay import SessionRecorder, SessionReplay
+from utils.storage import Storage
+
+@dataclass
+class DownloadSession:
+    details: TorrentDetails
+    resume_data: ResumeData
+    storage: Storage
+    picker: PiecePicker
+    peer_cache: Optional[PeerCache] = None
+    journal: Optional[BlockJournal] = None
+    # Files of completed torrents, this torrent's finished files are added to it
+    content_index: Optional[ContentIndex] = None
+
+    # Stream blocks to disk as they arrive instead of holding whole pieces in memory
+    write_through: bool = False
+    # "tcp", "utp" or "auto" (TCP with uTP fallback)
+    transport: str = "tcp"
+    # Upper bound on connects/handshakes in flight, and bounds on peers downloaded from at once
+    max_half_open: int = 32
+    min_peers: int = 2
+    max_peers: int = 40
+    # Pieces a peer claims per batch, resized by the pool controller up to max_claim
+    max_claim: int = 30
+    claim_size: int = 30
+    # Bytes received from peers so far, sampled for throughput
+    bytes_received: int = 0
+    # Upload policy for peers that connect to us, also told how fast each peer sends to us
+    choker: Optional[Choker] = None
+    bytes_uploaded: int = 0
+    # Set with --profile, times the pipeline stages and watches the event loop
+    profiler: Optional[Profiler] = None
+    # Set with --record, writes the raw bytes of every peer connection to a file
+    recorder: Optional[SessionRecorder] = None
+    # Replaces the network with recorded connections, see benchmarks/replay_session.py
+    replay: Optional[SessionReplay] = None
+    # Set when LSD runs, lets LAN peers join the batch being downloaded instead of waiting for the next one
+    peer_intake: Optional[PeerIntake] = None
+
+    def set_file_priorities(self, file_priorities: List[int]) -> None:
+        self.picker.set_file_priorities(file_priorities)
+        self.storage.set_skipped_files(i for i, priority in enumerate(file_priorities) if priority == PRIORITY_SKIP)
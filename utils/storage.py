@@ -0,0 +1,292 @@
+import os
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from typing import Iterable, Iterator, Tuple
+
+from utils.details import TorrentDetails
+
+MAX_OPEN_FILES = 64 # Open file handles kept around between writes
+PARTFILE_NAME = ".partfile" # Holds the bytes of skipped files that share a piece with a wanted file
+WRITE_CACHE_SIZE = 16 * 2**20 # Bytes of written data held back to be merged into larger sequential writes
+FLUSH_INTERVAL = 5 # Seconds data may wait in the write cache
+FSYNC_POLICIES = ("never", "checkpoint")
+
+class Storage:
+    def __init__(self, details: TorrentDetails, preallocate: bool = False, cache_size: int = 0,
+                 flush_interval: float = FLUSH_INTERVAL, fsync: str = "never"):
+        self.details = details
+        # Allocate the whole file up front instead of leaving a sparse file that fills in piece order
+        self.preallocate = preallocate and hasattr(os, "posix_fallocate")
+        self.fsync = fsync
+        # Write-back cache: offset -> data, flushed in offset order with adjacent writes merged
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.cache = {}
+        self.cache_offsets = []
+        self.cached_bytes = 0
+        self.cached_since = 0.0
+        self.disk_writes = 0
+        # Started with the first cached write, flushes data that waited flush_interval even if no write follows
+        self.flusher = None
+        self.closing = threading.Event()
+        self.handles = OrderedDict()
+        # Streaming readers may read from another thread while the download loop writes
+        self.lock = threading.Lock()
+        self.skipped_files = set()
+        self.partfile_path = os.path.join(details.root, PARTFILE_NAME)
+
+        # Every piece that spans more than one file gets a fixed slot in the partfile
+        self.boundary_pieces = [piece_index for piece_index in range(details.num_of_pieces)
+                                if details.piece_first_file[piece_index] != details.piece_last_file[piece_index]]
+
+    def _spans(self, offset: int, length: int) -> Iterator[Tuple[int, int, int, int]]:
+        # Yields (file_index, offset within file, start in data, end in data) for every file overlapping the range
+        end = offset + length
+        piece_length = self.details.piece_length
+        first_file = self.details.piece_first_file[min(offset // piece_length, self.details.num_of_pieces - 1)]
+        offsets = self.details.files.offsets
+        lengths = self.details.files.lengths
+
+        for file_index in range(first_file, len(offsets)):
+            file_offset = offsets[file_index]
+            file_end = file_offset + lengths[file_index]
+
+            if file_offset >= end:
+                break
+
+            # Check if there is an intersection between [offset, end) and [file_offset, file_end)
+            overlap_start = max(offset, file_offset)
+            overlap_end = min(end, file_end)
+
+            if overlap_start < overlap_end:
+                yield file_index, overlap_start - file_offset, overlap_start - offset, overlap_end - offset
+
+    def _partfile_spans(self, global_offset: int, length: int) -> Iterator[Tuple[int, int, int]]:
+        # Splits a range of a skipped file into (partfile offset, start in range, end in range) per boundary piece
+        piece_length = self.details.piece_length
+        position = global_offset
+        end = global_offset + length
+
+        while position < end:
+            piece_index = position // piece_length
+            piece_end = min(end, (piece_index + 1) * piece_length)
+            slot = bisect_left(self.boundary_pieces, piece_index)
+
+            if slot < len(self.boundary_pieces) and self.boundary_pieces[slot] == piece_index:
+                yield slot * piece_length + position - piece_index * piece_length, position - global_offset, piece_end - global_offset
+
+            position = piece_end
+
+    def _open_path(self, file_path: str, length: int):
+        handle = self.handles.get(file_path)
+
+        if handle is not None:
+            self.handles.move_to_end(file_path)
+            return handle
+
+        # Ensure the directory exists.
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        #Make the file. Other worker processes may be creating it at the same moment, so never truncate existing data
+        fd = os.open(file_path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(fd).st_size < length:
+            if self.preallocate:
+                # Only allocates the holes, bytes already in the file are kept
+                os.posix_fallocate(fd, 0, length)
+            else:
+                os.ftruncate(fd, length)
+
+        handle = os.fdopen(fd, 'r+b')
+        self.handles[file_path] = handle
+
+        if len(self.handles) > MAX_OPEN_FILES:
+            _, oldest = self.handles.popitem(last=False)
+            if self.fsync == "checkpoint":
+                # The next checkpoint will not see this handle any more
+                oldest.flush()
+                os.fsync(oldest.fileno())
+            oldest.close()
+
+        return handle
+
+    def _open(self, file_index: int):
+        files = self.details.files
+        return self._open_path(files.path(file_index), files.lengths[file_index])
+
+    def set_skipped_files(self, skipped: Iterable[int]) -> None:
+        # A skipped file that is already on disk keeps being written in place
+        skipped = {file_index for file_index in skipped
+                   if file_index in self.skipped_files or not os.path.exists(self.details.files.path(file_index))}
+        with self.lock:
+            # Cached data has to land where the old skip set says before the partfile is moved
+            self._flush_cache()
+            # Files that are wanted again take over whatever was parked for them in the partfile
+            files = self.details.files
+            for file_index in self.skipped_files - skipped:
+                if not os.path.exists(self.partfile_path):
+                    break
+                for part_offset, data_start, data_end in self._partfile_spans(files.offsets[file_index], files.lengths[file_index]):
+                    partfile = self._open_path(self.partfile_path, 0)
+                    partfile.seek(part_offset)
+                    chunk = partfile.read(data_end - data_start)
+                    f = self._open(file_index)
+                    f.seek(data_start)
+                    f.write(chunk)
+            self.skipped_files = skipped
+
+    def _overlaps_cache(self, offset: int, end: int) -> bool:
+        slot = bisect_left(self.cache_offsets, offset)
+        if slot < len(self.cache_offsets) and self.cache_offsets[slot] < end:
+            return True
+        if slot > 0:
+            previous = self.cache_offsets[slot - 1]
+            return previous + len(self.cache[previous]) > offset
+        return False
+
+    def _cache_write(self, offset: int, view: memoryview) -> None:
+        # Blocks are views into received messages and can be kept as they are, mutable buffers are copied
+        if not view.readonly:
+            view = memoryview(bytes(view))
+        existing = self.cache.get(offset)
+        if existing is not None and len(existing) == len(view):
+            self.cache[offset] = view
+            return
+        # A partly overlapping write must not be reordered against what is already cached
+        if existing is not None or self._overlaps_cache(offset, offset + len(view)):
+            self._flush_cache()
+        if not self.cache:
+            self.cached_since = time.monotonic()
+        if self.flusher is None:
+            self.flusher = threading.Thread(target=self._flush_timer, daemon=True)
+            self.flusher.start()
+        self.cache[offset] = view
+        insort(self.cache_offsets, offset)
+        self.cached_bytes += len(view)
+
+        if self.cached_bytes >= self.cache_size or time.monotonic() - self.cached_since >= self.flush_interval:
+            self._flush_cache()
+
+    def _flush_cache(self) -> None:
+        # Runs of adjacent writes, typically neighbouring pieces that finished at different times, go out as one
+        run_start = run_end = None
+        run = []
+        for offset in self.cache_offsets:
+            if run and offset != run_end:
+                self._write(run_start, b''.join(run) if len(run) > 1 else run[0])
+                run = []
+            if not run:
+                run_start = offset
+            data = self.cache[offset]
+            run.append(data)
+            run_end = offset + len(data)
+        if run:
+            self._write(run_start, b''.join(run) if len(run) > 1 else run[0])
+        self.cache.clear()
+        self.cache_offsets.clear()
+        self.cached_bytes = 0
+
+    def _flush_timer(self) -> None:
+        # The last pieces before a stall or the end of a batch would otherwise sit in memory until the next write
+        delay = self.flush_interval
+        while not self.closing.wait(delay):
+            with self.lock:
+                if self.cache and time.monotonic() - self.cached_since >= self.flush_interval:
+                    self._flush_cache()
+                delay = self.flush_interval - (time.monotonic() - self.cached_since) if self.cache else self.flush_interval
+
+    def write(self, offset: int, data: bytes) -> None:
+        view = memoryview(data)
+        with self.lock:
+            if self.cache_size:
+                self._cache_write(offset, view)
+            else:
+                self._write(offset, view)
+
+    def _write(self, offset: int, data: bytes) -> None:
+        view = memoryview(data)
+        self.disk_writes += 1
+        for file_index, file_write_offset, data_start, data_end in self._spans(offset, len(data)):
+            if file_index in self.skipped_files:
+                global_start = offset + data_start
+                for part_offset, part_start, part_end in self._partfile_spans(global_start, data_end - data_start):
+                    partfile = self._open_path(self.partfile_path, 0)
+                    partfile.seek(part_offset)
+                    partfile.write(view[data_start + part_start:data_start + part_end])
+                continue
+
+            f = self._open(file_index)
+            f.seek(file_write_offset)
+            f.write(view[data_start:data_end])
+
+    def _read_cache(self, offset: int, buf: bytearray) -> None:
+        # Cached writes are newer than what is on disk
+        end = offset + len(buf)
+        slot = max(0, bisect_left(self.cache_offsets, offset) - 1)
+        for cached_offset in self.cache_offsets[slot:]:
+            if cached_offset >= end:
+                break
+            data = self.cache[cached_offset]
+            start = max(offset, cached_offset)
+            stop = min(end, cached_offset + len(data))
+            if start < stop:
+                buf[start - offset:stop - offset] = data[start - cached_offset:stop - cached_offset]
+
+    def read(self, offset: int, length: int) -> bytes:
+        buf = bytearray(length)
+        with self.lock:
+            for file_index, file_read_offset, data_start, data_end in self._spans(offset, length):
+                if file_index in self.skipped_files:
+                    if not os.path.exists(self.partfile_path):
+                        continue
+                    global_start = offset + data_start
+                    for part_offset, part_start, part_end in self._partfile_spans(global_start, data_end - data_start):
+                        partfile = self._open_path(self.partfile_path, 0)
+                        partfile.seek(part_offset)
+                        chunk = partfile.read(part_end - part_start)
+                        buf[data_start + part_start:data_start + part_start + len(chunk)] = chunk
+                    continue
+
+                if not os.path.exists(self.details.files.path(file_index)):
+                    continue
+                f = self._open(file_index)
+                f.flush()
+                f.seek(file_read_offset)
+                chunk = f.read(data_end - data_start)
+                buf[data_start:data_start + len(chunk)] = chunk
+            if self.cache:
+                self._read_cache(offset, buf)
+        return bytes(buf)
+
+    def write_piece(self, piece_index: int, piece_data: bytes) -> None:
+        self.write(piece_index * self.details.piece_length, piece_data)
+
+    def flush(self) -> None:
+        with self.lock:
+            self._flush_cache()
+            for handle in self.handles.values():
+                handle.flush()
+
+    def checkpoint(self) -> None:
+        # Called right before progress is saved: with fsync=checkpoint, nothing the resume data or the
+        # block journal claims can be lost to a crash or power cut afterwards
+        with self.lock:
+            self._flush_cache()
+            for handle in self.handles.values():
+                handle.flush()
+                if self.fsync == "checkpoint":
+                    os.fsync(handle.fileno())
+
+    def close(self) -> None:
+        self.closing.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        with self.lock:
+            self._flush_cache()
+            for handle in self.handles.values():
+                handle.close()
+            self.handles.clear()
+            # A write after close starts a new timer
+            self.flusher = None
+            self.closing = threading.Event()
@@ -0,0 +1,85 @@
+import io
+import os
+
+from utils.piece_picker import PiecePicker
+from utils.storage import Storage
+
+class TorrentFileReader(io.RawIOBase):
+    # File-like view of one file of the torrent that blocks until the pieces it needs are verified.
+    # Reading moves the picker's cursor, so the download follows the reader.
+    def __init__(self, picker: PiecePicker, storage: Storage, file_index: int):
+        super().__init__()
+        self.picker = picker
+        self.storage = storage
+        self.piece_length = storage.details.piece_length
+        self.file_offset = storage.details.files.offsets[file_index]
+        self.length = storage.details.files.lengths[file_index]
+        self.position = 0
+        self.picker.set_cursor(self.file_offset // self.piece_length)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            position = offset
+        elif whence == os.SEEK_CUR:
+            position = self.position + offset
+        elif whence == os.SEEK_END:
+            position = self.length + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+
+        self.position = max(0, min(position, self.length))
+        self.picker.set_cursor((self.file_offset + self.position) // self.piece_length)
+        return self.position
+
+    def _pieces_for(self, size: int) -> range:
+        start = self.file_offset + self.position
+        end = start + size
+        return range(start // self.piece_length, (end - 1) // self.piece_length + 1)
+
+    def _read_available(self, size: int) -> bytes:
+        data = self.storage.read(self.file_offset + self.position, size)
+        self.position += len(data)
+        self.picker.set_cursor((self.file_offset + self.position) // self.piece_length)
+        return data
+
+    def read(self, size: int = -1, timeout: float = None) -> bytes:
+        if size is None or size < 0:
+            size = self.length - self.position
+        size = min(size, self.length - self.position)
+        if size <= 0:
+            return b''
+
+        for piece_index in self._pieces_for(size):
+            if not self.picker.wait_for_piece(piece_index, timeout):
+                raise TimeoutError(f"Piece {piece_index} not available within {timeout} sec")
+
+        return self._read_available(size)
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    async def aread(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self.length - self.position
+        size = min(size, self.length - self.position)
+        if size <= 0:
+            return b''
+
+        for piece_index in self._pieces_for(size):
+            await self.picker.wait_for_piece_async(piece_index)
+
+        return self._read_available(size)
+
+def open_torrent_file(picker: PiecePicker, storage: Storage, file_index: int = 0) -> TorrentFileReader:
+    return TorrentFileReader(picker, storage, file_index)
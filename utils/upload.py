@@ -0,0 +1,86 @@
+import asyncio
+
+import utils.build_messages as messages
+import utils.verify_messages as verify
+from utils.choker import Choker
+from utils.logger import Logger
+from utils.session import DownloadSession
+
+TIMEOUT = 5 # Seconds an incoming peer gets to send its handshake
+IDLE_TIMEOUT = 180 # Peers must send something (at least a keep-alive) this often
+MAX_REQUEST_LENGTH = 2**17 # Larger requests are ignored, as other clients do
+MAX_UPLOAD_PEERS = 50 # Incoming connections accepted at once
+
+async def serve_peer(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, session: DownloadSession,
+                     choker: Choker, logger: Logger) -> None:
+    details = session.details
+    picker = session.picker
+    ip, port = writer.get_extra_info("peername")[:2]
+    key = f"{ip}:{port}"
+
+    if len(choker.peers) >= MAX_UPLOAD_PEERS:
+        writer.close()
+        return
+
+    try:
+        handshake = await asyncio.wait_for(messages.recv_whole_message(reader, isHandshake=True), timeout=TIMEOUT)
+        if not verify.is_handshake(handshake, details.info_hash):
+            writer.close()
+            return
+        verified = [picker.is_verified(piece_index) for piece_index in range(details.num_of_pieces)]
+        writer.write(messages.build_bitTorrent_handshake(details) + messages.build_bitfeild(verified, details))
+        await writer.drain()
+    except Exception:
+        writer.close()
+        return
+
+    # Every peer starts choked, the choker decides who is served
+    state = choker.add(key, ip, writer.write)
+    logger.info(f"[{key}] Incoming peer connected")
+
+    try:
+        while True:
+            body = await asyncio.wait_for(messages.recv_message_body(reader), timeout=IDLE_TIMEOUT)
+            if not body:
+                continue
+
+            if body[0] == 2:
+                choker.set_interested(key, True)
+            elif body[0] == 3:
+                choker.set_interested(key, False)
+            elif body[0] == 6 and len(body) == messages.REQUEST_BODY.size:
+                # Requests from a choked peer are dropped, it has to ask again once unchoked
+                _, piece_index, begin, length = messages.REQUEST_BODY.unpack(body)
+                if state.choked or length > MAX_REQUEST_LENGTH or piece_index >= details.num_of_pieces:
+                    continue
+                if not picker.is_verified(piece_index) or begin + length > details.piece_size(piece_index):
+                    continue
+                block = session.storage.read(piece_index * details.piece_length + begin, length)
+                writer.writelines((messages.build_piece_header(piece_index, begin, length), block))
+                await writer.drain()
+                choker.record_upload(key, length)
+                session.bytes_uploaded += length
+            elif body[0] == 21 and len(body) == messages.HASH_REQUEST.size - messages.LENGTH.size:
+                # We do not keep Merkle trees to hand out, a v2 peer has to ask someone else
+                writer.write(messages.HEADER.pack(len(body), 23) + body[1:])
+
+    except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+        pass
+    except Exception as e:
+        logger.error(f"[{key}] Upload failed: {e}")
+    finally:
+        choker.remove(key)
+        writer.close()
+
+async def upload_server(session: DownloadSession, choker: Choker, logger: Logger, port: int) -> None:
+    server = await asyncio.start_server(lambda r, w: serve_peer(r, w, session, choker, logger), "0.0.0.0", port)
+    logger.info(f"Accepting peers on port {port}")
+    async with server:
+        await asyncio.gather(server.serve_forever(), choker.run(logger))
+
+def run_upload_server(session: DownloadSession, choker: Choker, logger: Logger, port: int) -> None:
+    # Runs in its own thread: the download loop is restarted for every peer batch, the listener must stay up
+    try:
+        asyncio.run(upload_server(session, choker, logger, port))
+    except OSError as e:
+        logger.warn(f"Not accepting incoming peers: {e}")
@@ -0,0 +1,544 @@
+import asyncio
+import random
+import struct
+import time
+import weakref
+from collections import OrderedDict, deque
+from typing import Dict, Tuple
+
+# uTP (BEP 29) over asyncio UDP with selective acks and LEDBAT congestion control.
+# Connections hand out a regular asyncio.StreamReader plus a writer with the StreamWriter
+# methods the download pipeline uses, so peers can be reached over TCP or uTP alike.
+
+ST_DATA = 0
+ST_FIN = 1
+ST_STATE = 2
+ST_RESET = 3
+ST_SYN = 4
+VERSION = 1
+EXT_NONE = 0
+EXT_SACK = 1
+
+HEADER = struct.Struct(">BBHIIIHH")
+SEQ_MASK = 0xFFFF
+
+PACKET_SIZE = 1400 # Maximum payload bytes per packet, keeps datagrams under a typical MTU
+CCONTROL_TARGET = 100000 # LEDBAT target queueing delay (microseconds)
+MAX_CWND_INCREASE_PER_RTT = 3000 # Bytes the window may grow per RTT when there is no queueing delay
+MIN_WINDOW = PACKET_SIZE
+INITIAL_WINDOW = 2 * PACKET_SIZE
+RECV_WINDOW = 1024 * 1024 # Receive window advertised to the other side
+WRITE_HIGH_WATER = 256 * 1024 # drain() blocks while more than this is queued or in flight
+MIN_TIMEOUT = 0.5
+INITIAL_TIMEOUT = 1.0
+MAX_TIMEOUTS = 6 # Consecutive timeouts before the connection is considered dead
+DUP_ACK_THRESHOLD = 3
+TICK_INTERVAL = 0.1
+DELAY_HISTORY_MINUTES = 2
+
+CS_SYN_SENT = 1
+CS_CONNECTED = 2
+CS_FIN_SENT = 3
+CS_CLOSED = 4
+
+def _micros() -> int:
+    return (time.monotonic_ns() // 1000) & 0xFFFFFFFF
+
+def _seq_less(a: int, b: int) -> bool:
+    # a comes before b with 16 bit wraparound
+    return a != b and ((b - a) & SEQ_MASK) < 0x8000
+
+class _OutgoingPacket:
+    __slots__ = ("seq", "type", "payload", "sent_at", "transmissions")
+
+    def __init__(self, seq: int, ptype: int, payload: bytes):
+        self.seq = seq
+        self.type = ptype
+        self.payload = payload
+        self.sent_at = 0.0
+        self.transmissions = 0
+
+
+class UTPConnection:
+    def __init__(self, endpoint: "UTPEndpoint", addr: Tuple[str, int], recv_id: int, send_id: int):
+        self.endpoint = endpoint
+        self.addr = addr
+        self.recv_id = recv_id
+        self.send_id = send_id
+        self.loop = asyncio.get_running_loop()
+        self.reader = asyncio.StreamReader()
+        self.writer = UTPStreamWriter(self)
+
+        self.state = CS_SYN_SENT
+        self.seq_nr = 1
+        self.ack_nr = 0
+        self.reply_micro = 0
+
+        # Sending side
+        self.send_buffer = bytearray()
+        self.outstanding: "OrderedDict[int, _OutgoingPacket]" = OrderedDict()
+        self.cur_window = 0
+        self.max_window = INITIAL_WINDOW
+        self.peer_window = RECV_WINDOW
+        self.slow_start = True
+        self.duplicate_acks = 0
+        self.last_loss = 0.0
+        self.rtt = 0.0
+        self.rtt_var = 0.8
+        self.rto = INITIAL_TIMEOUT
+        self.timeouts = 0
+        self.closing = False
+
+        # LEDBAT delay tracking: per-minute minima of the one-way delay the peer reports
+        self.delay_history = deque(maxlen=DELAY_HISTORY_MINUTES)
+        self.delay_minute = None
+        self.delay_minute_min = None
+        self.queue_delay = 0
+
+        # Receiving side
+        self.reorder_buffer: Dict[int, Tuple[int, bytes]] = {}
+        self.eof_seq = None
+
+        self.connected = self.loop.create_future()
+        self.closed = self.loop.create_future()
+        self.drain_waiter = None
+        self.timer = self.loop.call_later(TICK_INTERVAL, self._tick)
+
+    # ---- packet helpers ----
+
+    def _recv_window(self) -> int:
+        buffered = sum(len(payload) for _, payload in self.reorder_buffer.values())
+        return max(0, RECV_WINDOW - buffered)
+
+    def _sack_extension(self) -> bytes:
+        if not self.reorder_buffer:
+            return b''
+        # Bit i acknowledges ack_nr + 2 + i
+        mask = bytearray(4)
+        for seq in self.reorder_buffer:
+            bit = (seq - self.ack_nr - 2) & SEQ_MASK
+            if bit < 32:
+                mask[bit // 8] |= 1 << (bit % 8)
+        return bytes([EXT_NONE, len(mask)]) + bytes(mask)
+
+    def _send(self, ptype: int, seq: int, payload: bytes = b'') -> None:
+        ext = self._sack_extension() if ptype == ST_STATE else b''
+        connection_id = self.recv_id if ptype == ST_SYN else self.send_id
+        header = HEADER.pack((ptype << 4) | VERSION, EXT_SACK if ext else EXT_NONE, connection_id,
+                             _micros(), self.reply_micro, self._recv_window(), seq, self.ack_nr)
+        self.endpoint.send(header + ext + payload, self.addr)
+
+    def _transmit(self, packet: _OutgoingPacket) -> None:
+        packet.sent_at = time.monotonic()
+        packet.transmissions += 1
+        self._send(packet.type, packet.seq, packet.payload)
+
+    def _queue_packet(self, ptype: int, payload: bytes) -> None:
+        packet = _OutgoingPacket(self.seq_nr, ptype, payload)
+        self.seq_nr = (self.seq_nr + 1) & SEQ_MASK
+        self.outstanding[packet.seq] = packet
+        self.cur_window += len(payload)
+        self._transmit(packet)
+
+    def send_syn(self) -> None:
+        self.state = CS_SYN_SENT
+        self._queue_packet(ST_SYN, b'')
+
+    def _flush(self) -> None:
+        if self.state not in (CS_CONNECTED, CS_FIN_SENT):
+            return
+
+        window = min(self.max_window, self.peer_window)
+        while self.send_buffer:
+            size = min(PACKET_SIZE, len(self.send_buffer))
+            # Always allow one packet in flight so a tiny window cannot stall the connection
+            if self.cur_window and self.cur_window + size > window:
+                break
+            payload = bytes(self.send_buffer[:size])
+            del self.send_buffer[:size]
+            self._queue_packet(ST_DATA, payload)
+
+        if self.closing and not self.send_buffer and self.state == CS_CONNECTED:
+            self.state = CS_FIN_SENT
+            self._queue_packet(ST_FIN, b'')
+
+        self._wake_drain()
+
+    def _wake_drain(self) -> None:
+        if self.drain_waiter and not self.drain_waiter.done() and len(self.send_buffer) + self.cur_window <= WRITE_HIGH_WATER:
+            self.drain_waiter.set_result(None)
+
+    # ---- congestion control ----
+
+    def _update_base_delay(self, delay: int) -> int:
+        minute = int(time.monotonic() // 60)
+        if minute != self.delay_minute:
+            if self.delay_minute_min is not None:
+                self.delay_history.append(self.delay_minute_min)
+            self.delay_minute = minute
+            self.delay_minute_min = delay
+        else:
+            self.delay_minute_min = min(self.delay_minute_min, delay)
+        return min(list(self.delay_history) + [self.delay_minute_min])
+
+    def _on_bytes_acked(self, bytes_acked: int, delay_sample: int) -> None:
+        if delay_sample:
+            base_delay = self._update_base_delay(delay_sample)
+            self.queue_delay = delay_sample - base_delay
+
+        off_target = (CCONTROL_TARGET - self.queue_delay) / CCONTROL_TARGET
+
+        if self.slow_start and off_target > 0.5:
+            # Exponential growth until queueing delay shows up or we see a loss
+            self.max_window += bytes_acked
+        else:
+            self.slow_start = False
+            gain = MAX_CWND_INCREASE_PER_RTT * off_target * bytes_acked / max(self.max_window, 1)
+            self.max_window += gain
+
+        self.max_window = max(MIN_WINDOW, self.max_window)
+
+    def _on_loss(self) -> None:
+        now = time.monotonic()
+        # React at most once per RTT to a burst of losses
+        if now - self.last_loss < max(self.rtt, 0.05):
+            return
+        self.last_loss = now
+        self.slow_start = False
+        self.max_window = max(MIN_WINDOW, self.max_window / 2)
+
+    def _update_rtt(self, sample: float) -> None:
+        if self.rtt == 0.0:
+            self.rtt = sample
+            self.rtt_var = sample / 2
+        else:
+            delta = self.rtt - sample
+            self.rtt_var += (abs(delta) - self.rtt_var) / 4
+            self.rtt += (sample - self.rtt) / 8
+        self.rto = max(MIN_TIMEOUT, self.rtt + 4 * self.rtt_var)
+
+    def _ack_packet(self, seq: int, now: float) -> int:
+        packet = self.outstanding.pop(seq, None)
+        if packet is None:
+            return 0
+        self.cur_window -= len(packet.payload)
+        if packet.transmissions == 1:
+            self._update_rtt(now - packet.sent_at)
+        return len(packet.payload)
+
+    def _process_ack(self, ack_nr: int, sack: bytes, delay_sample: int, is_state: bool) -> None:
+        now = time.monotonic()
+        bytes_acked = 0
+        acked_any = False
+
+        for seq in list(self.outstanding):
+            if _seq_less(ack_nr, seq):
+                break
+            bytes_acked += self._ack_packet(seq, now)
+            acked_any = True
+
+        if sack:
+            for bit in range(len(sack) * 8):
+                if sack[bit // 8] & (1 << (bit % 8)):
+                    seq = (ack_nr + 2 + bit) & SEQ_MASK
+                    if seq in self.outstanding:
+                        bytes_acked += self._ack_packet(seq, now)
+                        acked_any = True
+
+        if acked_any:
+            self.timeouts = 0
+            self.duplicate_acks = 0
+        elif self.outstanding and is_state:
+            self.duplicate_acks += 1
+
+        # Fast retransmit: the first unacked packet was skipped over by several later ones
+        if self.outstanding:
+            first = next(iter(self.outstanding.values()))
+            sacked_after = 0
+            if sack:
+                sacked_after = sum(bin(byte).count("1") for byte in sack)
+            if self.duplicate_acks >= DUP_ACK_THRESHOLD or sacked_after >= DUP_ACK_THRESHOLD:
+                if now - first.sent_at > self.rtt:
+                    self._on_loss()
+                    self._transmit(first)
+                self.duplicate_acks = 0
+
+        if bytes_acked:
+            self._on_bytes_acked(bytes_acked, delay_sample)
+
+        if self.state == CS_FIN_SENT and not self.outstanding:
+            self._finish()
+
+    # ---- incoming packets ----
+
+    def on_packet(self, ptype: int, extension: int, timestamp: int, timestamp_diff: int,
+                  wnd_size: int, seq_nr: int, ack_nr: int, data: bytes) -> None:
+        if timestamp:
+            self.reply_micro = (_micros() - timestamp) & 0xFFFFFFFF
+        self.peer_window = wnd_size
+
+        # Walk the extension chain, we only understand selective acks
+        sack = b''
+        while extension != EXT_NONE and len(data) >= 2:
+            next_extension, length = data[0], data[1]
+            if extension == EXT_SACK:
+                sack = data[2:2 + length]
+            data = data[2 + length:]
+            extension = next_extension
+
+        if ptype == ST_RESET:
+            self._abort(ConnectionResetError("uTP connection reset by peer"))
+            return
+
+        if self.state == CS_SYN_SENT:
+            if ptype != ST_STATE:
+                return
+            self.state = CS_CONNECTED
+            self.ack_nr = (seq_nr - 1) & SEQ_MASK
+            if not self.connected.done():
+                self.connected.set_result(None)
+
+        self._process_ack(ack_nr, sack, timestamp_diff, ptype == ST_STATE)
+
+        if ptype in (ST_DATA, ST_FIN):
+            self._on_data(ptype, seq_nr, data)
+
+        self._flush()
+
+    def _on_data(self, ptype: int, seq_nr: int, data: bytes) -> None:
+        expected = (self.ack_nr + 1) & SEQ_MASK
+
+        if seq_nr == expected:
+            self._deliver(ptype, seq_nr, data)
+            # Drain anything that was waiting on this packet
+            while True:
+                expected = (self.ack_nr + 1) & SEQ_MASK
+                if expected not in self.reorder_buffer:
+                    break
+                buffered_type, buffered = self.reorder_buffer.pop(expected)
+                self._deliver(buffered_type, expected, buffered)
+        elif _seq_less(expected, seq_nr) and ((seq_nr - expected) & SEQ_MASK) < 1024:
+            self.reorder_buffer[seq_nr] = (ptype, data)
+
+        # Ack everything, duplicates included, so the sender can tell what we hold
+        self._send(ST_STATE, self.seq_nr)
+
+    def _deliver(self, ptype: int, seq_nr: int, data: bytes) -> None:
+        self.ack_nr = seq_nr
+        if ptype == ST_FIN:
+            self.eof_seq = seq_nr
+            self.reader.feed_eof()
+        elif data and not self.reader.at_eof():
+            self.reader.feed_data(data)
+
+    # ---- timers and shutdown ----
+
+    def _tick(self) -> None:
+        self.timer = None
+        if self.state == CS_CLOSED:
+            return
+
+        if self.outstanding:
+            oldest = next(iter(self.outstanding.values()))
+            if time.monotonic() - oldest.sent_at > self.rto:
+                self.timeouts += 1
+                if self.timeouts > MAX_TIMEOUTS:
+                    self._abort(TimeoutError("uTP connection timed out"))
+                    return
+                # On timeout the window collapses to a single packet (BEP 29)
+                self.max_window = MIN_WINDOW
+                self.slow_start = False
+                self.rto = min(self.rto * 2, 60.0)
+                self._transmit(oldest)
+
+        self.timer = self.loop.call_later(TICK_INTERVAL, self._tick)
+
+    def _finish(self) -> None:
+        self.state = CS_CLOSED
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        self.endpoint.unregister(self)
+        if not self.closed.done():
+            self.closed.set_result(None)
+        self._wake_drain()
+        if not self.reader.at_eof():
+            self.reader.feed_eof()
+
+    def _abort(self, exc: Exception) -> None:
+        if not self.connected.done():
+            self.connected.set_exception(exc)
+        if self.drain_waiter and not self.drain_waiter.done():
+            self.drain_waiter.set_exception(exc)
+        if not self.reader.at_eof():
+            self.reader.set_exception(exc)
+        self._finish()
+
+    def reset(self) -> None:
+        if self.state != CS_CLOSED:
+            self._send(ST_RESET, self.seq_nr)
+        self._finish()
+
+
+class UTPStreamWriter:
+    # Mirrors the subset of asyncio.StreamWriter used by the download pipeline
+    def __init__(self, connection: UTPConnection):
+        self.connection = connection
+
+    def write(self, data: bytes) -> None:
+        if self.connection.closing or self.connection.state == CS_CLOSED:
+            raise ConnectionError("uTP connection is closed")
+        self.connection.send_buffer += data
+        self.connection._flush()
+
+    def writelines(self, data) -> None:
+        self.write(b''.join(data))
+
+    async def drain(self) -> None:
+        connection = self.connection
+        if connection.state == CS_CLOSED:
+            if connection.reader.exception():
+                raise connection.reader.exception()
+            return
+        if len(connection.send_buffer) + connection.cur_window <= WRITE_HIGH_WATER:
+            return
+        connection.drain_waiter = connection.loop.create_future()
+        await connection.drain_waiter
+
+    def can_write_eof(self) -> bool:
+        return False
+
+    def is_closing(self) -> bool:
+        return self.connection.closing or self.connection.state == CS_CLOSED
+
+    def close(self) -> None:
+        connection = self.connection
+        if connection.closing or connection.state == CS_CLOSED:
+            return
+        connection.closing = True
+        if connection.state == CS_SYN_SENT:
+            connection._finish()
+        else:
+            connection._flush()
+
+    async def wait_closed(self) -> None:
+        try:
+            await asyncio.wait_for(asyncio.shield(self.connection.closed), timeout=max(self.connection.rto * 2, 1.0))
+        except asyncio.TimeoutError:
+            self.connection.reset()
+
+    def get_extra_info(self, name: str, default=None):
+        if name == "peername":
+            return self.connection.addr
+        return default
+
+
+class UTPEndpoint(asyncio.DatagramProtocol):
+    # One UDP socket shared by every uTP connection of an event loop
+    def __init__(self, accept_callback=None):
+        self.transport = None
+        self.connections: Dict[Tuple[Tuple[str, int], int], UTPConnection] = {}
+        self.accept_callback = accept_callback
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def send(self, data: bytes, addr: Tuple[str, int]) -> None:
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.sendto(data, addr)
+
+    def register(self, connection: UTPConnection) -> None:
+        self.connections[(connection.addr, connection.recv_id)] = connection
+
+    def unregister(self, connection: UTPConnection) -> None:
+        self.connections.pop((connection.addr, connection.recv_id), None)
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]) -> None:
+        if len(data) < HEADER.size:
+            return
+        type_ver, extension, connection_id, timestamp, timestamp_diff, wnd_size, seq_nr, ack_nr = HEADER.unpack_from(data)
+        ptype, version = type_ver >> 4, type_ver & 0x0F
+        if version != VERSION or ptype > ST_SYN:
+            return
+
+        addr = addr[:2]
+        if ptype == ST_SYN:
+            self._on_syn(addr, connection_id, seq_nr)
+            return
+
+        connection = self.connections.get((addr, connection_id))
+        if connection is not None:
+            connection.on_packet(ptype, extension, timestamp, timestamp_diff, wnd_size, seq_nr, ack_nr, data[HEADER.size:])
+
+    def _on_syn(self, addr: Tuple[str, int], connection_id: int, seq_nr: int) -> None:
+        recv_id = (connection_id + 1) & SEQ_MASK
+        connection = self.connections.get((addr, recv_id))
+
+        if connection is None:
+            if self.accept_callback is None:
+                return
+            connection = UTPConnection(self, addr, recv_id, connection_id)
+            connection.state = CS_CONNECTED
+            connection.seq_nr = random.randint(0, SEQ_MASK)
+            connection.ack_nr = seq_nr
+            connection.connected.set_result(None)
+            self.register(connection)
+            result = self.accept_callback(connection.reader, connection.writer)
+            if asyncio.iscoroutine(result):
+                asyncio.ensure_future(result)
+
+        # Answer (possibly retransmitted) SYNs with a state packet carrying our initial sequence number
+        connection._send(ST_STATE, connection.seq_nr)
+
+    def error_received(self, exc: Exception) -> None:
+        pass
+
+    def close(self) -> None:
+        for connection in list(self.connections.values()):
+            connection.reset()
+        if self.transport is not None:
+            self.transport.close()
+
+
+_endpoints = weakref.WeakKeyDictionary()
+
+async def get_endpoint() -> UTPEndpoint:
+    # Every asyncio.run() in the connector thread gets a fresh loop, so endpoints are kept per loop
+    loop = asyncio.get_running_loop()
+    endpoint = _endpoints.get(loop)
+    if endpoint is None or endpoint.transport is None or endpoint.transport.is_closing():
+        _, endpoint = await loop.create_datagram_endpoint(UTPEndpoint, local_addr=("0.0.0.0", 0))
+        _endpoints[loop] = endpoint
+    return endpoint
+
+def close_endpoint() -> None:
+    # Called before the loop ends, an endpoint that is only dropped from _endpoints leaks its socket
+    endpoint = _endpoints.pop(asyncio.get_running_loop(), None)
+    if endpoint is not None:
+        endpoint.close()
+
+async def open_utp_connection(host: str, port: int, endpoint: UTPEndpoint = None):
+    if endpoint is None:
+        endpoint = await get_endpoint()
+
+    while True:
+        recv_id = random.randint(0, SEQ_MASK)
+        if ((host, port), recv_id) not in endpoint.connections:
+            break
+
+    connection = UTPConnection(endpoint, (host, port), recv_id, (recv_id + 1) & SEQ_MASK)
+    endpoint.register(connection)
+    connection.send_syn()
+
+    try:
+        await connection.connected
+    except asyncio.CancelledError:
+        connection.reset()
+        raise
+
+    return connection.reader, connection.writer
+
+async def start_utp_server(client_connected_cb, host: str, port: int, endpoint_factory=UTPEndpoint) -> UTPEndpoint:
+    loop = asyncio.get_running_loop()
+    _, endpoint = await loop.create_datagram_endpoint(lambda: endpoint_factory(client_connected_cb), local_addr=(host, port))
+    return endpoint
@@ -25,4 +25,16 @@ def is_unchoke(msg: ParsedMessage) -> bool:
     return msg.id == 1 and msg.size == 1
 
 def is_piece(msg: ParsedMessage) -> bool:
-    return msg.id == 7 and msg.size > 9 and msg.payload is not None
\ No newline at end of file
+    return msg.id == 7 and msg.size > 9 and msg.payload is not None
+
+def is_unchoke_body(body: bytes) -> bool:
+    return len(body) == 1 and body[0] == 1
+
+def is_piece_body(body: bytes) -> bool:
+    return len(body) > 9 and body[0] == 7
+
+def is_hashes_body(body: bytes) -> bool:
+    return len(body) >= 49 and body[0] == 22 and (len(body) - 49) % 32 == 0
+
+def is_hash_reject_body(body: bytes) -> bool:
+    return len(body) == 49 and body[0] == 23
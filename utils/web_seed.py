@@ -0,0 +1,269 @@
+import asyncio
+import ssl
+import time
+from typing import Dict, List, Set, Tuple
+from urllib.parse import quote, urljoin, urlsplit
+
+from utils.get_details import is_multi_file
+from utils.logger import Logger
+from utils.metainfo import FileTable
+from utils.pieces import BufferedPiece
+from utils.session import DownloadSession
+
+WEB_SEED_CONNECTIONS = 4 # Concurrent range requests per web seed URL
+WEB_SEED_CLAIM = 2 # Pieces a web seed connection claims at a time
+HTTP_TIMEOUT = 30 # Seconds allowed for one range request
+MAX_REDIRECTS = 3
+MAX_FAILURES = 5 # Consecutive failures before a web seed URL is given up on
+RETRY_DELAY = 2 # Base back-off in seconds after a failed request
+IDLE_WAIT = 1 # Seconds to wait when every remaining piece is claimed by someone else
+
+class WebSeedError(Exception):
+    pass
+
+def get_web_seed_urls(torrent_info: dict) -> List[str]:
+    url_list = torrent_info.get(b'url-list', [])
+    if isinstance(url_list, bytes):
+        url_list = [url_list]
+
+    urls = []
+    for url in url_list:
+        url = url.decode('utf-8', errors='ignore').strip()
+        if url.startswith(('http://', 'https://')) and url not in urls:
+            urls.append(url)
+    return urls
+
+def get_file_urls(base_url: str, info_dict: dict, files: FileTable) -> List[str]:
+    # BEP 19: multi-file torrents live under <url>/<name>/<path>, a single-file URL ending in '/' gets the name appended.
+    # One URL per entry of the file table, which has no padding files for hybrid torrents and covers v2 file trees
+    name = info_dict[b'name'].decode('utf-8')
+
+    if not is_multi_file(info_dict):
+        if base_url.endswith('/'):
+            return [base_url + quote(name)]
+        return [base_url]
+
+    if not base_url.endswith('/'):
+        base_url += '/'
+    root = base_url + quote(name) + '/'
+    return [root + quote(relative_path) for relative_path in files.relative_paths]
+
+
+class HTTPConnectionPool:
+    # Keep-alive HTTP/1.1 connections per (scheme, host, port), shared by all requests to that server
+    def __init__(self):
+        self.idle: Dict[Tuple[str, str, int], list] = {}
+        # Hosts that answered a range request with the whole resource
+        self.ignores_ranges: Set[str] = set()
+
+    async def _connect(self, scheme: str, host: str, port: int):
+        key = (scheme, host, port)
+        while self.idle.get(key):
+            reader, writer = self.idle[key].pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer
+            writer.close()
+
+        ssl_context = ssl.create_default_context() if scheme == 'https' else None
+        return await asyncio.open_connection(host, port, ssl=ssl_context)
+
+    def _release(self, key: Tuple[str, str, int], reader, writer) -> None:
+        self.idle.setdefault(key, []).append((reader, writer))
+
+    async def get_range(self, url: str, start: int, end: int) -> bytes:
+        # Returns bytes [start, end) of the resource
+        requested = url
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            scheme = parts.scheme
+            port = parts.port or (443 if scheme == 'https' else 80)
+            key = (scheme, parts.hostname, port)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+
+            reader, writer = await self._connect(scheme, parts.hostname, port)
+            try:
+                request = (f"GET {path} HTTP/1.1\r\n"
+                           f"Host: {parts.netloc}\r\n"
+                           f"Range: bytes={start}-{end - 1}\r\n"
+                           f"User-Agent: torrent-download-client\r\n"
+                           f"Connection: keep-alive\r\n\r\n")
+                writer.write(request.encode('latin-1'))
+                await writer.drain()
+                status, headers = await _read_head(reader)
+                # A server that ignores Range sends the whole resource, only the part up to the range end is read
+                body = await _read_body(reader, headers, end if status == 200 else None)
+            except BaseException:
+                writer.close()
+                raise
+
+            if status == 200 or headers.get('connection', '').lower() == 'close':
+                writer.close()
+            else:
+                self._release(key, reader, writer)
+
+            if status in (301, 302, 303, 307, 308) and 'location' in headers:
+                url = urljoin(url, headers['location'])
+                continue
+            if status == 206:
+                if len(body) != end - start:
+                    raise WebSeedError(f"Short range response from {url}: {len(body)} of {end - start} bytes")
+                return body
+            if status == 200:
+                self.ignores_ranges.add(urlsplit(requested).netloc)
+                if len(body) < end:
+                    raise WebSeedError(f"Resource {url} is shorter than expected")
+                return body[start:end]
+            raise WebSeedError(f"HTTP {status} from {url}")
+
+        raise WebSeedError(f"Too many redirects for {url}")
+
+    def close(self) -> None:
+        for connections in self.idle.values():
+            for _, writer in connections:
+                writer.close()
+        self.idle.clear()
+
+async def _read_head(reader: asyncio.StreamReader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise WebSeedError("Connection closed before response")
+    try:
+        status = int(status_line.split()[1])
+    except (IndexError, ValueError):
+        raise WebSeedError(f"Invalid status line {status_line!r}")
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return status, headers
+
+async def _read_body(reader: asyncio.StreamReader, headers: dict, limit: int = None) -> bytes:
+    # With a limit, reading stops once that many bytes are in and the rest of the body is left on the connection
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        body = bytearray()
+        while limit is None or len(body) < limit:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                await reader.readline()
+                break
+            body += await reader.readexactly(size)
+            await reader.readexactly(2)
+        return bytes(body)
+
+    if 'content-length' in headers:
+        length = int(headers['content-length'])
+        return await reader.readexactly(length if limit is None else min(length, limit))
+
+    headers['connection'] = 'close'
+    if limit is None:
+        return await reader.read()
+    try:
+        return await reader.readexactly(limit)
+    except asyncio.IncompleteReadError as e:
+        return e.partial
+
+
+class WebSeed:
+    def __init__(self, base_url: str, info_dict: dict, session: DownloadSession, pool: HTTPConnectionPool):
+        self.base_url = base_url
+        self.file_urls = get_file_urls(base_url, info_dict, session.details.files)
+        self.host = urlsplit(base_url).netloc
+        self.session = session
+        self.pool = pool
+        self.failures = 0
+        self.bytes_received = 0
+
+    def ranges_of_piece(self, piece_index: int) -> List[Tuple[str, int, int, int]]:
+        # (file url, start in file, end in file, start in piece) for every file the piece overlaps
+        details = self.session.details
+        piece_start = piece_index * details.piece_length
+        piece_end = piece_start + details.piece_size(piece_index)
+        ranges = []
+
+        for file_index in details.files_of_piece(piece_index):
+            file_offset = details.files.offsets[file_index]
+            overlap_start = max(piece_start, file_offset)
+            overlap_end = min(piece_end, details.files.end(file_index))
+            if overlap_start < overlap_end:
+                ranges.append((self.file_urls[file_index], overlap_start - file_offset,
+                               overlap_end - file_offset, overlap_start - piece_start))
+        return ranges
+
+    async def fetch_piece(self, piece_index: int) -> BufferedPiece:
+        details = self.session.details
+        piece = BufferedPiece(piece_index, details.piece_size(piece_index), self.session.storage)
+
+        # A piece spanning several files becomes one range request per file, issued concurrently
+        ranges = self.ranges_of_piece(piece_index)
+        requests = [self.pool.get_range(url, start, end) for url, start, end, _ in ranges]
+        bodies = await asyncio.wait_for(asyncio.gather(*requests), timeout=HTTP_TIMEOUT)
+
+        for (_, _, _, begin), body in zip(ranges, bodies):
+            piece.add_block(begin, body)
+            self.bytes_received += len(body)
+        return piece
+
+    async def worker(self, logger: Logger) -> None:
+        picker = self.session.picker
+        all_pieces = range(self.session.details.num_of_pieces)
+
+        while self.failures < MAX_FAILURES and self.host not in self.pool.ignores_ranges and not picker.is_complete():
+            claimed = picker.claim(all_pieces, WEB_SEED_CLAIM)
+            if not claimed:
+                await asyncio.sleep(IDLE_WAIT)
+                continue
+
+            for piece_index in claimed:
+                try:
+                    if picker.is_verified(piece_index) or self.host in self.pool.ignores_ranges:
+                        continue
+
+                    piece = await self.fetch_piece(piece_index)
+
+                    if not piece.verify(self.session.details.hash_of_pieces[piece_index]):
+                        logger.warn(f"[web seed {self.base_url}] Invalid hash for piece {piece_index}. Discarding...")
+                        self.failures += 1
+                        continue
+
+                    if not picker.is_verified(piece_index):
+                        piece.commit()
+                        if picker.mark_verified(piece_index):
+                            logger.success(f"[web seed {self.base_url}] Piece {piece_index} downloaded and verified ✅")
+                    self.failures = 0
+                    logger.update_stats(self.session.resume_data.downloaded, self.session.details.num_of_pieces)
+
+                except Exception as e:
+                    self.failures += 1
+                    logger.error(f"[web seed {self.base_url}] Failed to fetch piece {piece_index}: {type(e).__name__} {e}")
+                    await asyncio.sleep(RETRY_DELAY * self.failures)
+                finally:
+                    picker.release(piece_index)
+
+        if self.failures >= MAX_FAILURES:
+            logger.warn(f"[web seed {self.base_url}] Giving up after {self.failures} consecutive failures")
+        elif self.host in self.pool.ignores_ranges:
+            # Every further piece would mean reading its file from the start again
+            logger.warn(f"[web seed {self.base_url}] Server ignores range requests, giving up")
+
+async def web_seed_main(urls: List[str], info_dict: dict, session: DownloadSession, logger: Logger) -> None:
+    pool = HTTPConnectionPool()
+    seeds = [WebSeed(url, info_dict, session, pool) for url in urls]
+    started_at = time.monotonic()
+
+    try:
+        await asyncio.gather(*[seed.worker(logger) for seed in seeds for _ in range(WEB_SEED_CONNECTIONS)])
+    finally:
+        pool.close()
+
+    elapsed = time.monotonic() - started_at
+    for seed in seeds:
+        logger.info(f"[web seed {seed.base_url}] {seed.bytes_received / 2**20:.1f} MiB in {elapsed:.1f} sec")
+
+def run_web_seeds(urls: List[str], info_dict: dict, session: DownloadSession, logger: Logger) -> None:
+    asyncio.run(web_seed_main(urls, info_dict, session, logger))